@@ -0,0 +1,192 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import re
+import json
+from array import array
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from mk_squit.generation.label_table import IdTable, InternedStringTable, LabelTable, StringTable
+from mk_squit.generation.snapshot import cached_snapshot, load_arrays, save_arrays
+
+SEPARATOR_PATTERN = re.compile(r"[\s,]*")
+
+
+def snapshot_path(data_dir: str, name: str) -> str:
+    """Path of a snapshot (see mk_squit.generation.snapshot) in the data directory's cache."""
+    return os.path.join(data_dir, ".cache", name)
+
+
+def iter_json_array(fp: str, buffer_size: int = 1 << 20) -> Iterator:
+    """
+    Args:
+        fp: file containing a JSON array, e.g. "./data/person-5k-preprocessed.json"
+        buffer_size: number of characters read at a time
+
+    Returns:
+        the elements of the array one by one, without holding more than about buffer_size characters and one
+        element in memory
+    """
+    decoder = json.JSONDecoder()
+    with open(fp, "r") as f:
+        buffer = f.read(buffer_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{fp} does not contain a JSON array.")
+        pos = 1
+        done = False
+        while True:
+            pos = SEPARATOR_PATTERN.match(buffer, pos).end()
+            if buffer.startswith("]", pos):
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element continues past the buffer
+                if done:
+                    raise
+                chunk = f.read(buffer_size)
+                done = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+
+
+def parse_qid(url: str) -> int:
+    """http://www.wikidata.org/entity/Q494 -> 494"""
+    qid = url.split("/")[-1]
+    if not qid.startswith("Q") or not qid[1:].isdigit():
+        raise ValueError(f"{url} is not a Wikidata entity.")
+    return int(qid[1:])
+
+
+def build_entity_arrays(fp: str) -> Dict[str, np.ndarray]:
+    """
+    Args:
+        fp: "./data/person-5k-preprocessed.json"
+
+    Returns:
+        the arrays of an entity table:
+            qids: integer Q-ids of the entities with at least one label
+            item_offsets: label_ids[item_offsets[i]:item_offsets[i + 1]] are the labels of entity i
+            owners: the entity each label belongs to
+            label_ids: ids of the labels in the string table
+            blob, string_offsets: the unique labels, see StringTable
+
+    The file is streamed into flat buffers, so besides the arrays only the lookup of unique labels is held in
+    memory.
+    """
+    interned = dict()
+    blob = bytearray()
+    string_offsets = array("q", [0])
+    qids = array("q")
+    item_offsets = array("q", [0])
+    owners = array("i")
+    label_ids = array("i")
+    for thing in iter_json_array(fp):
+        if not thing["labels"]:
+            continue
+        for label in thing["labels"]:
+            label_id = interned.get(label)
+            if label_id is None:
+                label_id = interned[label] = len(interned)
+                blob += label.encode("utf-8")
+                string_offsets.append(len(blob))
+            label_ids.append(label_id)
+        owners.extend([len(qids)] * len(thing["labels"]))
+        qids.append(parse_qid(thing["thing"]))
+        item_offsets.append(len(label_ids))
+
+    return {
+        "qids": np.frombuffer(qids, dtype=np.int64),
+        "item_offsets": np.frombuffer(item_offsets, dtype=np.int64),
+        "owners": np.frombuffer(owners, dtype=np.int32),
+        "label_ids": np.frombuffer(label_ids, dtype=np.int32),
+        "blob": np.frombuffer(blob, dtype=np.uint8),
+        "string_offsets": np.frombuffer(string_offsets, dtype=np.int64),
+    }
+
+
+def entity_table(arrays: Dict[str, np.ndarray]) -> LabelTable:
+    """LabelTable over the arrays of build_entity_arrays."""
+    return LabelTable(
+        IdTable(arrays["qids"]),
+        InternedStringTable(StringTable(arrays["blob"], arrays["string_offsets"]), arrays["label_ids"]),
+        arrays["item_offsets"],
+        arrays["owners"],
+    )
+
+
+def load_entity_table(fp: str, use_snapshot: bool = True) -> LabelTable:
+    """
+    Args:
+        fp: "./data/person-5k-preprocessed.json"
+        use_snapshot: load from (and save to) a memory-mapped snapshot that is rebuilt whenever the file changes
+
+    Returns:
+        a LabelTable of the entities' Q-values and labels
+    """
+    if not use_snapshot:
+        return entity_table(build_entity_arrays(fp))
+    name = os.path.splitext(os.path.basename(fp))[0]
+    path = snapshot_path(os.path.dirname(fp), name)
+    _, arrays = cached_snapshot(path, [fp], lambda: ({}, build_entity_arrays(fp)), save=save_arrays, load=load_arrays)
+    return entity_table(arrays)
+
+
+class EntityStore(object):
+    """Entity LabelTables of the start domains, each loaded on first use:
+        store["person"].sample(rng)
+
+    A table holds integer Q-ids, per-entity label ranges and every distinct label once in a contiguous buffer, so
+    it takes little more memory than the label bytes themselves. Snapshot tables are memory-mapped, and loaded
+    tables are not pickled: worker processes load (map) them again when they first need them.
+    """
+
+    def __init__(self, data_dir: str, file_identifier: str, domains: List[str], use_snapshot: bool = True):
+        """
+        Args:
+            data_dir: directory of the preprocessed data files
+            file_identifier: glob of the entity files, "*" is replaced by the domain
+            domains: ["person", "movie", ...]
+            use_snapshot: see load_entity_table
+        """
+        self.data_dir = data_dir
+        self.file_identifier = file_identifier
+        self.domains = list(domains)
+        self.use_snapshot = use_snapshot
+        self._tables = dict()
+
+    def path(self, domain: str) -> str:
+        return os.path.join(self.data_dir, self.file_identifier.replace("*", domain, 1))
+
+    def __getitem__(self, domain: str) -> LabelTable:
+        table = self._tables.get(domain)
+        if table is None:
+            if not os.path.exists(self.path(domain)):
+                raise KeyError(domain)
+            table = load_entity_table(self.path(domain), use_snapshot=self.use_snapshot)
+            self._tables[domain] = table
+        return table
+
+    def __contains__(self, domain: str) -> bool:
+        return domain in self._tables or os.path.exists(self.path(domain))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.domains)
+
+    def __len__(self) -> int:
+        return len(self.domains)
+
+    def keys(self) -> List[str]:
+        return list(self.domains)
+
+    def items(self) -> Iterator:
+        return ((domain, self[domain]) for domain in self.domains)
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_tables"] = dict() if self.use_snapshot else self._tables
+        return state
@@ -0,0 +1,145 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import json
+import hashlib
+from itertools import product
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from mk_squit.generation.template_plan import SUFFIXES, compile_template
+from mk_squit.generation.type_generator import MULTI_ENTITY_EXCLUDED_TYPES, TypeGenerator
+
+THING_TYPES = ["movie", "person", "literary_work", "television_series"]
+
+Signature = Tuple[Tuple[str, ...], ...]
+
+
+def template_signature(number_template: str, pred_chain_lengths: List[int]) -> Signature:
+    """
+    Args:
+        number_template: "[WH] is the [NOUN:A:0] of [THING:A] [VERB-ADP:A:1] ?"
+        pred_chain_lengths: [2]
+
+    Returns:
+        the POS of the predicate slots of every chain in numbered order
+        (("NOUN", "VERB-ADP"),)
+
+    Templates with the same signature can be typed and filled with exactly the same start types and paths.
+    """
+    plan = compile_template(number_template)
+    return tuple(
+        tuple(pos for _, _, pos in plan.pred_slots.get(SUFFIXES[i], [])) for i in range(len(pred_chain_lengths))
+    )
+
+
+class FeasibilityTable(object):
+    """The fillable (template, start types, path) combinations of a TypeGenerator's graph and predicate bank.
+
+    A path is fillable for a template if every step's predicate type has labels with the POS of the slot it types.
+    Combinations are counted per template signature (see template_signature) and start types with the POS-restricted
+    path counts of the TypeGenerator, so nothing is enumerated. Templates without any fillable combination are dead.
+    """
+
+    def __init__(self, type_generator: TypeGenerator, thing_types: List[str] = None):
+        self.type_gen = type_generator
+        self.thing_types = thing_types if thing_types is not None else THING_TYPES
+        # signature -> ([start types, ...], [number of fillable paths, ...]) of the start types with any
+        self._starts: Dict[Signature, Tuple[List[Tuple[str, ...]], List[int]]] = {}
+        self._key: Optional[str] = None
+
+    def key(self) -> str:
+        """Hash of everything besides the templates that decides which templates are live: the predicate types with
+        labels per POS (which also give the graph), the start types and the types chains may not meet on."""
+        if self._key is None:
+            predicate_bank = self.type_gen.predicate_bank
+            pos_pairs = sorted(key for key, table in predicate_bank.predicate_index.items() if len(table))
+            excluded = sorted(MULTI_ENTITY_EXCLUDED_TYPES)
+            text = json.dumps([sorted(predicate_bank.predicate_types), pos_pairs, self.thing_types, excluded])
+            self._key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return self._key
+
+    def starts(self, signature: Signature) -> Tuple[List[Tuple[str, ...]], List[int]]:
+        """
+        Returns:
+            the start types (one per chain) that have fillable paths for the signature, and their numbers of paths
+        """
+        entry = self._starts.get(signature)
+        if entry is None:
+            starts, counts = [], []
+            for things in product(self.thing_types, repeat=len(signature)):
+                if len(signature) == 1:
+                    count = self.type_gen.count_chain_paths(things[0], signature[0])
+                else:
+                    count = self.type_gen.count_bidirectional_chain_paths(things[0], things[1], *signature)
+                if count:
+                    starts.append(things)
+                    counts.append(count)
+            entry = (starts, counts)
+            self._starts[signature] = entry
+        return entry
+
+    def is_live(self, signature: Signature) -> bool:
+        return bool(self.starts(signature)[0])
+
+    def live_indices(self, templates: Sequence[Tuple[str, List[int]]]) -> List[int]:
+        """Indices of the numbered templates that are not dead."""
+        return [i for i, template in enumerate(templates) if self.is_live(template_signature(*template))]
+
+    def report(self, templates: Dict[str, Sequence[Tuple[str, List[int]]]]) -> Dict:
+        """
+        Args:
+            templates: numbered templates per template type, e.g. TemplateGenerator.templates
+
+        Returns:
+            per template type, the number of templates, the dead templates and the number of fillable combinations
+        """
+        report = dict()
+        for key, numbered in templates.items():
+            dead = []
+            combinations = 0
+            for number_template, lengths in numbered:
+                count = sum(self.starts(template_signature(number_template, lengths))[1])
+                if count == 0:
+                    dead.append(number_template)
+                combinations += count
+            report[key] = {"templates": len(numbered), "dead": dead, "combinations": combinations}
+        return report
+
+
+def cached_live_indices(
+    feasibility: FeasibilityTable,
+    templates: Sequence[Tuple[str, List[int]]],
+    template_key: str,
+    cache_dir: Optional[str] = None,
+) -> List[int]:
+    """
+    Args:
+        feasibility: FeasibilityTable of the graph the templates are filled on
+        templates: numbered templates, e.g. a NumberedTemplates view of a grammar
+        template_key: template_cache_key of the templates
+        cache_dir: directory of the cache, None to not cache
+
+    Returns:
+        feasibility.live_indices(templates)
+
+    Finding the live templates numbers and checks every template, which takes seconds for large grammars. With a
+    cache directory the indices are stored in cache_dir/live-templates-<key>.json, keyed by template_key and the
+    FeasibilityTable.key of the graph, and later calls read them back.
+    """
+    if cache_dir is None:
+        return feasibility.live_indices(templates)
+
+    key = hashlib.sha1(f"{template_key}|{feasibility.key()}".encode("utf-8")).hexdigest()
+    path = os.path.join(cache_dir, f"live-templates-{key}.json")
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            cache = json.load(f)
+        if cache.get("key") == key:
+            return cache["live"]
+
+    live = feasibility.live_indices(templates)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"key": key, "live": live}, f)
+    os.replace(path + ".tmp", path)
+    return live
@@ -1,17 +1,59 @@
 # Copyright (c) 2020 MeetKai Inc. All rights reserved.
 
 import os
+import copy
+import time
 import random
 import itertools
+import collections
+import multiprocessing
+import multiprocessing.pool
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import typer
 from tqdm import tqdm
 
 from mk_squit.generation.predicate_bank import PredicateBank
+from mk_squit.generation.profiles import GenerationProfile, load_profiles
+from mk_squit.generation.query_writer import QueryWriter
+from mk_squit.generation.shard_writer import BASE_COLUMNS, METADATA_COLUMNS, QID_COLUMN, ShardedQueryWriter
 from mk_squit.generation.template_filler import TemplateFiller
 from mk_squit.generation.template_generator import TemplateGenerator
+from mk_squit.generation.template_plan import thing_types
+from mk_squit.generation.token_writer import (
+    TOKENIZE_SIDES,
+    TokenWriter,
+    Vocabulary,
+    save_vocabularies,
+    sparql_vocabulary,
+)
 from mk_squit.generation.type_generator import TypeGenerator
+from mk_squit.utils.digest_set import BloomFilter, DigestSet, query_digest
+from mk_squit.utils.instrumentation import Instrumentation
+
+
+# Set in each worker process by _init_worker: the generator (None) and the generators of profiles by name
+_worker_generators = dict()
+
+
+def _init_worker(
+    generator: "FullQueryGenerator", profile_generators: Optional[Dict[str, "FullQueryGenerator"]] = None
+) -> None:
+    _worker_generators.clear()
+    _worker_generators[None] = generator
+    _worker_generators.update(profile_generators or {})
+    for worker_generator in _worker_generators.values():
+        if worker_generator.instrumentation is not None:
+            worker_generator.instrumentation.reset()
+
+
+def _run_shard(shard: Tuple, profile: Optional[str] = None) -> Tuple[List[Tuple[str, str, str]], Optional[Dict]]:
+    generator = _worker_generators[profile]
+    queries = generator.generate_shard(*shard)
+    instrumentation = generator.instrumentation
+    return queries, None if instrumentation is None else instrumentation.take()
 
 
 class FullQueryGenerator(object):
@@ -23,53 +65,593 @@ class FullQueryGenerator(object):
         property_file_identifier: str = "*-props-preprocessed.json",
         entity_file_identifier: str = "*-5k-preprocessed.json",
         type_list_file_name: str = "type-list-autogenerated.json",
+        use_snapshot: bool = True,
+        prune: bool = True,
+        instrument: bool = False,
+        entity_format: str = "label",
     ):
+        """
+        Args:
+            data_dir: directory of the preprocessed data files
+            property_file_identifier: glob of the property files
+            entity_file_identifier: glob of the entity files
+            type_list_file_name: the type list file in data_dir
+            use_snapshot: load the data files from memory-mapped snapshots in data_dir/.cache
+            prune: only draw fillable templates, see TemplateGenerator
+            instrument: record per-stage counters, see Instrumentation
+            entity_format: how entities are written in the SPARQL queries, see TemplateFiller
+        """
+        # A single RNG shared by every stage, reseeded per shard in generate_shard
+        self.rng = random.Random()
+
         self.predicate_bank = PredicateBank(
             data_dir=data_dir,
             property_file_identifier=property_file_identifier,
             entity_file_identifier=entity_file_identifier,
-            type_list_file_name=type_list_file_name
-
+            type_list_file_name=type_list_file_name,
+            rng=self.rng,
+            use_snapshot=use_snapshot,
         )
-        self.type_generator = TypeGenerator(predicate_bank=self.predicate_bank)
+        self.type_generator = TypeGenerator(predicate_bank=self.predicate_bank, rng=self.rng)
 
         self.template_generator = TemplateGenerator(
-            type_generator=self.type_generator, predicate_bank=self.predicate_bank
+            type_generator=self.type_generator,
+            predicate_bank=self.predicate_bank,
+            rng=self.rng,
+            cache_dir=os.path.join(data_dir, ".cache") if use_snapshot else None,
+            prune=prune,
         )
 
-        self.template_filler = TemplateFiller(predicate_bank=self.predicate_bank)
+        self.template_filler = TemplateFiller(predicate_bank=self.predicate_bank, entity_format=entity_format)
 
-    def generate_queries(self, n: int, out_file: str) -> None:
+        # Token vocabularies shared by every tokenized output of generate_queries, created on first use
+        self.vocabularies = None
+
+        # The profile of generators created by with_profile
+        self.profile = None
+
+        # Per-stage counters, dumped next to the output of generate_queries. Nothing is instrumented without them
+        self.instrumentation = None
+        if instrument:
+            self._instrument()
+
+    def _instrument(self) -> None:
+        self.instrumentation = Instrumentation()
+        self.instrumentation.instrument(self, "generate_shard", "generate_shard")
+        self.instrumentation.instrument(
+            self.template_generator, "sample_typed_template", "type_template", reason="no_path", key_arg=0
+        )
+        self.instrumentation.instrument(
+            self.template_filler, "fill_query", "fill_query", reason="missing_pos", key_arg=0
+        )
+        self.instrumentation.instrument(
+            self.template_filler, "fill_query_batch", "fill_query_batch", reason="missing_pos", key_arg=0
+        )
+        self.instrumentation.instrument(self.predicate_bank, "get_entity", "get_thing", key_arg=0)
+        self.instrumentation.instrument(
+            self.predicate_bank, "get_predicate", "get_predicate", reason="missing_pos", key_arg=1
+        )
+
+    def with_profile(self, profile: GenerationProfile) -> "FullQueryGenerator":
+        """
+        Args:
+            profile: GenerationProfile
+
+        Returns:
+            a generator of the profile's grammars, depths and entity domain with its own RNG that shares the loaded
+            predicate bank, type graph, feasibility table and templates with this one, so that only the templates
+            of grammars and depths this generator has not loaded yet are loaded (or enumerated) and pruned
+        """
+        thing_tables = self.predicate_bank.thing_tables
+        if profile.entity_domain is not None and profile.entity_domain not in thing_tables:
+            raise ValueError(
+                f"Entity domain {profile.entity_domain} of profile {profile.name} has no entity file "
+                f"{thing_tables.path(profile.entity_domain)}."
+            )
+        # Created before copying so that every profile shares them
+        self.get_vocabularies()
+
+        generator = copy.copy(self)
+        generator.profile = profile
+        generator.rng = random.Random()
+        generator.predicate_bank = copy.copy(self.predicate_bank)
+        generator.predicate_bank.rng = generator.rng
+        generator.type_generator = copy.copy(self.type_generator)
+        generator.type_generator.predicate_bank = generator.predicate_bank
+        generator.type_generator.rng = generator.rng
+        generator.template_generator = TemplateGenerator(
+            type_generator=generator.type_generator,
+            predicate_bank=generator.predicate_bank,
+            rng=generator.rng,
+            cache_dir=self.template_generator.cache_dir,
+            prune=self.template_generator.feasibility is not None,
+            grammar_set=profile.grammars,
+            depths=profile.depths,
+            feasibility=self.template_generator.feasibility,
+            template_cache=self.template_generator.template_cache,
+        )
+        generator.template_filler = TemplateFiller(
+            generator.predicate_bank,
+            entity_domain=profile.entity_domain,
+            entity_format=self.template_filler.entity_format,
+        )
+        generator.check_template_mix(profile.template_mix)
+        if self.instrumentation is not None:
+            # The copies still hold the methods instrumented for this generator's counters
+            Instrumentation.uninstrument(generator)
+            Instrumentation.uninstrument(generator.predicate_bank)
+            generator._instrument()
+        return generator
+
+    def get_vocabularies(self) -> Dict[str, Vocabulary]:
+        """Token vocabularies shared by every tokenized output of this generator and its profiles, see TokenWriter."""
+        if self.vocabularies is None:
+            self.vocabularies = {"sparql": sparql_vocabulary(self.predicate_bank), "english": Vocabulary()}
+        return self.vocabularies
+
+    def generate_shard(
+        self,
+        seed: int,
+        shard_index: int,
+        size: int,
+        template_mix: Optional[Dict[str, float]] = None,
+        metadata: bool = False,
+        fills_per_template: int = 1,
+    ) -> List[Tuple]:
+        """
+        Args:
+            seed: the master seed of the run
+            shard_index: 3
+            size: the number of iterations in the shard, each iteration tries one template of every type
+            template_mix: {"single_entity": 0.6, "multi_entity": 0.2, "count": 0.2} to instead try one template per
+                iteration, of a type drawn with these weights
+            metadata: append the template type, the chain lengths and the domain (the thing types, comma separated)
+                to every row, which draws nothing from the RNG
+            fills_per_template: fill every typed template this many times with TemplateFiller.fill_query_batch,
+                which draws the entities and predicates of all fills at once, instead of once with fill_query
+
+        Returns:
+            the (english, sparql, hash) tuples generated for this shard
+            ("What is ...?", "SELECT ...", "cfc8...", "single_entity", [2], "person") with metadata
+
+        Every shard draws from its own RNG stream derived from (seed, shard_index), so a shard's output does not
+        depend on which process generates it or on what was generated before it.
+        """
+        self.rng.seed(f"{seed}:{shard_index}")
+        if template_mix is None:
+            keys = itertools.chain.from_iterable(itertools.repeat(list(self.template_generator.templates), size))
+        else:
+            keys = self.rng.choices(list(template_mix), weights=list(template_mix.values()), k=size)
+        queries = []
+        for k in keys:
+            type_template = self.template_generator.sample_typed_template(k)
+            if type_template is None:
+                continue
+            if fills_per_template == 1:
+                filled_template = self.template_filler.fill_query(k, *type_template)
+                filled_templates = None if filled_template is None else [filled_template]
+            else:
+                filled_templates = self.template_filler.fill_query_batch(k, *type_template, fills_per_template)
+            if filled_templates is None:
+                continue
+            if metadata:
+                typed_template, pred_chain_lengths = type_template
+                row_metadata = (k, list(pred_chain_lengths), ",".join(thing_types(typed_template)))
+                filled_templates = [(*filled_template, *row_metadata) for filled_template in filled_templates]
+            queries.extend(filled_templates)
+        return queries
+
+    def iter_shard_results(
+        self, shards: Iterable[Tuple], workers: int = 1, pool: Optional[multiprocessing.pool.Pool] = None
+    ) -> Iterator[Tuple[Tuple, List[Tuple[str, str, str]]]]:
+        """
+        Args:
+            shards: (seed, shard_index, size[, template_mix, metadata, fills_per_template]) arguments of
+                generate_shard, may be infinite
+            workers: the number of processes to generate with
+            pool: a pool of worker processes, initialized with this generator's profile, to generate with instead
+                of starting one, see generate_profiles
+
+        Returns:
+            an iterator of (shard, queries) in the order of shards
+
+        At most 2 * workers shards are in flight at any time, so consumers that stop early or fall behind never
+        cause unbounded work or buffering.
+        """
+        if pool is None:
+            if workers <= 1:
+                for shard in shards:
+                    yield shard, self.generate_shard(*shard)
+                return
+            with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+                yield from self._iter_pool_results(shards, workers, pool, None)
+        else:
+            yield from self._iter_pool_results(shards, workers, pool, self.profile.name)
+
+    def _iter_pool_results(
+        self, shards: Iterable[Tuple], workers: int, pool: multiprocessing.pool.Pool, profile: Optional[str]
+    ) -> Iterator[Tuple[Tuple, List[Tuple[str, str, str]]]]:
+        pending = collections.deque()
+        for shard in shards:
+            pending.append((shard, pool.apply_async(_run_shard, (shard, profile))))
+            if len(pending) >= 2 * workers:
+                shard, result = pending.popleft()
+                yield shard, self._collect(result.get())
+        while pending:
+            shard, result = pending.popleft()
+            yield shard, self._collect(result.get())
+
+    def _collect(self, result: Tuple[List[Tuple[str, str, str]], Optional[Dict]]) -> List[Tuple[str, str, str]]:
+        """Merges the counters a worker recorded for a shard and returns the shard's queries."""
+        queries, counters = result
+        if counters is not None:
+            self.instrumentation.merge(counters)
+        return queries
+
+    def check_template_mix(self, template_mix: Optional[Dict[str, float]]) -> Optional[Dict[str, float]]:
+        """Returns a copy of the template mix, raises a ValueError for unknown template types or invalid weights."""
+        if template_mix is None:
+            return None
+        unknown = [key for key in template_mix if key not in self.template_generator.templates]
+        if unknown:
+            raise ValueError(f"Unknown template types {unknown}, expected {list(self.template_generator.templates)}.")
+        if any(weight < 0 for weight in template_mix.values()) or not sum(template_mix.values()) > 0:
+            raise ValueError(f"Template mix weights must be non-negative with a positive sum, got {template_mix}.")
+        return dict(template_mix)
+
+    def get_example(
+        self, seed: int, i: int, template_mix: Optional[Dict[str, float]] = None, max_attempts: int = 100
+    ) -> Tuple[str, str, str]:
+        """
+        Args:
+            seed: the seed of the virtual dataset
+            i: 1000000000
+            template_mix: weight per template type, see generate_shard, None to use type i % 3 in the order of
+                the templates
+            max_attempts: attempts before giving up on an index whose templates cannot be typed or filled
+
+        Returns:
+            the i-th (english, sparql, hash) of the virtual dataset of the seed
+
+        Every stage draws from the RNG reseeded with a key of (seed, i) only, so an example costs the same for any i
+        and is the same whatever was generated before it: rows can be regenerated, shuffled and split by index
+        without storing them. Attempts that fail (which pruned templates never do) are retried with (seed, i, attempt).
+        """
+        if i < 0:
+            raise ValueError(f"Example index must not be negative, got {i}.")
+        template_mix = self.check_template_mix(template_mix)
+        keys = list(self.template_generator.templates)
+        for attempt in range(max_attempts):
+            self.rng.seed(f"{seed}:example:{i}" if attempt == 0 else f"{seed}:example:{i}:{attempt}")
+            if template_mix is None:
+                key = keys[i % len(keys)]
+            else:
+                key = self.rng.choices(list(template_mix), weights=list(template_mix.values()))[0]
+            type_template = self.template_generator.sample_typed_template(key)
+            if type_template is None:
+                continue
+            filled_template = self.template_filler.fill_query(key, *type_template)
+            if filled_template is not None:
+                return filled_template
+        raise RuntimeError(f"No example {i} of seed {seed} could be generated in {max_attempts} attempts.")
+
+    def iter_queries(
+        self,
+        seed: int,
+        template_mix: Optional[Dict[str, float]] = None,
+        shard_size: int = 100,
+        num_shards: Optional[int] = None,
+        shard_offset: int = 0,
+        shard_step: int = 1,
+        workers: int = 1,
+    ) -> Iterator[Tuple[str, str, str]]:
+        """
+        Args:
+            seed: the master seed of the stream
+            template_mix: weight per template type, see generate_shard, None to try every type in turn
+            shard_size: the number of iterations per shard
+            num_shards: the number of shards in the stream, None for an endless stream
+            shard_offset, shard_step: generate only the shards shard_offset, shard_offset + shard_step, ..., so that
+                shard_step consumers with offsets 0 to shard_step - 1 split the stream without overlap
+            workers: the number of processes to generate with
+
+        Returns:
+            the (english, sparql, hash) tuples of the stream's shards, generated lazily shard by shard
+
+        Shard i of the stream is generate_shard(seed, i, shard_size, template_mix), so the same seed always gives the
+        same stream however it is split, and without a mix it is the output of generate_queries with that seed.
+        """
+        template_mix = self.check_template_mix(template_mix)
+        if num_shards is None:
+            indices = itertools.count(shard_offset, shard_step)
+        else:
+            indices = range(shard_offset, num_shards, shard_step)
+        if template_mix is None:
+            shards = ((seed, i, shard_size) for i in indices)
+        else:
+            shards = ((seed, i, shard_size, template_mix) for i in indices)
+        for _, queries in self.iter_shard_results(shards, workers=workers):
+            yield from queries
+
+    def generate_queries(
+        self,
+        n: int,
+        out_file: str,
+        workers: int = 1,
+        seed: Optional[int] = None,
+        shard_size: int = 1000,
+        chunk_size: int = 10000,
+        resume: bool = False,
+        dedup: Optional[str] = None,
+        unique: bool = False,
+        bloom_filter: bool = False,
+        stall_shards: int = 10,
+        output_format: Optional[str] = None,
+        shard_rows: int = 1000000,
+        tokenize: Optional[str] = None,
+        template_mix: Optional[Dict[str, float]] = None,
+        fills_per_template: int = 1,
+        save_vocab: bool = True,
+        pool: Optional[multiprocessing.pool.Pool] = None,
+    ) -> None:
         """
         Args:
             n: the number of queries to generate
-            out_file: the filename of the output file
+            out_file: the filename of the output file, or the prefix of the shards and manifest with output_format
+            workers: the number of processes to generate with
+            seed: the master seed, a random one is drawn (and printed) if None
+            shard_size: the number of iterations per shard
+            chunk_size: the number of rows buffered before they are written to out_file, see QueryWriter
+            resume: continue an interrupted run from its checkpoint instead of starting over
+            dedup: None to keep duplicates, "sparql" or "pair" to drop rows whose SPARQL query (or english and
+                SPARQL pair) was already generated
+            unique: interpret n as the exact number of unique rows to write instead of the number of iterations,
+                requires dedup
+            bloom_filter: track seen queries in a Bloom filter instead of an exact DigestSet, saving memory at the
+                cost of rarely dropping a unique row
+            stall_shards: in unique mode, stop early once this many consecutive shards produced no new rows
+            output_format: None to write a single TSV file, otherwise one of shard_writer.FORMATS (e.g. "parquet",
+                "jsonl.zst") to write shards of shard_rows rows and a manifest, see ShardedQueryWriter
+            shard_rows: the number of rows per output shard
+            tokenize: "sparql" (or "both" for the english side too) to also write the rows as token IDs, see
+                TokenWriter
+            template_mix: weight per template type, see generate_shard, None to try every type in every iteration
+            fills_per_template: the number of rows filled from every typed template, see generate_shard
+            save_vocab: with tokenize, save the vocabularies next to out_file (e.g. ./out/sparql.vocab.json) after
+                the run, False when later runs extend the same vocabularies and save them instead
+            pool: worker processes to generate with, see iter_shard_results
 
         Generates n queries and writes them to out_file
+
+        The iterations are split into shards of shard_size which are generated independently (see generate_shard)
+        and merged in shard order, so the same seed gives byte-identical output for any number of workers.
+        Deduplication happens during the merge and is just as deterministic.
+
+        Rows are streamed to out_file and checkpointed after a shard, once per chunk of chunk_size rows (or once
+        per output shard with output_format). Since each shard's RNG stream is derived from (seed, shard index),
+        the seed and the index of the next shard are all the RNG state needed to resume. Resuming an output that a
+        previous run completed leaves it as it is.
+
+        If the generator is instrumented, the counters of the run are written to out_file + ".stats.json" and (in
+        the Prometheus textfile format) to out_file + ".stats.prom".
         """
-        all_queries = []
-        for _ in tqdm(itertools.repeat(None, n)):
-            for k, v in self.template_generator.templates.items():
-                number_template = random.choice(v)
-                type_template = self.template_generator.type_template(*number_template)
-                if type_template is None:
-                    continue
-                filled_template = self.template_filler.fill_query(k, *type_template)
-                if filled_template is None:
-                    continue
-                all_queries.append(filled_template)
+        if unique and dedup is None:
+            raise ValueError("Generating n unique rows requires a dedup key.")
+        if fills_per_template < 1:
+            raise ValueError(f"fills_per_template must be positive, got {fills_per_template}.")
+        template_mix = self.check_template_mix(template_mix)
+
+        if self.instrumentation is not None:
+            self.instrumentation.reset()
+        start_time = time.perf_counter()
+
+        seen = None
+        if dedup is not None and bloom_filter:
+            # Every iteration writes up to fills_per_template rows of every template type, or of one with a mix
+            types_per_iteration = len(self.template_generator.templates) if template_mix is None else 1
+            seen = BloomFilter(n if unique else n * types_per_iteration * fills_per_template)
+        elif dedup is not None:
+            # Sized for one unique row per iteration, the set grows if there are more
+            seen = DigestSet(n)
+
+        token_writer = None
+        if tokenize is not None:
+            if tokenize not in TOKENIZE_SIDES:
+                raise ValueError(f"Unknown tokenize value {tokenize}, expected one of {list(TOKENIZE_SIDES)}.")
+            token_writer = TokenWriter(out_file, self.get_vocabularies(), TOKENIZE_SIDES[tokenize])
+
+        # The query with Q-ids follows the hash with the "both" entity format
+        columns = BASE_COLUMNS + ([QID_COLUMN] if self.template_filler.entity_format == "both" else [])
+        if output_format is None:
+            writer = QueryWriter(out_file, chunk_size=chunk_size, columns=columns)
+            metadata = False
+        else:
+            if not output_format.startswith("tsv"):
+                columns = columns + METADATA_COLUMNS
+            writer = ShardedQueryWriter(out_file, fmt=output_format, shard_rows=shard_rows, columns=columns)
+            metadata = writer.metadata
+
+        with writer:
+            state = writer.open(resume=resume)
+            if writer.complete:
+                print(f"{out_file} was completed by a previous run with {writer.rows_written} rows, keeping it")
+                if token_writer is not None:
+                    # Later outputs that share the vocabularies need the IDs this output assigned
+                    token_writer.add(writer.read_rows())
+                return
+            if token_writer is not None:
+                token_writer.open()
+            run_args = {
+                "n": n,
+                "shard_size": shard_size,
+                "dedup": dedup,
+                "unique": unique,
+                "template_mix": template_mix,
+                "fills_per_template": fills_per_template,
+            }
+            if state is not None:
+                if any(state.get(k) != v for k, v in run_args.items()) or seed not in (None, state["seed"]):
+                    raise ValueError(f"The checkpoint of {out_file} was written by a run with different arguments.")
+                seed = state["seed"]
+                print(f"Resuming from shard {state['next_shard']} with seed {seed}")
+                if seen is not None or token_writer is not None:
+                    # Tokenizing the rows again assigns the same IDs as before the interruption
+                    rows = writer.read_rows()
+                    for chunk in iter(lambda: list(itertools.islice(rows, chunk_size)), []):
+                        if seen is not None:
+                            for query in chunk:
+                                seen.add(query_digest(query, dedup))
+                        if token_writer is not None:
+                            token_writer.write(chunk)
+            elif seed is None:
+                seed = random.randrange(2 ** 32)
+                print(f"Using seed {seed}")
+            if state is None:
+                # A sharded output can close a shard in the middle of the first generator shard, see ShardedQueryWriter
+                writer.checkpoint({"seed": seed, "next_shard": 0, **run_args})
+
+            first_shard = 0 if state is None else state["next_shard"]
+            if unique:
+                shards = (
+                    (seed, i, shard_size, template_mix, metadata, fills_per_template)
+                    for i in itertools.count(first_shard)
+                )
+                progress = tqdm(total=n, initial=writer.rows_written)
+            else:
+                shards = [
+                    (seed, i, min(shard_size, n - start), template_mix, metadata, fills_per_template)
+                    for i, start in enumerate(range(0, n, shard_size))
+                ]
+                shards = shards[first_shard:]
+                progress = tqdm(total=n, initial=first_shard * shard_size)
+
+            stalled = 0
+            with progress:
+                for shard, queries in self.iter_shard_results(shards, workers=workers, pool=pool):
+                    if seen is not None:
+                        num_queries = len(queries)
+                        queries = [query for query in queries if seen.add(query_digest(query, dedup))]
+                        if self.instrumentation is not None:
+                            self.instrumentation.add("dedup", "all", num_queries, len(queries), reason="duplicate")
+                    if unique:
+                        queries = queries[: n - writer.rows_written]
+                        stalled = 0 if queries else stalled + 1
+                    write_start = time.perf_counter()
+                    writer.write(queries)
+                    if token_writer is not None:
+                        token_writer.write(queries)
+                    writer.checkpoint({"seed": seed, "next_shard": shard[1] + 1, **run_args})
+                    if self.instrumentation is not None:
+                        self.instrumentation.record("write", "all", time.perf_counter() - write_start)
+                    progress.update(len(queries) if unique else shard[2])
+
+                    if unique and writer.rows_written >= n:
+                        break
+                    if unique and stalled >= stall_shards:
+                        print(
+                            f"WARNING: No new unique rows in {stalled} shards, the template space looks exhausted. "
+                            f"Stopping at {writer.rows_written} rows."
+                        )
+                        break
 
-        with open(out_file, "w") as f:
-            f.write("english\tsparql\tunique hash\n")
-            f.write("\n".join(["\t".join(exs) for exs in all_queries]))
-            print(f"Saved to {out_file}")
+            if token_writer is not None:
+                token_writer.close()
+                if save_vocab:
+                    save_vocabularies(self.vocabularies, token_writer.sides, os.path.dirname(out_file))
+            if self.instrumentation is not None:
+                seconds = time.perf_counter() - start_time
+                run = {
+                    "rows_written": writer.rows_written,
+                    "seconds": seconds,
+                    "rows_per_second": writer.rows_written / seconds if seconds else 0.0,
+                    "workers": workers,
+                }
+                self.instrumentation.dump(out_file + ".stats", run)
+        print(f"Saved to {out_file}")
+
+    def generate_profiles(
+        self,
+        profiles: List[GenerationProfile],
+        out_dir: str,
+        workers: int = 1,
+        seed: Optional[int] = None,
+        extension: str = ".tsv",
+        **kwargs,
+    ) -> None:
+        """
+        Args:
+            profiles: the splits to generate, e.g. [PROFILES["train"], PROFILES["test_easy"], PROFILES["test_hard"]]
+            out_dir: the directory of the outputs, named by the profiles' out and the extension
+            workers: the number of processes to generate with, shared by all splits
+            seed: the master seed of the first split, split i is generated with seed + i, random seeds if None
+            extension: ".tsv", or "" for sharded outputs that are named by a prefix
+            kwargs: further arguments of generate_queries, e.g. dedup="sparql"
+
+        Every split is generated by a generator of its profile (see with_profile), so the predicate bank, the type
+        graph and the templates the profiles have in common are loaded once for all of them. With multiple workers
+        the splits are generated concurrently: the workers hold the generators of every profile, and each split
+        submits its shards to them and writes its output from its own thread. With tokenize, the splits are
+        generated one after another instead, so that the IDs of their shared vocabularies do not depend on timing,
+        and the vocabularies are saved once to out_dir after the last split.
+        """
+        names = [profile.name for profile in profiles]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Profile names must be unique, got {names}.")
+        generators = [self.with_profile(profile) for profile in profiles]
+        tokenize = kwargs.pop("tokenize", None)
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        runs = [
+            (
+                generator,
+                dict(
+                    n=profile.n,
+                    out_file=os.path.join(out_dir, profile.out + extension),
+                    workers=workers,
+                    seed=None if seed is None else seed + i,
+                    template_mix=profile.template_mix,
+                    **kwargs,
+                ),
+            )
+            for i, (profile, generator) in enumerate(zip(profiles, generators))
+        ]
+        if tokenize is not None:
+            for generator, run in runs:
+                generator.generate_queries(tokenize=tokenize, save_vocab=False, **run)
+            save_vocabularies(self.vocabularies, TOKENIZE_SIDES[tokenize], out_dir)
+            return
+        if workers <= 1 or len(runs) == 1:
+            for generator, run in runs:
+                generator.generate_queries(**run)
+            return
+
+        profile_generators = dict(zip(names, generators))
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self, profile_generators)) as pool:
+            with ThreadPoolExecutor(len(runs)) as executor:
+                futures = [executor.submit(generator.generate_queries, pool=pool, **run) for generator, run in runs]
+                for future in futures:
+                    future.result()
 
 
 def generate(
     data_dir: str = "data",
     prop_id: str = "*-props-preprocessed.json",
     ent_id: str = "*-5k-preprocessed.json",
-    out_dir: str = "out"
+    out_dir: str = "out",
+    workers: int = 1,
+    seed: Optional[int] = None,
+    resume: bool = False,
+    dedup: Optional[str] = None,
+    unique: bool = False,
+    snapshot: bool = True,
+    prune: bool = True,
+    stats: bool = True,
+    output_format: Optional[str] = None,
+    shard_rows: int = 1000000,
+    tokenize: Optional[str] = None,
+    profiles: str = "train,test_easy",
+    config: Optional[str] = None,
+    entity_format: str = "label",
+    fills_per_template: int = 1,
 ):
     """Generate dataset end-to-end.
 
@@ -77,15 +659,59 @@ def generate(
         --data-dir data \
         --prop-id *-props-preprocessed.json \
         --ent-id *-5k-preprocessed.json \
-        --out-dir out
+        --out-dir out \
+        --workers 8 \
+        --seed 42
+
+    Pass --resume to continue interrupted runs from their checkpoints. Pass --dedup sparql (or pair) to drop
+    duplicate queries while generating and --unique to keep generating until every set has exactly its n rows.
+    Data files are loaded from memory-mapped snapshots in data_dir/.cache and the live templates of grammars are
+    cached there as well, pass --no-snapshot to parse and prune them instead. Only fillable template, type and path
+    combinations are drawn, pass --no-prune to sample them independently and drop the ones that fail as before.
+    Per-stage times, attempts and failures are written next to every output file (*.stats.json, *.stats.prom)
+    unless --no-stats.
+    Pass --output-format parquet (or arrow, jsonl, tsv, optionally compressed as jsonl.zst, tsv.gz, ...) to write
+    shards of --shard-rows rows with a manifest (e.g. train_queries_v3.manifest.json) instead of a single TSV file.
+    Pass --tokenize sparql (or both) to also write the SPARQL (and english) side as int32 token IDs that can be
+    memory-mapped (*.sparql.ids.npy, *.sparql.offsets.npy) with one vocab file shared by all sets (sparql.vocab.json).
+    The sets are the comma separated --profiles (train, test_easy and test_hard of profiles.PROFILES), built in one
+    run on one loaded predicate bank, pass --config with a JSON file of profiles to define others.
+    Pass --entity-format qid to write entities as their Q-ids (wd:Q76) instead of labels ([ Barack Obama ]) in the
+    SPARQL queries, or both to keep the labels and add the query with Q-ids as a sparql_qid column.
+    Pass --fills-per-template 8 to fill every sampled template 8 times in one batched draw, which writes 8 times the
+    rows per iteration with less work per row.
     """
-    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    available = load_profiles(config)
+    names = [name.strip() for name in profiles.split(",") if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown profiles {unknown}, expected some of {list(available)}.")
+
+    # Sharded outputs are named by a prefix, their files get the format's extension
+    extension = ".tsv" if output_format is None else ""
     query_generator = FullQueryGenerator(
-        data_dir=data_dir, property_file_identifier=prop_id, entity_file_identifier=ent_id
+        data_dir=data_dir,
+        property_file_identifier=prop_id,
+        entity_file_identifier=ent_id,
+        use_snapshot=snapshot,
+        prune=prune,
+        instrument=stats,
+        entity_format=entity_format,
+    )
+    query_generator.generate_profiles(
+        [available[name] for name in names],
+        out_dir,
+        workers=workers,
+        seed=seed,
+        extension=extension,
+        resume=resume,
+        dedup=dedup,
+        unique=unique,
+        output_format=output_format,
+        shard_rows=shard_rows,
+        tokenize=tokenize,
+        fills_per_template=fills_per_template,
     )
-    query_generator.generate_queries(100000, os.path.join(out_dir, "train_queries_v3.tsv"))
-    query_generator.generate_queries(5000, os.path.join(out_dir, "test_easy_queries_v3.tsv"))
-    # query_generator.generate_queries(5000, os.path.join(out_dir, "test_hard_queries_v3.tsv"))     # TEST_HARD
 
 
 if __name__ == "__main__":
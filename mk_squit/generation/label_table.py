@@ -0,0 +1,163 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import random
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+
+class StringTable(object):
+    """Read-only sequence of strings stored as one UTF-8 blob:
+        string i is blob[offsets[i]:offsets[i + 1]]
+
+    Both arrays can be memory-mapped, so a table costs no parsing and no per-string objects until a string is read.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> "StringTable":
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        return self.blob[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        if len(self) == 0:
+            return
+        base = int(self.offsets[0])
+        data = self.blob[base : int(self.offsets[-1])].tobytes()
+        offsets = (self.offsets - base).tolist()
+        for start, end in zip(offsets, offsets[1:]):
+            yield data[start:end].decode("utf-8")
+
+
+class InternedStringTable(object):
+    """Read-only sequence of strings that refer into a table of unique strings:
+        string i is strings[ids[i]]
+
+    Repeated strings (e.g. entity labels shared by many entities) are stored once.
+    """
+
+    def __init__(self, strings: Sequence[str], ids: np.ndarray):
+        self.strings = strings
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> str:
+        return self.strings[int(self.ids[i])]
+
+    def __iter__(self) -> Iterator[str]:
+        strings = self.strings
+        for i in self.ids.tolist():
+            yield strings[i]
+
+
+class IdTable(object):
+    """Read-only sequence of Wikidata ids stored as integers:
+        id i is prefix + str(ids[i]), e.g. "Q494"
+    """
+
+    def __init__(self, ids: np.ndarray, prefix: str = "Q"):
+        self.ids = ids
+        self.prefix = prefix
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> str:
+        return f"{self.prefix}{self.ids[i]}"
+
+    def __iter__(self) -> Iterator[str]:
+        prefix = self.prefix
+        for i in self.ids.tolist():
+            yield f"{prefix}{i}"
+
+
+class LabelTable(object):
+    """Labels of a set of items (properties or entities) stored flat:
+        labels[offsets[i]:offsets[i + 1]] are the labels of the item with id keys[i]
+        owners[j] is the item that labels[j] belongs to
+
+    Every item has at least one label, so sampling never has to retry. Offsets and owners are NumPy arrays so that
+    batches of labels can be drawn with a handful of vectorized operations. Keys and labels are lists when built
+    from data files and StringTables when loaded from a snapshot. Entity tables keep their keys as an IdTable and
+    their labels as an InternedStringTable, see mk_squit.generation.entity_store.
+    """
+
+    def __init__(self, keys: Sequence[str], labels: Sequence[str], offsets: np.ndarray, owners: np.ndarray):
+        self.keys = keys
+        self.labels = labels
+        self.offsets = offsets
+        self.owners = owners
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[str, List[str]]]) -> "LabelTable":
+        """
+        Args:
+            items: [("P27", ["citizenship", "nationality"]), ...], items without labels are skipped
+        """
+        keys, labels, offsets, owners = [], [], [0], []
+        for key, item_labels in items:
+            if not item_labels:
+                continue
+            owners.extend([len(keys)] * len(item_labels))
+            keys.append(key)
+            labels.extend(item_labels)
+            offsets.append(len(labels))
+        return cls(keys, labels, np.array(offsets, dtype=np.int64), np.array(owners, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def sample(self, rng: random.Random, by_label: bool = False) -> Tuple[str, str]:
+        """
+        Args:
+            rng: random source
+            by_label: draw uniformly over all labels instead of uniformly over items and then over the item's labels
+
+        Returns:
+            (label, key) of the item the label belongs to
+        """
+        if by_label:
+            j = rng.randrange(len(self.labels))
+            return self.labels[j], self.keys[self.owners[j]]
+        i = rng.randrange(len(self.keys))
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.labels[start + rng.randrange(end - start)], self.keys[i]
+
+    def sample_indices(
+        self, rng: np.random.Generator, k: int, by_label: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            rng: NumPy random generator
+            k: number of draws
+            by_label: see sample
+
+        Returns:
+            the label indices and item indices of k independent draws
+        """
+        if by_label:
+            labels = rng.integers(0, len(self.labels), size=k)
+            return labels, self.owners[labels]
+        items = rng.integers(0, len(self.keys), size=k)
+        starts = self.offsets[items]
+        return starts + rng.integers(0, self.offsets[items + 1] - starts), items
+
+    def sample_batch(self, rng: np.random.Generator, k: int, by_label: bool = False) -> Tuple[List[str], List[str]]:
+        """Returns the labels and keys of k independent draws, see sample."""
+        labels, items = self.sample_indices(rng, k, by_label=by_label)
+        return [self.labels[j] for j in labels.tolist()], [self.keys[i] for i in items.tolist()]
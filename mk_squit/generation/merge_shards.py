@@ -0,0 +1,292 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import json
+import heapq
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import typer
+
+from mk_squit.generation.shard_writer import (
+    BASE_COLUMNS,
+    FORMATS,
+    METADATA_COLUMNS,
+    ShardedQueryWriter,
+    read_columns,
+    read_shard,
+)
+from mk_squit.generation.template_filler import SPARQL_TEMPLATES
+
+# A run line is hash, sequence number, source index, template type and the JSON encoded row, tab separated
+RUN_FIELDS = 5
+WRITE_BATCH = 10000
+
+
+def input_files(paths: List[str]) -> List[Tuple[str, str, List[str]]]:
+    """
+    Args:
+        paths: manifests of ShardedQueryWriter ("out/train_queries_v3.manifest.json") or output files of any of
+            FORMATS, e.g. the TSV files of QueryWriter ("out/train_queries_v3.tsv")
+
+    Returns:
+        (path, format, columns) of every input shard, in the order of the paths and of the shards in a manifest
+    """
+    files = []
+    for path in paths:
+        if path.endswith(".manifest.json"):
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            if not manifest.get("complete"):
+                raise ValueError(f"{path} belongs to an incomplete run, resume it before merging.")
+            directory = os.path.dirname(path)
+            for shard in manifest["shards"]:
+                files.append((os.path.join(directory, shard["file"]), manifest["format"], manifest["columns"]))
+            continue
+        fmt = max((fmt for fmt in FORMATS if path.endswith("." + fmt)), key=len, default=None)
+        if fmt is None:
+            raise ValueError(f"Cannot tell the format of {path}, expected a manifest or one of {FORMATS}.")
+        columns = read_columns(path, fmt)
+        files.append((path, fmt, columns))
+    return files
+
+
+def template_type(sparql: str) -> str:
+    """
+    Args:
+        sparql: "ASK { [ Barack Obama ] wdt:P26 ?end . [ Michelle Obama ] wdt:P26 ?end . }"
+
+    Returns:
+        the template type of the SPARQL query, told apart by the skeletons of SPARQL_TEMPLATES: "multi_entity"
+    """
+    for key, template in SPARQL_TEMPLATES.items():
+        if sparql.startswith(template.split("[CLAUSES]")[0]):
+            return key
+    return "unknown"
+
+
+class MergeStats(object):
+    """Rows read and duplicates dropped per input shard and per template type."""
+
+    def __init__(self, sources: List[str]):
+        self.sources = sources
+        # source index -> [rows, duplicates]
+        self.shards = [[0, 0] for _ in sources]
+        # template type -> [rows, duplicates]
+        self.template_types: Dict[str, List[int]] = {}
+
+    def read(self, source: int, key: str) -> None:
+        self.shards[source][0] += 1
+        self.template_types.setdefault(key, [0, 0])[0] += 1
+
+    def duplicate(self, source: int, key: str) -> None:
+        self.shards[source][1] += 1
+        self.template_types[key][1] += 1
+
+    @staticmethod
+    def _entry(rows: int, duplicates: int) -> Dict:
+        return {"rows": rows, "duplicates": duplicates, "duplicate_rate": duplicates / rows if rows else 0.0}
+
+    def report(self) -> Dict:
+        rows = sum(shard[0] for shard in self.shards)
+        duplicates = sum(shard[1] for shard in self.shards)
+        return {
+            **self._entry(rows, duplicates),
+            "rows_written": rows - duplicates,
+            "shards": {source: self._entry(*counts) for source, counts in zip(self.sources, self.shards)},
+            "template_types": {key: self._entry(*counts) for key, counts in sorted(self.template_types.items())},
+        }
+
+
+def _read_run(path: str) -> Iterator[Tuple[str, int, int, str, str]]:
+    with open(path, "r", encoding="utf-8", newline="\n") as f:
+        for line in f:
+            h, seq, source, key, row = line.rstrip("\n").split("\t", RUN_FIELDS - 1)
+            yield h, int(seq), int(source), key, row
+
+
+def _write_run(path: str, entries: Iterator[Tuple[str, int, int, str, str]]) -> None:
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        f.writelines(f"{h}\t{seq}\t{source}\t{key}\t{row}\n" for h, seq, source, key, row in entries)
+
+
+class ShardMerger(object):
+    """Merges the outputs of generation runs, e.g. of several machines, into one deduplicated sharded output with
+    bounded memory, by an external sort on the hash column:
+        1. rows are read in runs of run_rows, sorted by (hash, input order) and spilled to temporary files
+        2. the runs are k-way merged, at most fan_in at a time, keeping the first row of every hash
+
+    The output therefore holds every distinct hash once, in hash order, with the row that came first in the order of
+    the inputs. It is written with a ShardedQueryWriter (shards and a manifest) and duplicate rates per input shard
+    and per template type are written to prefix.dedup.json.
+
+    Very large merges can be split over machines by hash: with num_partitions, each merge only keeps the hashes of
+    its partition, so the outputs of partitions 0 to num_partitions - 1 of the same inputs are disjoint.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        fmt: str = "tsv",
+        shard_rows: int = 1000000,
+        run_rows: int = 1000000,
+        fan_in: int = 64,
+        tmp_dir: Optional[str] = None,
+        partition: int = 0,
+        num_partitions: int = 1,
+    ):
+        """
+        Args:
+            prefix: path of the merged output without extension, e.g. "./out/train_queries_v3"
+            fmt: the output format, one of shard_writer.FORMATS
+            shard_rows: the number of rows per output shard
+            run_rows: the number of rows sorted in memory at a time, which bounds the memory use
+            fan_in: the largest number of runs merged (and open files) at a time
+            tmp_dir: directory of the sorted runs, the system's temporary directory by default
+            partition: the partition of hashes to merge, between 0 and num_partitions - 1
+            num_partitions: the number of partitions the hashes are split into
+        """
+        if run_rows <= 0 or fan_in < 2:
+            raise ValueError("run_rows must be positive and fan_in at least 2.")
+        if not 0 <= partition < num_partitions:
+            raise ValueError(f"partition must be between 0 and {num_partitions - 1}, got {partition}.")
+        self.prefix = prefix
+        self.fmt = fmt
+        self.shard_rows = shard_rows
+        self.run_rows = run_rows
+        self.fan_in = fan_in
+        self.tmp_dir = tmp_dir
+        self.partition = partition
+        self.num_partitions = num_partitions
+
+    def in_partition(self, h: str) -> bool:
+        return self.num_partitions == 1 or int(h[:8], 16) % self.num_partitions == self.partition
+
+    def merge(self, paths: List[str]) -> Dict:
+        """
+        Args:
+            paths: the inputs, see input_files
+
+        Returns:
+            the duplicate report, see MergeStats.report
+        """
+        files = input_files(paths)
+        # Columns beyond the base columns are only kept if every input has the same
+        columns = BASE_COLUMNS
+        if files and all(file_columns == files[0][2] for _, _, file_columns in files):
+            columns = files[0][2]
+        if self.fmt.startswith("tsv"):
+            columns = [column for column in columns if column not in METADATA_COLUMNS]
+        stats = MergeStats([path for path, _, _ in files])
+
+        with tempfile.TemporaryDirectory(prefix="merge-", dir=self.tmp_dir) as run_dir:
+            runs = self._spill_runs(files, columns, run_dir, stats)
+            # Runs are merged fan_in at a time until a single merge of all runs is left
+            while len(runs) > self.fan_in:
+                path = os.path.join(run_dir, f"run-{len(os.listdir(run_dir)):06d}.tsv")
+                _write_run(path, self._dedup(runs[: self.fan_in], stats))
+                for run in runs[: self.fan_in]:
+                    os.remove(run)
+                runs = runs[self.fan_in :] + [path]
+
+            writer = ShardedQueryWriter(self.prefix, fmt=self.fmt, shard_rows=self.shard_rows, columns=columns)
+            with writer:
+                writer.open()
+                batch = []
+                for _, _, _, _, row in self._dedup(runs, stats):
+                    batch.append(json.loads(row))
+                    if len(batch) >= WRITE_BATCH:
+                        writer.write(batch)
+                        batch = []
+                writer.write(batch)
+
+        report = stats.report()
+        with open(self.prefix + ".dedup.json", "w") as f:
+            json.dump(report, f, indent=4)
+        return report
+
+    def _spill_runs(
+        self, files: List[Tuple[str, str, List[str]]], columns: List[str], run_dir: str, stats: MergeStats
+    ) -> List[str]:
+        """Reads the inputs in runs of run_rows rows, sorts each run by (hash, sequence number) and writes it."""
+        runs = []
+        entries = []
+        seq = 0
+        type_index = columns.index("template_type") if "template_type" in columns else None
+        for source, (path, fmt, _) in enumerate(files):
+            for row in read_shard(path, fmt, columns=columns):
+                seq += 1
+                h = row[2]
+                if not self.in_partition(h):
+                    continue
+                key = row[type_index] if type_index is not None else template_type(row[1])
+                stats.read(source, key)
+                entries.append((h, seq, source, key, json.dumps(row, ensure_ascii=False)))
+                if len(entries) >= self.run_rows:
+                    runs.append(self._spill(entries, run_dir, len(runs)))
+                    entries = []
+        if entries or not runs:
+            runs.append(self._spill(entries, run_dir, len(runs)))
+        return runs
+
+    @staticmethod
+    def _spill(entries: List[Tuple[str, int, int, str, str]], run_dir: str, index: int) -> str:
+        entries.sort()
+        path = os.path.join(run_dir, f"spill-{index:06d}.tsv")
+        _write_run(path, entries)
+        return path
+
+    @staticmethod
+    def _dedup(runs: List[str], stats: MergeStats) -> Iterator[Tuple[str, int, int, str, str]]:
+        """k-way merges sorted runs and drops every entry whose hash came before, counting it as a duplicate."""
+        last = None
+        for entry in heapq.merge(*(_read_run(run) for run in runs)):
+            if entry[0] == last:
+                stats.duplicate(entry[2], entry[3])
+                continue
+            last = entry[0]
+            yield entry
+
+
+def merge(
+    inputs: List[str],
+    out: str = "out/merged_queries_v3",
+    output_format: str = "tsv",
+    shard_rows: int = 1000000,
+    run_rows: int = 1000000,
+    fan_in: int = 64,
+    tmp_dir: Optional[str] = None,
+    partition: int = 0,
+    num_partitions: int = 1,
+):
+    """Merge generated outputs into one sharded output without duplicate hashes.
+
+    python -m mk_squit.generation.merge_shards \
+        node1/train_queries_v3.tsv node2/train_queries_v3.manifest.json \
+        --out out/train_queries_v3_merged \
+        --output-format parquet
+
+    Memory use is bounded by --run-rows, sorted runs are spilled to --tmp-dir.
+    """
+    merger = ShardMerger(
+        out,
+        fmt=output_format,
+        shard_rows=shard_rows,
+        run_rows=run_rows,
+        fan_in=fan_in,
+        tmp_dir=tmp_dir,
+        partition=partition,
+        num_partitions=num_partitions,
+    )
+    report = merger.merge(inputs)
+    print(
+        f"Merged {report['rows']} rows into {report['rows_written']} rows, dropping {report['duplicates']} "
+        f"duplicates ({report['duplicate_rate']:.2%})"
+    )
+    for key, entry in report["template_types"].items():
+        print(f"    {key}: {entry['duplicates']} of {entry['rows']} rows ({entry['duplicate_rate']:.2%})")
+    print(f"Saved to {out}.manifest.json, duplicate rates per shard in {out}.dedup.json")
+
+
+if __name__ == "__main__":
+    typer.run(merge)
@@ -3,10 +3,20 @@
 import os
 import json
 import random
+import hashlib
 from glob import glob
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import typer
+import numpy as np
+
+from mk_squit.generation.entity_store import EntityStore, snapshot_path
+from mk_squit.generation.label_table import LabelTable
+from mk_squit.generation.snapshot import cached_snapshot
+
+PREDICATE_WEIGHTINGS = ["property", "label"]
+# Version of the layout of the predicate bank's snapshot, part of its file name
+BANK_SNAPSHOT_VERSION = 2
 
 
 class PredicateBank(object):
@@ -14,6 +24,13 @@ class PredicateBank(object):
         - Loads predicate dictionaries
         - Loads property dictionaries
         - Loads the autogenerated type list
+        - Indexes predicate labels by (predicate type, POS)
+        - Loads entity labels per start domain on first use into compact tables for single and batched sampling
+
+    Everything is loaded from binary snapshots of the data files when possible, see mk_squit.generation.snapshot.
+
+    All sampling goes through rng (the global random module by default) so that a seeded random.Random shared with
+    the rest of the pipeline makes generation reproducible.
     """
 
     def __init__(
@@ -22,11 +39,59 @@ class PredicateBank(object):
         property_file_identifier: str = "*-props-preprocessed.json",
         entity_file_identifier: str = "*-5k-preprocessed.json",
         type_list_file_name: str = "type-list-autogenerated.json",
+        rng: random.Random = None,
+        predicate_weighting: str = "property",
+        pos_tags: Tuple[str, ...] = ("NOUN", "VERB-ADP"),
+        use_snapshot: bool = True,
     ):
-        self.bank = self._load_predicate_bank(data_dir=data_dir, file_identifier=property_file_identifier)
-        self.type_list = self._load_type_list(data_dir=data_dir, file_name=type_list_file_name)
-        self.things = self._load_things(
-            data_dir=data_dir, file_identifier=entity_file_identifier, thing_types=self.type_list["start_domains"]
+        """
+        Args:
+            data_dir: directory of the preprocessed data files
+            property_file_identifier: glob of the property files
+            entity_file_identifier: glob of the entity files
+            type_list_file_name: name of the autogenerated type list
+            rng: random source for sampling, defaults to the global random module
+            predicate_weighting: "property" to draw predicates uniformly by property and then by label, "label" to
+                draw uniformly over all labels
+            pos_tags: POS tags the templates use, predicate types without any label for them are reported at load
+            use_snapshot: load from memory-mapped snapshots in data_dir/.cache instead of parsing the data files,
+                snapshots are (re)built automatically whenever the content of the data files changes
+        """
+        if predicate_weighting not in PREDICATE_WEIGHTINGS:
+            raise ValueError(f"Unknown predicate weighting {predicate_weighting}, expected {PREDICATE_WEIGHTINGS}.")
+        self.rng = rng if rng is not None else random
+        self.predicate_weighting = predicate_weighting
+
+        def build():
+            bank = self._load_predicate_bank(data_dir=data_dir, file_identifier=property_file_identifier)
+            type_list = self._load_type_list(data_dir=data_dir, file_name=type_list_file_name)
+            tables = {"index\t" + "\t".join(key): table for key, table in self._index_predicates(bank).items()}
+            tables.update(self._property_tables(bank))
+            return {"predicate_types": list(bank), "type_list": type_list}, tables
+
+        if use_snapshot:
+            sources = sorted(glob(os.path.join(data_dir, property_file_identifier)))
+            sources.append(os.path.join(data_dir, type_list_file_name))
+            key = f"{property_file_identifier}|{type_list_file_name}|{BANK_SNAPSHOT_VERSION}"
+            key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            metadata, tables = cached_snapshot(snapshot_path(data_dir, f"predicate-bank-{key[:12]}"), sources, build)
+        else:
+            metadata, tables = build()
+
+        self.predicate_types: List[str] = metadata["predicate_types"]
+        self.type_list = metadata["type_list"]
+        self.predicate_index = {
+            tuple(name.split("\t")[1:]): table for name, table in tables.items() if name.startswith("index\t")
+        }
+        self.properties: LabelTable = tables["props"]
+        self.property_pos: LabelTable = tables["pos"]
+        self._bank: Optional[Dict] = None
+        self.missing_pos = self._find_missing_pos(pos_tags)
+        self.thing_tables = EntityStore(
+            data_dir=data_dir,
+            file_identifier=entity_file_identifier,
+            domains=self.type_list["start_domains"],
+            use_snapshot=use_snapshot,
         )
 
     def _load_predicate_bank(self, data_dir: str, file_identifier: str) -> Dict:
@@ -47,20 +112,77 @@ class PredicateBank(object):
 
         return predicate_bank
 
+    def _index_predicates(self, bank: Dict) -> Dict[Tuple[str, str], LabelTable]:
+        """Maps (predicate type, POS) to a LabelTable of the labels with that POS and their P-values."""
+        grouped = {}
+        for predicate_type, preds in bank.items():
+            for pred in preds:
+                for pos, labels in pred["pos"].items():
+                    grouped.setdefault((predicate_type, pos), []).append((pred["prop"].split("/")[-1], labels))
+        return {key: LabelTable.from_items(items) for key, items in grouped.items()}
+
+    @staticmethod
+    def _property_tables(bank: Dict) -> Dict[str, LabelTable]:
+        """Stores the properties of the bank, in bank order, as two LabelTables:
+        "props": the labels of each property, keyed by "<predicate type>\t<URL>"
+        "pos": the labels of each POS of each property, keyed by "<predicate type>\t<URL>\t<POS>"
+        """
+        preds = [pred for preds in bank.values() for pred in preds]
+        return {
+            "props": LabelTable.from_items((f"{pred['type']}\t{pred['prop']}", pred["labels"]) for pred in preds),
+            "pos": LabelTable.from_items(
+                (f"{pred['type']}\t{pred['prop']}\t{pos}", labels)
+                for pred in preds
+                for pos, labels in pred["pos"].items()
+            ),
+        }
+
+    @staticmethod
+    def _table_items(table: LabelTable) -> Iterator[Tuple[str, List[str]]]:
+        """(key, labels) of every item of a LabelTable."""
+        labels = list(table.labels)
+        offsets = table.offsets.tolist()
+        for i, key in enumerate(table.keys):
+            yield key, labels[offsets[i] : offsets[i + 1]]
+
+    @property
+    def bank(self) -> Dict[str, List[Dict]]:
+        """The properties by predicate type, as in the data files:
+            {"person->country": [{"prop": ".../P27", "type": "person->country", "labels": [...], "pos": {...}}]}
+
+        Only built from the property tables on first use, generation itself only needs the tables.
+        """
+        if self._bank is None:
+            preds = dict()
+            for key, labels in self._table_items(self.properties):
+                predicate_type, prop = key.split("\t")
+                preds[key] = {"prop": prop, "type": predicate_type, "labels": labels, "pos": dict()}
+            for key, labels in self._table_items(self.property_pos):
+                key, pos = key.rsplit("\t", 1)
+                preds[key]["pos"][pos] = labels
+            self._bank = {predicate_type: [] for predicate_type in self.predicate_types}
+            for pred in preds.values():
+                self._bank[pred["type"]].append(pred)
+        return self._bank
+
+    def _find_missing_pos(self, pos_tags: Tuple[str, ...]) -> Dict[str, List[str]]:
+        """Finds and reports the predicate types that have no labels for each of the given POS tags."""
+        missing_pos = dict()
+        for pos in pos_tags:
+            missing_pos[pos] = [t for t in self.predicate_types if not self.predicate_index.get((t, pos))]
+            if missing_pos[pos]:
+                print(
+                    f"WARNING: {len(missing_pos[pos])} of {len(self.predicate_types)} predicate types have no {pos} "
+                    "labels"
+                )
+        return missing_pos
+
     def _load_type_list(self, data_dir: str, file_name: str) -> Dict:
         fp = os.path.join(data_dir, file_name)
         with open(fp, "r") as f:
             type_list = json.load(f)
         return type_list
 
-    def _load_things(self, data_dir: str, file_identifier: str, thing_types: List[str]) -> Dict:
-        things = dict()
-        for thing_name in thing_types:
-            fp = os.path.join(data_dir, thing_name + file_identifier[1:])
-            with open(fp, "r") as f:
-                things[thing_name] = json.load(f)
-        return things
-
     def get_thing(self, thing_type: str) -> str:
         """
         Args:
@@ -69,28 +191,80 @@ class PredicateBank(object):
         Returns:
             a random label associated with thing
         """
-        return random.choice(random.choice(self.things[thing_type])["labels"])
-        # return random.choice(random.choice(self.things["chemical"])["labels"])
+        return self.get_entity(thing_type)[0]
 
-    def get_predicate(self, predicate_type: str, part_of_speech: str, patience_limit: int = 50) -> (str, str):
+    def get_entity(self, thing_type: str) -> (str, str):
+        """
+        Args:
+            thing_type: "person"
+
+        Returns:
+            a random label and the Q-id of its entity, drawn like get_thing
+            ("Barack Obama", "Q76")
+        """
+        return self.thing_tables[thing_type].sample(self.rng)
+
+    def get_predicate(self, predicate_type: str, part_of_speech: str) -> (str, str):
         """
         Args:
             predicate_type: "person->location"
             part_of_speech: "NOUN", "VERB-ABP", "VERB"
-            patience_limit: limit to how random predicates to look through
 
         Returns:
-            predicate and its P-value with a given type and part of speech tag
-        """
-        part_of_speech = part_of_speech.upper()  # ensure all capitalized
-        item = random.choice(self.bank[predicate_type])
-        patience = 0
-        while part_of_speech not in item["pos"].keys():
-            if patience >= patience_limit:
-                return None
-            item = random.choice(self.bank[predicate_type])
-            patience += 1
-        return random.choice(item["pos"][part_of_speech]), item["prop"].split("/")[-1]
+            predicate and its P-value with a given type and part of speech tag, None if there is no such predicate
+        """
+        table = self.predicate_index.get((predicate_type, part_of_speech.upper()))  # ensure all capitalized
+        if table is None:
+            return None
+        return table.sample(self.rng, by_label=self.predicate_weighting == "label")
+
+    def numpy_rng(self) -> np.random.Generator:
+        """Returns a NumPy generator seeded from rng, so batched draws follow the same seeding as single draws."""
+        return np.random.default_rng(self.rng.getrandbits(64))
+
+    def sample_things(self, thing_type: str, k: int, rng: np.random.Generator = None) -> List[str]:
+        """
+        Args:
+            thing_type: "person"
+            k: number of labels to draw
+            rng: NumPy random generator, defaults to one seeded from rng
+
+        Returns:
+            k random labels, drawn like get_thing
+        """
+        return self.sample_entities(thing_type, k, rng)[0]
+
+    def sample_entities(self, thing_type: str, k: int, rng: np.random.Generator = None) -> (List[str], List[str]):
+        """
+        Args:
+            thing_type: "person"
+            k: number of entities to draw
+            rng: NumPy random generator, defaults to one seeded from rng
+
+        Returns:
+            the labels and Q-ids of k random entities, drawn like sample_things
+        """
+        rng = rng if rng is not None else self.numpy_rng()
+        return self.thing_tables[thing_type].sample_batch(rng, k)
+
+    def sample_predicates(
+        self, predicate_type: str, part_of_speech: str, k: int, rng: np.random.Generator = None
+    ) -> (List[str], List[str]):
+        """
+        Args:
+            predicate_type: "person->location"
+            part_of_speech: "NOUN"
+            k: number of predicates to draw
+            rng: NumPy random generator, defaults to one seeded from rng
+
+        Returns:
+            the labels and P-values of k random predicates drawn like get_predicate, None if there is no such predicate
+        """
+        table = self.predicate_index.get((predicate_type, part_of_speech.upper()))
+        if table is None:
+            return None
+        rng = rng if rng is not None else self.numpy_rng()
+        return table.sample_batch(rng, k, by_label=self.predicate_weighting == "label")
 
     def get_wh_word(self, thing_type: str) -> str:
         """
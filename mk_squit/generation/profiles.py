@@ -0,0 +1,98 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import json
+from typing import Dict, Optional
+
+from mk_squit.generation.template_generator import DEPTHS, GRAMMARS
+
+# Keys a profile may have in a config file, besides its name
+PROFILE_KEYS = ["out", "n", "grammars", "depths", "entity_domain", "template_mix"]
+
+
+class GenerationProfile(object):
+    """Declarative description of one split of a dataset:
+        GenerationProfile("test_hard", n=5000, grammars="hard", depths={"single_entity": 8}, entity_domain="chemical")
+
+    Profiles only describe what differs between splits. FullQueryGenerator.with_profile turns one into a generator
+    that shares everything already loaded, and FullQueryGenerator.generate_profiles builds several splits in one run.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        out: Optional[str] = None,
+        n: int = 5000,
+        grammars: str = "easy",
+        depths: Optional[Dict[str, int]] = None,
+        entity_domain: Optional[str] = None,
+        template_mix: Optional[Dict[str, float]] = None,
+    ):
+        """
+        Args:
+            name: "test_hard"
+            out: name of the output file without extension, the name by default
+            n: the n argument of FullQueryGenerator.generate_queries
+            grammars: name of the grammar set in template_generator.GRAMMARS
+            depths: {"single_entity": 8} to override the template_generator.DEPTHS of template types
+            entity_domain: "chemical" to fill every [THING] with entities of this domain, see TemplateFiller
+            template_mix: weight per template type, see FullQueryGenerator.generate_shard
+        """
+        if grammars not in GRAMMARS:
+            raise ValueError(f"Unknown grammar set {grammars} in profile {name}, expected one of {list(GRAMMARS)}.")
+        depths = dict(depths or {})
+        unknown = [key for key in depths if key not in DEPTHS]
+        if unknown:
+            raise ValueError(f"Unknown template types {unknown} in the depths of profile {name}.")
+        if any(not isinstance(depth, int) or depth <= 0 for depth in depths.values()):
+            raise ValueError(f"Depths must be positive integers, got {depths} in profile {name}.")
+        self.name = name
+        self.out = out if out is not None else name
+        self.n = n
+        self.grammars = grammars
+        self.depths = depths
+        self.entity_domain = entity_domain
+        self.template_mix = template_mix
+
+    @classmethod
+    def from_dict(cls, name: str, config: Dict) -> "GenerationProfile":
+        unknown = [key for key in config if key not in PROFILE_KEYS]
+        if unknown:
+            raise ValueError(f"Unknown keys {unknown} in profile {name}, expected some of {PROFILE_KEYS}.")
+        return cls(name, **config)
+
+    def to_dict(self) -> Dict:
+        return {key: getattr(self, key) for key in PROFILE_KEYS}
+
+    def __repr__(self):
+        return f"GenerationProfile({self.name!r}, {self.to_dict()})"
+
+
+# The splits of the v3 dataset
+PROFILES = {
+    "train": GenerationProfile("train", out="train_queries_v3", n=100000),
+    "test_easy": GenerationProfile("test_easy", out="test_easy_queries_v3", n=5000),
+    "test_hard": GenerationProfile(
+        "test_hard",
+        out="test_hard_queries_v3",
+        n=5000,
+        grammars="hard",
+        depths={"single_entity": 8, "multi_entity": 6, "count": 7},
+        entity_domain="chemical",
+    ),
+}
+
+
+def load_profiles(config_file: Optional[str] = None) -> Dict[str, GenerationProfile]:
+    """
+    Args:
+        config_file: JSON file of profiles by name, None for the built-in PROFILES
+            {"test_hard": {"out": "test_hard_queries_v3", "n": 5000, "grammars": "hard", "entity_domain": "chemical"}}
+
+    Returns:
+        the profiles by name, in the order of the file
+    """
+    if config_file is None:
+        return dict(PROFILES)
+    with open(config_file, "r") as f:
+        config = json.load(f)
+    return {name: GenerationProfile.from_dict(name, profile) for name, profile in config.items()}
@@ -0,0 +1,213 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import sys
+import itertools
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import typer
+
+from mk_squit.generation.full_query_generator import FullQueryGenerator
+
+
+def worker_info() -> Tuple[int, int]:
+    """
+    Returns:
+        (id, number) of the PyTorch DataLoader worker process this runs in, (0, 1) outside of DataLoader workers
+
+    torch is only consulted if it was already imported, which it always is in a DataLoader worker.
+    """
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return 0, 1
+    info = torch.utils.data.get_worker_info()
+    if info is None:
+        return 0, 1
+    return info.id, info.num_workers
+
+
+def distributed_info() -> Tuple[int, int]:
+    """
+    Returns:
+        (rank, world size) of the initialized torch.distributed process group, otherwise of the RANK and WORLD_SIZE
+        environment variables that launchers such as torchrun set, (0, 1) without either
+    """
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+class QueryDataset(object):
+    """Stream of freshly generated (english, sparql, hash) pairs for training without writing a dataset to disk:
+        for english, sparql, _ in QueryDataset(generator, seed=42):
+            ...
+
+    The stream is split into shards (see FullQueryGenerator.iter_queries) that are dealt out round-robin over every
+    DataLoader worker of every distributed rank, so each consumer generates its own disjoint shards with their own
+    RNG streams and no pair is generated twice. Consumers are detected when iteration starts, which is when
+    DataLoader workers iterate their copy of the dataset.
+
+    The core package never imports torch. TorchQueryDataset is the same class as a torch.utils.data.IterableDataset
+    for DataLoader, and importing it imports torch:
+        from mk_squit.generation.query_dataset import TorchQueryDataset
+        loader = DataLoader(TorchQueryDataset(generator, seed=42), batch_size=64, num_workers=4)
+    """
+
+    def __init__(
+        self,
+        generator: FullQueryGenerator,
+        seed: int,
+        template_mix: Optional[Dict[str, float]] = None,
+        shard_size: int = 100,
+        num_shards: Optional[int] = None,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+    ):
+        """
+        Args:
+            generator: FullQueryGenerator, copied into every DataLoader worker
+            seed: the master seed of the stream, e.g. derived from the epoch for a different stream per epoch
+            template_mix: weight per template type, see FullQueryGenerator.generate_shard
+            shard_size: the number of iterations per shard, the unit of work dealt out to consumers
+            num_shards: the number of shards per pass over the dataset, None for an endless stream
+            rank: the distributed rank, detected with distributed_info if None
+            world_size: the number of distributed ranks, detected with distributed_info if None
+        """
+        self.generator = generator
+        self.seed = seed
+        self.template_mix = template_mix
+        self.shard_size = shard_size
+        self.num_shards = num_shards
+        self.rank = rank
+        self.world_size = world_size
+
+    def consumer(self) -> Tuple[int, int]:
+        """
+        Returns:
+            (index, number) of the consumer iterating, rank-major over distributed ranks and DataLoader workers
+        """
+        rank, world_size = distributed_info()
+        if self.rank is not None:
+            rank = self.rank
+        if self.world_size is not None:
+            world_size = self.world_size
+        worker_id, num_workers = worker_info()
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def __iter__(self) -> Iterator[Tuple[str, str, str]]:
+        index, num_consumers = self.consumer()
+        return self.generator.iter_queries(
+            self.seed,
+            template_mix=self.template_mix,
+            shard_size=self.shard_size,
+            num_shards=self.num_shards,
+            shard_offset=index,
+            shard_step=num_consumers,
+        )
+
+
+class VirtualQueryDataset(object):
+    """Fixed-size dataset whose rows are generated when they are accessed and never stored:
+        dataset = VirtualQueryDataset(generator, seed=42, size=10 ** 9)
+        dataset[123456789] == generator.get_example(42, 123456789)
+
+    Views select and reorder rows by index without generating anything, so shuffles and splits need no I/O:
+        shuffled = dataset[:1000000].shuffle(seed=0)
+        train, test = shuffled[:990000], shuffled[990000:]
+
+    It is a map-style dataset (len and indexing), so PyTorch's DataLoader can shuffle and batch it directly.
+    """
+
+    def __init__(
+        self,
+        generator: FullQueryGenerator,
+        seed: int,
+        size: Optional[int] = None,
+        template_mix: Optional[Dict[str, float]] = None,
+        indices: Optional[Sequence[int]] = None,
+    ):
+        """
+        Args:
+            generator: FullQueryGenerator
+            seed: the seed of the virtual dataset, see FullQueryGenerator.get_example
+            size: the number of rows, ignored if indices are given
+            template_mix: weight per template type, see FullQueryGenerator.generate_shard
+            indices: the example indices of the rows, range(size) by default
+        """
+        if indices is None and size is None:
+            raise ValueError("Either size or indices must be given.")
+        self.generator = generator
+        self.seed = seed
+        self.template_mix = generator.check_template_mix(template_mix)
+        self.indices = indices if indices is not None else range(size)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[Tuple[str, str, str], "VirtualQueryDataset"]:
+        """Returns the row at a position, or a view of the rows of a slice."""
+        if isinstance(item, slice):
+            return self.subset(self.indices[item])
+        return self.generator.get_example(self.seed, int(self.indices[item]), template_mix=self.template_mix)
+
+    def __iter__(self) -> Iterator[Tuple[str, str, str]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def subset(self, indices: Sequence[int]) -> "VirtualQueryDataset":
+        """View of the rows with the given example indices."""
+        return VirtualQueryDataset(self.generator, self.seed, template_mix=self.template_mix, indices=indices)
+
+    def shuffle(self, seed: int) -> "VirtualQueryDataset":
+        """View of the rows in a random order, which holds a permutation of len(self) indices in memory."""
+        return self.subset(np.asarray(self.indices)[np.random.default_rng(seed).permutation(len(self))])
+
+
+def _torch_query_dataset() -> type:
+    from torch.utils.data import IterableDataset
+
+    class TorchQueryDataset(QueryDataset, IterableDataset):
+        __doc__ = QueryDataset.__doc__
+
+    TorchQueryDataset.__module__ = __name__
+    return TorchQueryDataset
+
+
+def __getattr__(name: str):
+    # Creates TorchQueryDataset (and imports torch) on first access, which is also how pickle finds it in spawned
+    # DataLoader workers
+    if name == "TorchQueryDataset":
+        cls = _torch_query_dataset()
+        globals()[name] = cls
+        return cls
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def example(
+    data_dir: str = "data",
+    prop_id: str = "*-props-preprocessed.json",
+    ent_id: str = "*-5k-preprocessed.json",
+    seed: int = 42,
+    world_size: int = 2,
+    n: int = 5,
+):
+    """QueryDataset example functionality, splitting one stream over distributed ranks.
+
+    python -m mk_squit.generation.query_dataset \
+        --data-dir data \
+        --prop-id *-props-preprocessed.json \
+        --ent-id *-5k-preprocessed.json
+    """
+    generator = FullQueryGenerator(data_dir=data_dir, property_file_identifier=prop_id, entity_file_identifier=ent_id)
+    mix = {"single_entity": 0.5, "multi_entity": 0.25, "count": 0.25}
+    for rank in range(world_size):
+        dataset = QueryDataset(generator, seed, template_mix=mix, shard_size=10, rank=rank, world_size=world_size)
+        print(f"Rank {rank}:")
+        for english, sparql, _ in itertools.islice(dataset, n):
+            print(f"    {english}\t{sparql}")
+
+
+if __name__ == "__main__":
+    typer.run(example)
@@ -0,0 +1,245 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import json
+import random
+import asyncio
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import typer
+
+from mk_squit.generation.full_query_generator import FullQueryGenerator, _init_worker, _run_shard
+from mk_squit.generation.query_writer import QueryWriter
+
+FORMATS = {"ndjson": "application/x-ndjson", "tsv": "text/tab-separated-values"}
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+class RequestError(Exception):
+    """A request that cannot be served, answered with its status and message."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_template_mix(text: str) -> Dict[str, float]:
+    """
+    Args:
+        text: "single_entity:2,count:1"
+
+    Returns:
+        {"single_entity": 2.0, "count": 1.0}
+    """
+    template_mix = dict()
+    for item in text.split(","):
+        key, _, weight = item.partition(":")
+        try:
+            template_mix[key.strip()] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f"Invalid weight in template mix {text}, expected e.g. single_entity:2,count:1.")
+    return template_mix
+
+
+def format_rows(rows: List[Tuple[str, str, str]], fmt: str) -> bytes:
+    if fmt == "ndjson":
+        lines = [json.dumps({"english": english, "sparql": sparql, "hash": h}) + "\n" for english, sparql, h in rows]
+    else:
+        lines = ["\t".join(row) + "\n" for row in rows]
+    return "".join(lines).encode("utf-8")
+
+
+class QueryServer(object):
+    """Streams generated (english, sparql, hash) pairs to any number of clients over HTTP on TCP or a Unix socket:
+        GET /queries?seed=42&n=100000&mix=single_entity:2,count:1&format=ndjson
+
+    The generator (and its predicate bank) is loaded once and copied into a pool of worker processes that generate
+    the shards of every request, so requests are served concurrently while the event loop only writes. Responses
+    are chunked, one chunk per shard. Each request has at most max_pending shards in flight, and the next shard is
+    only submitted once the client has read most of the previous chunk, so a slow client slows down its own generation
+    instead of buffering rows.
+
+    A request streams shards 0, 1, ... of FullQueryGenerator.iter_queries, so the same seed, mix and shard size
+    always give the same rows. Without n the stream is endless and ends when the client disconnects.
+
+    Parameters:
+        seed: master seed of the stream, random if missing
+        n: number of rows to stream
+        mix: template type weights, "single_entity:2,count:1", every type in turn if missing
+        format: "ndjson" (default) or "tsv" (with a header row)
+        shard_size: number of iterations per shard, the server's default if missing
+    """
+
+    def __init__(
+        self,
+        generator: FullQueryGenerator,
+        workers: int = 4,
+        shard_size: int = 100,
+        max_pending: int = 2,
+        max_shard_size: int = 10000,
+    ):
+        """
+        Args:
+            generator: FullQueryGenerator, copied into every worker process
+            workers: the number of generating processes shared by all requests
+            shard_size: the default number of iterations per shard
+            max_pending: the number of shards a request may have in flight
+            max_shard_size: the largest shard size a request may ask for
+        """
+        self.generator = generator
+        self.workers = workers
+        self.shard_size = shard_size
+        self.max_pending = max_pending
+        self.max_shard_size = max_shard_size
+        self.pool = None
+
+    def parse_request(self, target: str) -> Dict:
+        """Parses the parameters of a /queries request, raises RequestError for invalid ones."""
+        url = urlsplit(target)
+        if url.path != "/queries":
+            raise RequestError(404, f"Unknown path {url.path}, expected /queries.")
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            seed = int(params["seed"]) if "seed" in params else random.randrange(2 ** 32)
+            n = int(params["n"]) if "n" in params else None
+            shard_size = int(params.get("shard_size", self.shard_size))
+            template_mix = parse_template_mix(params["mix"]) if "mix" in params else None
+            template_mix = self.generator.check_template_mix(template_mix)
+        except ValueError as e:
+            raise RequestError(400, str(e))
+        fmt = params.get("format", "ndjson")
+        if fmt not in FORMATS:
+            raise RequestError(400, f"Unknown format {fmt}, expected one of {list(FORMATS)}.")
+        if not 0 < shard_size <= self.max_shard_size:
+            raise RequestError(400, f"shard_size must be between 1 and {self.max_shard_size}.")
+        if n is not None and n < 0:
+            raise RequestError(400, "n must not be negative.")
+        return {"seed": seed, "n": n, "shard_size": shard_size, "template_mix": template_mix, "fmt": fmt}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            # Headers are not needed, but must be read before responding
+            while (await reader.readline()).strip():
+                pass
+            if len(request_line) != 3:
+                raise RequestError(400, "Malformed request line.")
+            method, target, _ = request_line
+            if method != "GET":
+                raise RequestError(405, f"Method {method} is not allowed, expected GET.")
+            request = self.parse_request(target)
+            await self.stream(writer, **request)
+        except RequestError as e:
+            await self.respond(writer, e.status, "text/plain", str(e).encode("utf-8") + b"\n")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The client went away, its pending shards were cancelled or finish unobserved
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes) -> None:
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1")
+            + body
+        )
+        await writer.drain()
+
+    async def write_chunk(self, writer: asyncio.StreamWriter, data: bytes) -> None:
+        """Writes a chunk and waits while the transport's write buffer is above its high-water mark, i.e. until the
+        client has read most of what was sent, which is the flow control of the stream."""
+        if data:
+            writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+            await writer.drain()
+
+    async def stream(
+        self,
+        writer: asyncio.StreamWriter,
+        seed: int,
+        n: Optional[int],
+        shard_size: int,
+        template_mix: Optional[Dict[str, float]],
+        fmt: str,
+    ) -> None:
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: {FORMATS[fmt]}\r\nTransfer-Encoding: chunked\r\n"
+            f"X-Seed: {seed}\r\nConnection: close\r\n\r\n".encode("latin-1")
+        )
+        if fmt == "tsv":
+            await self.write_chunk(writer, QueryWriter.header.encode("utf-8"))
+
+        loop = asyncio.get_running_loop()
+        shard_index = 0
+        rows_sent = 0
+        pending = collections.deque()
+        try:
+            while n is None or rows_sent < n:
+                while len(pending) < self.max_pending:
+                    shard = (seed, shard_index, shard_size, template_mix)
+                    pending.append(loop.run_in_executor(self.pool, _run_shard, shard))
+                    shard_index += 1
+                rows = self.generator._collect(await pending.popleft())
+                if n is not None:
+                    rows = rows[: n - rows_sent]
+                rows_sent += len(rows)
+                await self.write_chunk(writer, format_rows(rows, fmt))
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765, unix_socket: Optional[str] = None) -> None:
+        """Serves until cancelled, on the Unix socket if one is given and otherwise on host:port."""
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.generator,)) as pool:
+            self.pool = pool
+            if unix_socket is not None:
+                server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+                print(f"Serving on {unix_socket}")
+            else:
+                server = await asyncio.start_server(self.handle, host=host, port=port)
+                print(f"Serving on http://{host}:{port}/queries")
+            async with server:
+                await server.serve_forever()
+
+
+def serve(
+    data_dir: str = "data",
+    prop_id: str = "*-props-preprocessed.json",
+    ent_id: str = "*-5k-preprocessed.json",
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    unix_socket: Optional[str] = None,
+    workers: int = 4,
+    shard_size: int = 100,
+    max_pending: int = 2,
+    snapshot: bool = True,
+    prune: bool = True,
+):
+    """Serve generated queries to local training and evaluation jobs.
+
+    python -m mk_squit.generation.query_server \
+        --data-dir data \
+        --workers 8 \
+        --unix-socket /tmp/mk_squit.sock
+
+    curl -N --unix-socket /tmp/mk_squit.sock "http://localhost/queries?seed=42&n=1000&mix=single_entity:2,count:1"
+    """
+    generator = FullQueryGenerator(
+        data_dir=data_dir,
+        property_file_identifier=prop_id,
+        entity_file_identifier=ent_id,
+        use_snapshot=snapshot,
+        prune=prune,
+    )
+    server = QueryServer(generator, workers=workers, shard_size=shard_size, max_pending=max_pending)
+    try:
+        asyncio.run(server.serve(host=host, port=port, unix_socket=unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    typer.run(serve)
@@ -0,0 +1,140 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import json
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+def tsv_header(columns: List[str]) -> str:
+    """The header line of TSV outputs with these columns, in which the hash column is called "unique hash"."""
+    return "\t".join("unique hash" if column == "hash" else column for column in columns) + "\n"
+
+
+class QueryWriter(object):
+    """Streams generated (english, sparql, hash) rows to a TSV file:
+        - Buffers rows and flushes them in chunks of chunk_size so memory stays flat for any number of rows
+        - Writes a checkpoint file next to the output which allows an interrupted run to be resumed, at most once
+          per chunk so that a run does not wait for the disk after every few rows
+    """
+
+    header = tsv_header(["english", "sparql", "hash"])
+
+    def __init__(self, out_file: str, chunk_size: int = 10000, columns: Optional[List[str]] = None):
+        """
+        Args:
+            out_file: "./out/train_queries_v3.tsv"
+            chunk_size: the number of rows buffered before they are written, and written between checkpoints
+            columns: the columns of the rows for the header, english, sparql and hash by default
+        """
+        if columns is not None:
+            self.header = tsv_header(columns)
+        self.out_file = out_file
+        self.checkpoint_file = out_file + ".checkpoint"
+        self.chunk_size = chunk_size
+
+        self.rows_written = 0
+        self.bytes_written = 0
+        # Set by open when resuming an output that a previous run completed, which is then left as it is
+        self.complete = False
+        self._buffer = []
+        self._f = None
+        # rows_written at the last checkpoint
+        self._checkpoint_rows = None
+
+    def open(self, resume: bool = False) -> Optional[Dict]:
+        """
+        Args:
+            resume: continue from the checkpoint of a previous run if one exists
+
+        Returns:
+            the state saved with the last checkpoint when resuming, otherwise None
+
+        When resuming, anything written after the last checkpoint is truncated so the file ends exactly where the
+        checkpointed state left it. A new output gets a checkpoint right away, so an output without one was
+        completed by close: resuming it sets complete and neither opens nor changes the file.
+        """
+        state = None
+        if resume and os.path.exists(self.out_file) and not os.path.exists(self.checkpoint_file):
+            self.complete = True
+            with open(self.out_file, "r", encoding="utf-8", newline="\n") as f:
+                self.rows_written = sum(1 for _ in f) - 1
+        elif resume and os.path.exists(self.checkpoint_file) and os.path.exists(self.out_file):
+            with open(self.checkpoint_file, "r") as f:
+                checkpoint = json.load(f)
+            self.rows_written = self._checkpoint_rows = checkpoint["rows_written"]
+            self.bytes_written = checkpoint["bytes_written"]
+            state = checkpoint["state"]
+
+            self._f = open(self.out_file, "r+b")
+            self._f.truncate(self.bytes_written)
+            self._f.seek(self.bytes_written)
+        else:
+            self._f = open(self.out_file, "wb")
+            self._f.write(self.header.encode("utf-8"))
+            self.bytes_written = self._f.tell()
+            self.checkpoint(None)
+        return state
+
+    def write(self, rows: Iterable[Tuple[str, str, str]]) -> None:
+        for row in rows:
+            # Rows are newline separated without a trailing newline
+            self._buffer.append(("\n" if self.rows_written else "") + "\t".join(row))
+            self.rows_written += 1
+            if len(self._buffer) >= self.chunk_size:
+                self.flush()
+
+    def read_rows(self) -> Iterator[Tuple[str, ...]]:
+        """Reads back the rows written so far, e.g. to rebuild state when resuming."""
+        if not self.complete:
+            self.flush()
+        with open(self.out_file, "r", encoding="utf-8", newline="\n") as f:
+            next(f)  # header
+            for line in f:
+                yield tuple(line.rstrip("\n").split("\t"))
+
+    def flush(self) -> None:
+        if self._buffer:
+            chunk = "".join(self._buffer).encode("utf-8")
+            self._f.write(chunk)
+            self.bytes_written += len(chunk)
+            self._buffer = []
+        self._f.flush()
+
+    def checkpoint(self, state: Dict) -> None:
+        """
+        Args:
+            state: everything needed to continue generation after the rows written so far, must be JSON serializable
+
+        Once chunk_size rows were written since the last checkpoint, flushes the output to disk and atomically
+        replaces the checkpoint file. Otherwise nothing is done, and a resumed run regenerates the rows written since.
+        """
+        if self._checkpoint_rows is not None and self.rows_written - self._checkpoint_rows < self.chunk_size:
+            return
+        self._checkpoint_rows = self.rows_written
+        self.flush()
+        os.fsync(self._f.fileno())
+        checkpoint = {"rows_written": self.rows_written, "bytes_written": self.bytes_written, "state": state}
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def close(self) -> None:
+        """Flushes the remaining rows and removes the checkpoint, the output is complete."""
+        if self.complete:
+            return
+        self.flush()
+        self._f.close()
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif not self.complete:
+            # Keep the checkpoint so the run can be resumed
+            self.flush()
+            self._f.close()
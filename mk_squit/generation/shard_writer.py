@@ -0,0 +1,392 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import io
+import os
+import re
+import json
+import gzip
+import itertools
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from mk_squit.generation.query_writer import tsv_header
+from mk_squit.generation.snapshot import file_digest
+
+MANIFEST_VERSION = 1
+
+# Rows are (english, sparql, hash) or, with metadata, (english, sparql, hash, template type, chain lengths, domain)
+COLUMNS = ["english", "sparql", "hash", "template_type", "chain_lengths", "domain"]
+BASE_COLUMNS = COLUMNS[:3]
+METADATA_COLUMNS = COLUMNS[3:]
+# The query with Q-ids that follows the hash with the "both" entity format of TemplateFiller
+QID_COLUMN = "sparql_qid"
+
+TEXT_FORMATS = ["tsv", "jsonl"]
+COMPRESSIONS = {"gz": "gzip", "zst": "zstd"}
+TABLE_FORMATS = ["parquet", "arrow"]
+FORMATS = [f"{f}.{c}" if c else f for f in TEXT_FORMATS for c in [None, *COMPRESSIONS]] + TABLE_FORMATS
+# Rows per Parquet row group and per Arrow record batch
+TABLE_BATCH_ROWS = 131072
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow output requires pyarrow, install it with pip install pyarrow.")
+    return pyarrow
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed output requires zstandard, install it with pip install zstandard.")
+    return zstandard
+
+
+def _arrow_schema(columns: List[str]):
+    pa = _import_pyarrow()
+    types = {"chain_lengths": pa.list_(pa.int32())}
+    return pa.schema([(column, types.get(column, pa.string())) for column in columns])
+
+
+class _GzipWriter(gzip.GzipFile):
+    """GzipFile that leaves the mtime and file name out of the header, so the same rows always give the same bytes
+    (and SHA-1), and closes the file it writes to."""
+
+    def __init__(self, path: str):
+        self._raw = open(path, "wb")
+        super().__init__(filename="", fileobj=self._raw, mode="wb", compresslevel=6, mtime=0)
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+
+def _open_binary(path: str, compression: Optional[str], mode: str):
+    if compression == "gz":
+        return _GzipWriter(path) if mode == "wb" else gzip.open(path, mode)
+    if compression == "zst":
+        zstandard = _import_zstandard()
+        if mode == "wb":
+            return zstandard.ZstdCompressor(level=3).stream_writer(open(path, "wb"))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, mode)
+
+
+class ShardFile(object):
+    """One output shard in one of FORMATS, written in batches of rows.
+
+    Parquet and Arrow rows are buffered and written batch_rows at a time, so row groups (and record batches) do not
+    depend on how many rows each call to write passes.
+    """
+
+    def __init__(self, path: str, fmt: str, columns: List[str], batch_rows: int = TABLE_BATCH_ROWS):
+        self.path = path
+        self.fmt, _, self.compression = fmt.partition(".")
+        self.columns = columns
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._buffer: List[Tuple] = []
+        if self.fmt == "parquet":
+            self._writer = _import_pyarrow().parquet.ParquetWriter(path, _arrow_schema(columns), compression="zstd")
+        elif self.fmt == "arrow":
+            self._sink = _import_pyarrow().OSFile(path, "wb")
+            self._writer = _import_pyarrow().ipc.new_file(self._sink, _arrow_schema(columns))
+        else:
+            self._f = _open_binary(path, self.compression, "wb")
+            if self.fmt == "tsv":
+                self._f.write(tsv_header(columns).encode("utf-8"))
+
+    def write(self, rows: Sequence[Tuple]) -> None:
+        if not rows:
+            return
+        self.rows += len(rows)
+        if self.fmt in TABLE_FORMATS:
+            self._buffer.extend(rows)
+            while len(self._buffer) >= self.batch_rows:
+                self._write_batch(self._buffer[: self.batch_rows])
+                del self._buffer[: self.batch_rows]
+        elif self.fmt == "tsv":
+            self._f.write("".join("\t".join(row) + "\n" for row in rows).encode("utf-8"))
+        else:
+            lines = [json.dumps(dict(zip(self.columns, row))) + "\n" for row in rows]
+            self._f.write("".join(lines).encode("utf-8"))
+
+    def _write_batch(self, rows: List[Tuple]) -> None:
+        pa = _import_pyarrow()
+        data = [[row[i] for row in rows] for i in range(len(self.columns))]
+        batch = pa.record_batch(data, schema=_arrow_schema(self.columns))
+        if self.fmt == "parquet":
+            self._writer.write_table(pa.Table.from_batches([batch]), row_group_size=len(rows))
+        else:
+            self._writer.write_batch(batch)
+
+    def close(self) -> None:
+        if self._buffer:
+            self._write_batch(self._buffer)
+            self._buffer = []
+        if self.fmt == "parquet":
+            self._writer.close()
+        elif self.fmt == "arrow":
+            self._writer.close()
+            self._sink.close()
+        else:
+            self._f.close()
+
+
+def read_shard(path: str, fmt: str, columns: Optional[List[str]] = None) -> Iterator[Tuple]:
+    """
+    Args:
+        path: a shard file listed in a manifest
+        fmt: the format of the manifest, e.g. "parquet"
+        columns: the columns to read, all columns of the shard by default (Parquet and Arrow only read these)
+
+    Returns:
+        the shard's rows as tuples of the columns
+    """
+    base_fmt, _, compression = fmt.partition(".")
+    if base_fmt in TABLE_FORMATS:
+        pa = _import_pyarrow()
+        if base_fmt == "parquet":
+            table = pa.parquet.read_table(path, columns=columns)
+        else:
+            with pa.memory_map(path, "r") as source:
+                table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select(columns)
+        for batch in table.to_batches():
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+        return
+
+    with io.TextIOWrapper(_open_binary(path, compression, "rb"), encoding="utf-8", newline="\n") as f:
+        if base_fmt == "tsv":
+            header = _tsv_columns(next(f))
+            rows = (line.rstrip("\n").split("\t") for line in f)
+        else:
+            header = None
+            rows = (json.loads(line) for line in f)
+        for row in rows:
+            if header is None:
+                header = list(row)
+            if isinstance(row, dict):
+                row = [row[column] for column in header]
+            if columns is None:
+                yield tuple(row)
+            else:
+                yield tuple(row[header.index(column)] for column in columns)
+
+
+def _tsv_columns(header: str) -> List[str]:
+    return ["hash" if name == "unique hash" else name for name in header.rstrip("\n").split("\t")]
+
+
+def read_columns(path: str, fmt: str) -> List[str]:
+    """The columns of a shard file (or of a QueryWriter output with fmt "tsv"), read from its header or schema."""
+    base_fmt, _, compression = fmt.partition(".")
+    if base_fmt == "parquet":
+        return _import_pyarrow().parquet.read_schema(path).names
+    if base_fmt == "arrow":
+        pa = _import_pyarrow()
+        with pa.memory_map(path, "r") as source:
+            return pa.ipc.open_file(source).schema.names
+    with io.TextIOWrapper(_open_binary(path, compression, "rb"), encoding="utf-8", newline="\n") as f:
+        line = f.readline()
+    if base_fmt == "tsv":
+        return _tsv_columns(line)
+    return list(json.loads(line)) if line else BASE_COLUMNS
+
+
+def load_manifest(manifest_file: str) -> Dict:
+    """Reads a manifest written by ShardedQueryWriter, raises a ValueError if the output is incomplete."""
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if not manifest.get("complete"):
+        raise ValueError(f"{manifest_file} belongs to an incomplete run, resume it to complete the output.")
+    return manifest
+
+
+class ShardedQueryWriter(object):
+    """Streams generated rows to size-bounded shards of one of FORMATS with a manifest:
+        prefix-00000.parquet, prefix-00001.parquet, ..., prefix.manifest.json
+
+    The manifest lists every shard with its row count, size and SHA-1, so readers can verify shards and load them in
+    parallel (see read_shard and load_manifest). Parquet and Arrow shards have the COLUMNS columns, JSONL rows have
+    the columns as keys (both need rows with metadata, see FullQueryGenerator.generate_shard), and TSV shards have
+    the three columns of QueryWriter, unless other columns are given.
+
+    Has the interface of QueryWriter, including resuming: rows are split so that every shard but the last holds
+    exactly shard_rows rows, and the manifest is only updated when a shard is closed. A shard can be closed between
+    two checkpoints, so the manifest records the last checkpointed state and the number of rows written after it.
+    A resumed run deletes the shard that was still open, continues from that state, and skips the rows written
+    after it that are already in closed shards when they are written again, as a deterministic run does.
+    """
+
+    def __init__(
+        self, prefix: str, fmt: str = "parquet", shard_rows: int = 1000000, columns: Optional[List[str]] = None
+    ):
+        """
+        Args:
+            prefix: path of the output without extension, e.g. "./out/train_queries_v3"
+            fmt: one of FORMATS
+            shard_rows: the number of rows per shard
+            columns: the columns of the rows, COLUMNS (BASE_COLUMNS for TSV) by default
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown output format {fmt}, expected one of {FORMATS}.")
+        if shard_rows <= 0:
+            raise ValueError("shard_rows must be positive.")
+        self.prefix = prefix
+        self.fmt = fmt
+        self.shard_rows = shard_rows
+        self.manifest_file = prefix + ".manifest.json"
+        # TSV shards only keep the base columns, so there is no need to generate metadata for them
+        if columns is None:
+            columns = BASE_COLUMNS if fmt.startswith("tsv") else COLUMNS
+        elif fmt.startswith("tsv") and any(column in METADATA_COLUMNS for column in columns):
+            raise ValueError(f"TSV shards cannot hold the metadata columns {METADATA_COLUMNS}.")
+        self.columns = columns
+        self.metadata = "template_type" in columns
+
+        self.rows_written = 0
+        # Set by open when resuming an output that a previous run completed, which is then left as it is
+        self.complete = False
+        self.shards: List[Dict] = []
+        self._shard: Optional[ShardFile] = None
+        # The last checkpointed state, rows_written at that checkpoint, and rows to skip after resuming from it
+        self._state: Optional[Dict] = None
+        self._state_rows = 0
+        self._skip_rows = 0
+
+    def shard_path(self, index: int) -> str:
+        return f"{self.prefix}-{index:05d}.{self.fmt}"
+
+    def _shard_files(self) -> List[str]:
+        directory = os.path.dirname(self.prefix) or "."
+        pattern = re.compile(re.escape(os.path.basename(self.prefix)) + r"-\d{5}\." + re.escape(self.fmt) + "$")
+        return [os.path.join(directory, name) for name in os.listdir(directory) if pattern.match(name)]
+
+    def open(self, resume: bool = False) -> Optional[Dict]:
+        """
+        Args:
+            resume: continue from the manifest of an incomplete previous run if one exists
+
+        Returns:
+            the last state checkpointed before the last closed shard when resuming, otherwise None
+
+        Shard files of this prefix and format that are not part of the resumed manifest are deleted. Resuming an
+        output whose manifest is complete sets complete and leaves the output as it is.
+        """
+        os.makedirs(os.path.dirname(self.prefix) or ".", exist_ok=True)
+        state = None
+        if resume and os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+            if manifest["format"] == self.fmt:
+                self.complete = manifest["complete"]
+                self.shards = manifest["shards"]
+                state = self._state = manifest.get("state")
+                self.rows_written = self._state_rows = manifest.get("state_rows", manifest["rows"])
+                self._skip_rows = manifest["rows"] - self.rows_written
+
+        kept = {os.path.join(os.path.dirname(self.prefix), shard["file"]) for shard in self.shards}
+        for path in self._shard_files():
+            if path not in kept:
+                os.remove(path)
+        return state
+
+    def write(self, rows: Iterable[Tuple]) -> None:
+        rows = list(rows)
+        if self._skip_rows:
+            # Rows of a resumed run that the closed shards already hold
+            skipped = min(self._skip_rows, len(rows))
+            rows = rows[skipped:]
+            self._skip_rows -= skipped
+            self.rows_written += skipped
+        start = 0
+        while start < len(rows):
+            if self._shard is not None and self._shard.rows >= self.shard_rows:
+                self._close_shard()
+                self._write_manifest(complete=False)
+            if self._shard is None:
+                self._shard = ShardFile(self.shard_path(len(self.shards)), self.fmt, self.columns)
+            end = start + self.shard_rows - self._shard.rows
+            self._shard.write(rows[start:end])
+            self.rows_written += len(rows[start:end])
+            start = end
+
+    def read_rows(self) -> Iterator[Tuple[str, ...]]:
+        """Reads back the (english, sparql, hash) rows written before the checkpointed state of the closed shards,
+        e.g. to rebuild state when resuming."""
+        remaining = self._state_rows
+        for shard in self.shards:
+            if remaining <= 0:
+                return
+            path = os.path.join(os.path.dirname(self.prefix), shard["file"])
+            yield from itertools.islice(read_shard(path, self.fmt, columns=BASE_COLUMNS), remaining)
+            remaining -= shard["rows"]
+
+    def _close_shard(self) -> None:
+        self._shard.close()
+        path = self._shard.path
+        self.shards.append(
+            {
+                "file": os.path.basename(path),
+                "rows": self._shard.rows,
+                "bytes": os.path.getsize(path),
+                "sha1": file_digest(path),
+            }
+        )
+        self._shard = None
+
+    def _write_manifest(self, complete: bool) -> None:
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "format": self.fmt,
+            "columns": self.columns,
+            "rows": sum(shard["rows"] for shard in self.shards),
+            "complete": complete,
+            "shards": self.shards,
+        }
+        if not complete:
+            manifest["state"] = self._state
+            manifest["state_rows"] = self._state_rows
+        with open(self.manifest_file + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+
+    def checkpoint(self, state: Dict) -> None:
+        """
+        Args:
+            state: everything needed to continue generation after the rows written so far, must be JSON serializable
+
+        Closes the open shard if it is full and records it in the manifest together with the state. The state is
+        also recorded when a later write closes a shard.
+        """
+        self._state = state
+        self._state_rows = self.rows_written
+        if self._shard is not None and self._shard.rows >= self.shard_rows:
+            self._close_shard()
+            self._write_manifest(complete=False)
+
+    def close(self) -> None:
+        """Closes the last shard and completes the manifest."""
+        if self.complete:
+            return
+        if self._shard is not None:
+            self._close_shard()
+        self._write_manifest(complete=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self._shard is not None:
+            # The open shard is not in the manifest and will be regenerated when resuming
+            self._shard.close()
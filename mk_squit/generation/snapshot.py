@@ -0,0 +1,205 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import json
+import hashlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from mk_squit.generation.label_table import LabelTable, StringTable
+
+SNAPSHOT_VERSION = 1
+
+ALIGNMENT = 8
+
+
+def file_digest(path: str) -> str:
+    """SHA-1 of a file's content."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_arrays(path: str, metadata: Dict, arrays: Dict[str, np.ndarray], **header) -> None:
+    """
+    Args:
+        path: snapshot path without extension, writes path.json (header) and a path.<token>.bin file (arrays)
+        metadata: JSON serializable data stored in the header
+        arrays: named one-dimensional arrays
+        header: additional JSON serializable header fields
+
+    Every array is stored aligned in one binary file that is only ever written once: each snapshot gets a new
+    file, so readers that mapped the previous one are unaffected. The header is replaced atomically.
+    """
+    data_file = f"{os.path.basename(path)}.{os.urandom(8).hex()}.bin"
+    array_layout = dict()
+    with open(os.path.join(os.path.dirname(path), data_file), "wb") as f:
+        for name, array in arrays.items():
+            f.write(b"\0" * (-f.tell() % ALIGNMENT))
+            array_layout[name] = [array.dtype.str, f.tell(), len(array)]
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    previous = _read_header(path)
+    header = {
+        **header,
+        "version": SNAPSHOT_VERSION,
+        "metadata": metadata,
+        "data_file": data_file,
+        "arrays": array_layout,
+    }
+    with open(path + ".json.tmp", "w") as f:
+        json.dump(header, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+    if previous is not None and previous.get("data_file"):
+        previous_file = os.path.join(os.path.dirname(path), previous["data_file"])
+        if os.path.exists(previous_file):
+            os.remove(previous_file)
+
+
+def _read_header(path: str) -> Optional[Dict]:
+    if not os.path.exists(path + ".json"):
+        return None
+    with open(path + ".json", "r") as f:
+        return json.load(f)
+
+
+def _map_arrays(path: str) -> Optional[Tuple[Dict, Dict[str, np.ndarray]]]:
+    header = _read_header(path)
+    if header is None or header.get("version") != SNAPSHOT_VERSION:
+        return None
+    data_file = os.path.join(os.path.dirname(path), header["data_file"])
+    if not os.path.exists(data_file):
+        return None
+
+    arrays = dict()
+    for name, (dtype, offset, length) in header["arrays"].items():
+        if length == 0:
+            arrays[name] = np.zeros(0, dtype=dtype)
+        else:
+            # A plain ndarray view of the mapping indexes several times faster than the np.memmap subclass
+            mapped = np.memmap(data_file, dtype=dtype, mode="r", offset=offset, shape=(length,))
+            arrays[name] = mapped.view(np.ndarray)
+    return header, arrays
+
+
+def load_arrays(path: str) -> Optional[Tuple[Dict, Dict[str, np.ndarray]]]:
+    """
+    Returns:
+        the metadata and the arrays of a snapshot written by save_arrays, None if there is no (compatible) snapshot
+        at path
+
+    Arrays are memory-mapped read-only, so processes loading the same snapshot share one copy in the page cache.
+    They are returned as plain ndarrays (views of the mappings), so sampling from them costs the same as from
+    arrays parsed from the JSON files.
+    """
+    mapped = _map_arrays(path)
+    if mapped is None:
+        return None
+    return mapped[0]["metadata"], mapped[1]
+
+
+def save_snapshot(path: str, metadata: Dict, tables: Dict[str, LabelTable]) -> None:
+    """
+    Args:
+        path: snapshot path without extension, see save_arrays
+        metadata: JSON serializable data stored in the header
+        tables: named LabelTables
+
+    All keys and labels go into one string blob. The header only stores the names of the tables, the ranges of
+    each table's keys, labels, item offsets and owners within the shared arrays are stored in the table_layout array.
+    """
+    strings, item_offsets, owners = [], [], []
+    num_offsets, num_owners = 0, 0
+    layout = []
+    for table in tables.values():
+        keys_start = len(strings)
+        strings.extend(table.keys)
+        labels_start = len(strings)
+        strings.extend(table.labels)
+        layout.append(
+            [
+                keys_start,
+                labels_start,
+                labels_start,
+                len(strings),
+                num_offsets,
+                num_offsets + len(table.offsets),
+                num_owners,
+                num_owners + len(table.owners),
+            ]
+        )
+        num_offsets += len(table.offsets)
+        num_owners += len(table.owners)
+        item_offsets.append(np.asarray(table.offsets, dtype=np.int64))
+        owners.append(np.asarray(table.owners, dtype=np.int64))
+
+    string_table = StringTable.from_strings(strings)
+    arrays = {
+        "blob": string_table.blob,
+        "string_offsets": string_table.offsets,
+        "item_offsets": np.concatenate(item_offsets) if item_offsets else np.zeros(0, dtype=np.int64),
+        "owners": np.concatenate(owners) if owners else np.zeros(0, dtype=np.int64),
+        "table_layout": np.array(layout, dtype=np.int64).reshape(-1),
+    }
+    save_arrays(path, metadata, arrays, tables=list(tables))
+
+
+def load_snapshot(path: str) -> Optional[Tuple[Dict, Dict[str, LabelTable]]]:
+    """
+    Returns:
+        the metadata and the LabelTables of a snapshot written by save_snapshot, None if there is no (compatible)
+        snapshot at path
+    """
+    mapped = _map_arrays(path)
+    if mapped is None or not isinstance(mapped[0].get("tables"), list):
+        return None
+    header, arrays = mapped
+
+    tables = dict()
+    layout = arrays["table_layout"].reshape(-1, 8).tolist()
+    for name, (keys_start, keys_end, labels_start, labels_end, *offsets, owners_start, owners_end) in zip(
+        header["tables"], layout
+    ):
+        tables[name] = LabelTable(
+            StringTable(arrays["blob"], arrays["string_offsets"][keys_start : keys_end + 1]),
+            StringTable(arrays["blob"], arrays["string_offsets"][labels_start : labels_end + 1]),
+            arrays["item_offsets"][slice(*offsets)],
+            arrays["owners"][owners_start:owners_end],
+        )
+    return header["metadata"], tables
+
+
+def cached_snapshot(
+    path: str,
+    sources: List[str],
+    build: Callable[[], Tuple[Dict, Any]],
+    save: Callable[[str, Dict, Any], None] = save_snapshot,
+    load: Callable[[str], Optional[Tuple[Dict, Any]]] = load_snapshot,
+) -> Tuple[Dict, Any]:
+    """
+    Args:
+        path: snapshot path without extension
+        sources: the files the snapshot is built from
+        build: builds (metadata, tables) from the sources
+        save: writes (metadata, tables), save_arrays for snapshots of plain arrays
+        load: reads (metadata, tables), load_arrays for snapshots of plain arrays
+
+    Returns:
+        the snapshot at path if it was built from sources with the same content, otherwise builds, saves and
+        returns a new one
+    """
+    digests = {os.path.abspath(source): file_digest(source) for source in sources}
+    snapshot = load(path)
+    if snapshot is not None and snapshot[0].get("sources") == digests:
+        return snapshot
+
+    metadata, tables = build()
+    metadata = {**metadata, "sources": digests}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    save(path, metadata, tables)
+    # Another process may have replaced the snapshot in the meantime, the built tables are just as good
+    return load(path) or (metadata, tables)
@@ -1,19 +1,44 @@
 # Copyright (c) 2020 MeetKai Inc. All rights reserved.
 
-import re
 import hashlib
-from typing import List
+from typing import List, Optional, Tuple
 
 import typer
+import numpy as np
 
 from mk_squit.generation.predicate_bank import PredicateBank
+from mk_squit.generation.template_plan import SUFFIXES, compile_template
+
+SPARQL_TEMPLATES = {
+    "single_entity": "SELECT ?end WHERE { [CLAUSES] }",
+    "multi_entity": "ASK { [CLAUSES] }",
+    "count": "SELECT ( COUNT ( DISTINCT ?end ) as ?endcount ) WHERE { [CLAUSES] }",
+}
+
+# How entities are written in the SPARQL queries: "[ Barack Obama ]", "wd:Q76", or labels in the sparql column and
+# Q-ids in an additional sparql_qid column
+ENTITY_FORMATS = ["label", "qid", "both"]
 
 
 class TemplateFiller(object):
     """Fills templates with entities and predicates from a PredicateBank."""
 
-    def __init__(self, predicate_bank: PredicateBank):
+    def __init__(
+        self, predicate_bank: PredicateBank, entity_domain: Optional[str] = None, entity_format: str = "label"
+    ):
+        """
+        Args:
+            predicate_bank: PredicateBank
+            entity_domain: "chemical" to fill every [THING] with an entity of this domain instead of the template's
+                start type, e.g. for out-of-domain test sets. The predicates still follow the template's types
+            entity_format: one of ENTITY_FORMATS, "qid" writes the sampled entities' Q-ids into the SPARQL queries so
+                that they need not be resolved from the labels, "both" appends the query with Q-ids to every row
+        """
+        if entity_format not in ENTITY_FORMATS:
+            raise ValueError(f"Unknown entity format {entity_format}, expected one of {ENTITY_FORMATS}.")
         self.predicate_bank = predicate_bank
+        self.entity_domain = entity_domain
+        self.entity_format = entity_format
 
     def construct_query_pair(
         self, typed_template: str, pred_chain_lengths: List[int], sparql_template: str = "clauses: [CLAUSES]"
@@ -26,75 +51,140 @@ class TemplateFiller(object):
             sparql_template: "SELECT (COUNT(DISTINCT ?end) as ?endcount) WHERE {[CLAUSES]}"
 
         Returns:
-            An English question and its corresponding SPARQL query, also the hash of the SPARQL query
+            An English question and its corresponding SPARQL query, also the hash of the SPARQL query, and the query
+            with Q-ids if the entity format is "both"
 
         Generates an English - SPARQL query pair
         """
 
-        suffixes = ["A", "B"]
-        statements = []
-
-        thing_pattern = r"\[\w+:"  # Matches [television_series:
-        pred_pattern = r"\[\w+->\w+:\w+-?\w+:"  # Matches [person->weight:NOUN:
+        plan = compile_template(typed_template)
+        tokens = list(plan.tokens)
+        chains = []
 
         for i in range(len(pred_chain_lengths)):
-            thing_match = re.search(f"{thing_pattern}{suffixes[i]}]", typed_template)
-            thing = self.predicate_bank.get_thing(thing_match.group().split(":")[0][1:])
-            # thing = self.predicate_bank.get_thing("chemical")     # TEST_HARD
-            typed_template = typed_template.replace(thing_match.group(), thing)
-            statement = f"[ {thing} ]"
-
-            # If there are no predicates for this chain i.e. "Who is Barack Obama?:
-            if pred_chain_lengths[i] == 0:
-                statement = f"BIND ( [ {thing} ] as ?end ) ."
-                statements.append(statement)
-                continue
+            thing_index, thing_type = plan.thing_slots[SUFFIXES[i]]
+            thing, qid = self.predicate_bank.get_entity(self.entity_domain or thing_type)
+            tokens[thing_index] = thing
 
+            prop_wdts = []
             for j in range(pred_chain_lengths[i]):
-                # Replace predicates in numbered order
-                pred_match = re.search(f"{pred_pattern}{suffixes[i]}:{j}]", typed_template)
-                pred_info = pred_match.group().split(":")
-                pred = self.predicate_bank.get_predicate(pred_info[0][1:], pred_info[1])
+                # Fill predicates in numbered order
+                pred_index, pred_type, pos = plan.pred_slots[SUFFIXES[i]][j]
+                pred = self.predicate_bank.get_predicate(pred_type, pos)
                 if pred is None:
                     return None
 
                 prop_label, prop_wdt = pred
-                typed_template = typed_template.replace(pred_match.group(), prop_label)
-
-                # This is the first predicate
-                if j == 0:
-                    statement = statement + f" wdt:{prop_wdt}"
-                else:
-                    statement = statement + f" / wdt:{prop_wdt}"
-            statement = statement + " ?end ."
-            statements.append(statement)
+                tokens[pred_index] = prop_label
+                prop_wdts.append(prop_wdt)
+            chains.append((thing, qid, prop_wdts))
 
+        typed_template = "".join(tokens)
         typed_template = typed_template.replace(" 's", "'s")
         typed_template = typed_template.replace(" ?", "?")
 
+        return (typed_template, *self.construct_queries(sparql_template, chains))
+
+    def construct_queries(self, sparql_template: str, chains: List[Tuple[str, str, List[str]]]) -> Tuple[str, ...]:
+        """
+        Args:
+            sparql_template: "SELECT ?end WHERE { [CLAUSES] }"
+            chains: the entity label, Q-id and P-values of every predicate chain, [("Barack Obama", "Q76", ["P26"])]
+
+        Returns:
+            the SPARQL query in the entity format and its hash, followed by the query with Q-ids for "both"
+            ("SELECT ?end WHERE { [ Barack Obama ] wdt:P26 ?end . }", "5b1a...", "SELECT ?end WHERE { wd:Q76 ...")
+        """
         # Insert the statements into the given SPARQL template
+        use_qids = self.entity_format == "qid"
+        statements = [self.construct_statement(thing, wdts, qid if use_qids else None) for thing, qid, wdts in chains]
         query = sparql_template.replace("[CLAUSES]", " ".join(statements))
+        unique_hex_dig = hashlib.sha1(query.encode("utf-8")).hexdigest()
+        if self.entity_format != "both":
+            return query, unique_hex_dig
+
+        statements = [self.construct_statement(thing, wdts, qid) for thing, qid, wdts in chains]
+        return query, unique_hex_dig, sparql_template.replace("[CLAUSES]", " ".join(statements))
+
+    @staticmethod
+    def construct_statement(thing: str, prop_wdts: List[str], qid: Optional[str] = None) -> str:
+        """
+        Args:
+            thing: "Barack Obama"
+            prop_wdts: ["P26", "P19"]
+            qid: "Q76" to refer to the entity by its Q-id instead of its label
+
+        Returns:
+            the SPARQL clause of one predicate chain
+            "[ Barack Obama ] wdt:P26 / wdt:P19 ?end .", or "wd:Q76 wdt:P26 / wdt:P19 ?end ." with the Q-id
+        """
+        entity = f"[ {thing} ]" if qid is None else f"wd:{qid}"
+        # If there are no predicates for this chain i.e. "Who is Barack Obama?:
+        if not prop_wdts:
+            return f"BIND ( {entity} as ?end ) ."
+        return f"{entity} wdt:" + " / wdt:".join(prop_wdts) + " ?end ."
+
+    def fill_query_batch(
+        self, key: str, typed_template: str, trip_lengths: List[int], k: int, rng: np.random.Generator = None
+    ) -> Optional[List[Tuple[str, str, str]]]:
+        """
+        Args:
+            key: "single_entity"
+            typed_template: "What is the [person->location:NOUN:A:1] of [person:A] 's [person->person:NOUN:A:0] ?"
+            trip_lengths: [2]
+            k: number of copies of the template to fill
+            rng: NumPy random generator, defaults to one seeded from the predicate bank's rng
 
-        unique_hash = hashlib.sha1(query.encode("utf-8"))
-        unique_hex_dig = unique_hash.hexdigest()
+        Returns:
+            k English questions and their SPARQL queries and hashes (see construct_queries), each filled independently
+            like fill_query, or None if a predicate slot cannot be filled
 
-        return typed_template, query, str(unique_hex_dig)
+        Entities and predicates are drawn for all k copies at once, slot by slot, so only string assembly is left
+        per copy.
+        """
+        rng = rng if rng is not None else self.predicate_bank.numpy_rng()
+        plan = compile_template(typed_template)
+
+        columns = []  # (token index, k labels)
+        chains = []  # (k things, k Q-ids, [k P-values per predicate])
+        for i in range(len(trip_lengths)):
+            thing_index, thing_type = plan.thing_slots[SUFFIXES[i]]
+            things, qids = self.predicate_bank.sample_entities(self.entity_domain or thing_type, k, rng)
+            columns.append((thing_index, things))
+            prop_wdts = []
+            for j in range(trip_lengths[i]):
+                pred_index, pred_type, pos = plan.pred_slots[SUFFIXES[i]][j]
+                preds = self.predicate_bank.sample_predicates(pred_type, pos, k, rng)
+                if preds is None:
+                    return None
+                columns.append((pred_index, preds[0]))
+                prop_wdts.append(preds[1])
+            chains.append((things, qids, prop_wdts))
+
+        sparql_template = SPARQL_TEMPLATES[key]
+        tokens = list(plan.tokens)
+        queries = []
+        for r in range(k):
+            for index, labels in columns:
+                tokens[index] = labels[r]
+            english = "".join(tokens).replace(" 's", "'s").replace(" ?", "?")
+            row_chains = [(things[r], qids[r], [p[r] for p in wdts]) for things, qids, wdts in chains]
+            queries.append((english, *self.construct_queries(sparql_template, row_chains)))
+        return queries
 
     def fill_single_ent_query(self, typed_template: str, trip_lengths: List[int]) -> (str, str, str):
         return self.construct_query_pair(
-            typed_template, trip_lengths, sparql_template="SELECT ?end WHERE { [CLAUSES] }"
+            typed_template, trip_lengths, sparql_template=SPARQL_TEMPLATES["single_entity"]
         )
 
     def fill_multi_ent_query(self, typed_template: str, trip_lengths: List[int]) -> (str, str, str):
-        return self.construct_query_pair(typed_template, trip_lengths, sparql_template="ASK { [CLAUSES] }")
-
-    def fill_count_query(self, typed_template: str, trip_lengths: List[int]) -> (str, str, str):
         return self.construct_query_pair(
-            typed_template,
-            trip_lengths,
-            sparql_template="SELECT ( COUNT ( DISTINCT ?end ) as ?endcount ) WHERE { [CLAUSES] }",
+            typed_template, trip_lengths, sparql_template=SPARQL_TEMPLATES["multi_entity"]
         )
 
+    def fill_count_query(self, typed_template: str, trip_lengths: List[int]) -> (str, str, str):
+        return self.construct_query_pair(typed_template, trip_lengths, sparql_template=SPARQL_TEMPLATES["count"])
+
     def fill_query(self, key: str, typed_template: str, trip_lengths: List[int]) -> (str, str, str):
         """
         Args:
@@ -146,6 +236,7 @@ def example(data_dir: str = "data", prop_id: str = "*-props-preprocessed.json",
 
     print(filler.fill_single_ent_query("Who is [person:A] ?", [0]))
     print(filler.fill_multi_ent_query("Is [person:A] the [person->person:NOUN:B:0] of [person:B] ?", [0, 1]))
+    print(filler.fill_query_batch("single_entity", "What is the [person->location:NOUN:A:0] of [person:A] ?", [1], 3))
 
 
 if __name__ == "__main__":
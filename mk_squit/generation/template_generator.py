@@ -1,55 +1,24 @@
 # Copyright (c) 2020 MeetKai Inc. All rights reserved.
 
-import re
 import json
 import random
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import typer
 from nltk import grammar as nltk_grammar
 from nltk import CFG
-from nltk.parse.generate import generate
 
+from mk_squit.generation.feasibility import FeasibilityTable, cached_live_indices, template_signature
 from mk_squit.generation.type_generator import TypeGenerator
 from mk_squit.generation.predicate_bank import PredicateBank
+from mk_squit.generation.template_grammar import NumberedTemplates, TemplateGrammar, template_cache_key
+from mk_squit.generation.template_plan import compile_template, number_tokens
 
 # Multi-fact questions bring forth referent ambiguities:
 #    "What is the name of the sister city tied to Kansas City,
 #    which is located in the county of Seville Province?"
 # Which city does "which" refer to?
 
-#### These grammars are for the TEST_HARD set
-# single_ent_template_grammar = CFG.fromstring(
-#     """
-# S -> "[WH]" IS Q "?" | CAN "[WH]" IS Q "?"
-# CAN -> "Hey" | "Can you tell me" | "Do you know"
-# IS -> "is" | "was"
-# Q -> NOUN | VERB-ADP
-# NOUN -> "[THING]" | NOUN "'s [NOUN]" | "the [NOUN] of" NOUN
-# VERB-ADP -> NOUN "[VERB-ADP]"
-# """
-# )
-#
-# multi_ent_template_grammar = CFG.fromstring(
-#     """
-# S -> IS NOUN "[SEP] the [NOUN] of" NOUN "?" | CAN is NOUN "[SEP] the [NOUN] of" NOUN "?"
-# CAN -> "Hey" | "Can you tell me" | "Do you know"
-# is -> "is" | "was"
-# IS -> "Is" | "Was"
-# NOUN -> "[THING]" | NOUN "'s [NOUN]" | "the [NOUN] of" NOUN
-# """
-# )
-#
-# count_template_grammar = CFG.fromstring(
-#     """
-# S -> "[WH]" IS Q "?" | "How many [NOUN] does" NOUN "have ?" | CAN "[WH]" IS Q "?" | CAN "how many [NOUN] does" NOUN "have ?"
-# CAN -> "Hey" | "Can you tell me" | "Do you know"
-# IS -> "is" | "was"
-# Q -> "the number of [NOUN] of" NOUN
-# NOUN -> "[THING]" | NOUN "'s [NOUN]" | "the [NOUN] of" NOUN
-# """
-# )
-
 single_ent_template_grammar = CFG.fromstring(
     """
 S -> "[WH]" IS Q "?"
@@ -79,39 +48,154 @@ NOUN -> "[THING]" | NOUN "'s [NOUN]" | "the [NOUN] of" NOUN
 """
 )
 
+# Grammars of the hard test set, with question prefixes the training grammars never produce
+hard_single_ent_template_grammar = CFG.fromstring(
+    """
+S -> "[WH]" IS Q "?" | CAN "[WH]" IS Q "?"
+CAN -> "Hey" | "Can you tell me" | "Do you know"
+IS -> "is" | "was"
+Q -> NOUN | VERB-ADP
+NOUN -> "[THING]" | NOUN "'s [NOUN]" | "the [NOUN] of" NOUN
+VERB-ADP -> NOUN "[VERB-ADP]"
+"""
+)
+
+hard_multi_ent_template_grammar = CFG.fromstring(
+    """
+S -> IS NOUN "[SEP] the [NOUN] of" NOUN "?" | CAN is NOUN "[SEP] the [NOUN] of" NOUN "?"
+CAN -> "Hey" | "Can you tell me" | "Do you know"
+is -> "is" | "was"
+IS -> "Is" | "Was"
+NOUN -> "[THING]" | NOUN "'s [NOUN]" | "the [NOUN] of" NOUN
+"""
+)
+
+hard_count_template_grammar = CFG.fromstring(
+    """
+S -> "[WH]" IS Q "?" | "How many [NOUN] does" NOUN "have ?"
+S -> CAN "[WH]" IS Q "?" | CAN "how many [NOUN] does" NOUN "have ?"
+CAN -> "Hey" | "Can you tell me" | "Do you know"
+IS -> "is" | "was"
+Q -> "the number of [NOUN] of" NOUN
+NOUN -> "[THING]" | NOUN "'s [NOUN]" | "the [NOUN] of" NOUN
+"""
+)
+
+# Grammar sets by name, each with a grammar for every template type. Register new sets here to use them in
+# generation profiles (see mk_squit.generation.profiles)
+GRAMMARS = {
+    "easy": {
+        "single_entity": single_ent_template_grammar,
+        "multi_entity": multi_ent_template_grammar,
+        "count": count_template_grammar,
+    },
+    "hard": {
+        "single_entity": hard_single_ent_template_grammar,
+        "multi_entity": hard_multi_ent_template_grammar,
+        "count": hard_count_template_grammar,
+    },
+}
+
+# Maximal derivation depth per template type
+DEPTHS = {"single_entity": 6, "multi_entity": 4, "count": 5}
+
+# Grammars with up to this many templates have their live templates listed when pruning
+LIVE_LIMIT = 100000
+
+# Larger grammars redraw dead templates up to this many times
+MAX_REDRAWS = 1000
+
 
 class TemplateGenerator(object):
     """Generates multiple layers of templates using a TypeGenerator and PredicateBank."""
 
-    def __init__(self, type_generator: TypeGenerator, predicate_bank: PredicateBank):
-        self.base_templates = {
-            "single_entity": self.generate_base_templates(single_ent_template_grammar, depth=6),
-            "multi_entity": self.generate_base_templates(multi_ent_template_grammar, depth=4),
-            "count": self.generate_base_templates(count_template_grammar, depth=5),
-            # "single_entity": self.generate_base_templates(single_ent_template_grammar, depth=8),  # TEST_HARD
-            # "multi_entity": self.generate_base_templates(multi_ent_template_grammar, depth=6),
-            # "count": self.generate_base_templates(count_template_grammar, depth=7),
-        }
-        self.templates = {
-            "single_entity": [self.number_single_ent(template) for template in self.base_templates["single_entity"]],
-            "multi_entity": [self.number_multi_ent(template) for template in self.base_templates["multi_entity"]],
-            "count": [self.number_count_ent(template) for template in self.base_templates["count"]],
+    def __init__(
+        self,
+        type_generator: TypeGenerator,
+        predicate_bank: PredicateBank,
+        rng: random.Random = None,
+        cache_dir: Optional[str] = None,
+        prune: bool = True,
+        grammar_set: str = "easy",
+        depths: Optional[Dict[str, int]] = None,
+        feasibility: Optional[FeasibilityTable] = None,
+        template_cache: Optional[Dict] = None,
+    ):
+        """
+        Args:
+            type_generator: TypeGenerator over the same predicate bank
+            predicate_bank: PredicateBank
+            rng: random source, defaults to the predicate bank's
+            cache_dir: directory to cache the live templates of grammars in, e.g. "./data/.cache", see
+                cached_live_indices
+            prune: make sample_typed_template draw only fillable (template, start types, path) combinations, see
+                FeasibilityTable
+            grammar_set: name of the grammars in GRAMMARS
+            depths: {"single_entity": 8} to override the DEPTHS of template types
+            feasibility: FeasibilityTable of the type generator to share with other template generators
+            template_cache: dict shared by template generators of the same graph, so that templates of the same
+                grammar and depth are only loaded and pruned once
+        """
+        if grammar_set not in GRAMMARS:
+            raise ValueError(f"Unknown grammar set {grammar_set}, expected one of {list(GRAMMARS)}.")
+        depths = {**DEPTHS, **(depths or {})}
+        numbers = {
+            "single_entity": self.number_single_ent,
+            "multi_entity": self.number_multi_ent,
+            "count": self.number_count_ent,
         }
+        self.grammar_set = grammar_set
+        self.depths = depths
+        self.cache_dir = cache_dir
         self.type_gen = type_generator
         self.predicate_bank = predicate_bank
+        self.rng = rng if rng is not None else predicate_bank.rng
+        if prune and feasibility is None:
+            feasibility = FeasibilityTable(type_generator)
+        self.feasibility = feasibility if prune else None
+        self.template_cache = template_cache if template_cache is not None else dict()
+
+        # Base templates are drawn from the grammars on demand and numbered when drawn
+        self.base_templates = dict()
+        self.templates = dict()
+        # Indices of the live templates per template type, None for grammars too large to list
+        self.live_templates = dict()
+        for key, grammar in GRAMMARS[grammar_set].items():
+            template_key = template_cache_key(grammar, depths[key], key)
+            cache_key = (template_key, self.feasibility is not None)
+            if cache_key not in self.template_cache:
+                base_templates = TemplateGrammar(grammar, depths[key])
+                templates = NumberedTemplates(base_templates, numbers[key])
+                live = None
+                if self.feasibility is not None and templates.size <= LIVE_LIMIT:
+                    live = cached_live_indices(self.feasibility, templates, template_key, cache_dir)
+                self.template_cache[cache_key] = (base_templates, templates, live)
+            self.base_templates[key], self.templates[key], live = self.template_cache[cache_key]
+            if self.feasibility is not None:
+                self.live_templates[key] = live
 
     def generate_base_templates(self, grammar: nltk_grammar, depth: int) -> List[str]:
-        templates = []
-        for sentence in generate(grammar, depth=depth):
-            templates.append(" ".join(sentence))
-        return templates
+        """Lists every base template of the grammar up to depth, in the order of nltk.parse.generate.generate."""
+        return list(TemplateGrammar(grammar, depth))
+
+    def sample_template(self, key: str) -> (str, List[int]):
+        """
+        Args:
+            key: "single_entity"
+
+        Returns:
+            a uniformly random numbered template and the length of its predicate chain(s), the same draw as
+            rng.choice(self.templates[key]) but also for grammars with more than sys.maxsize templates
+        """
+        templates = self.templates[key]
+        return templates[self.rng.randrange(getattr(templates, "size", len(templates)))]
 
     def save_base_templates(self, path: str = "./data/base_templates.json") -> None:
         with open(path, "w") as f:
-            json.dump(self.base_templates, f)
+            json.dump({key: list(templates) for key, templates in self.base_templates.items()}, f)
 
     def __str__(self):
-        return json.dumps(self.base_templates, indent=4)
+        return json.dumps({key: list(templates) for key, templates in self.base_templates.items()}, indent=4)
 
     def number_single_ent(self, text_template: str, suffix: str = "A") -> (str, int):
         """
@@ -133,26 +217,8 @@ class TemplateGenerator(object):
             secondly in descending order BEFORE the [THING] token
         Then the [VERB-ADP]s are numbered in ascending order starting after the [THING] token
         """
-        text_template = text_template.replace("[THING]", f"[THING:{suffix}]")
-        thing_ind = text_template.find(f"[THING:{suffix}]")
-        new_template = ""
-        counter = 0
-
-        for i in range(thing_ind, len(text_template)):
-            new_template += text_template[i]
-            if new_template[-5:] == "[NOUN":
-                new_template += f":{suffix}:{counter}"
-                counter += 1
-        for i in range(thing_ind - 1, -1, -1):
-            if new_template[:6] == "[NOUN]":
-                new_template = new_template[:5] + f":{suffix}:{counter}]" + new_template[6:]
-                counter += 1
-            new_template = text_template[i] + new_template
-
-        if new_template.find("[VERB-ADP]") != -1:
-            new_template = new_template.replace("[VERB-ADP]", f"[VERB-ADP:{suffix}:{counter}]")
-            counter += 1
-        return new_template, [counter]
+        template, counter = number_tokens(text_template, suffix)
+        return template, [counter]
 
     def number_multi_ent(self, text_template: str) -> (str, int, int):
         """
@@ -184,6 +250,48 @@ class TemplateGenerator(object):
         """
         return self.number_single_ent(text_template=text_template)
 
+    def sample_typed_template(self, key: str) -> Optional[Tuple[str, List[int]]]:
+        """
+        Args:
+            key: "single_entity"
+
+        Returns:
+            a random typed template and the length of its predicate chain(s), None if it could not be typed
+
+        Without pruning this is type_template(*sample_template(key)), which can fail or produce templates whose
+        predicates cannot be filled. With pruning, the template is drawn uniformly from the live ones, the start
+        types uniformly from those with fillable paths for it and the path uniformly from its fillable paths, so
+        every typed template can be filled. None is then only returned if every template of the type is dead.
+        """
+        if self.feasibility is None:
+            return self.type_template(*self.sample_template(key))
+
+        live = self.live_templates[key]
+        if live is not None:
+            if not live:
+                return None
+            number_template, pred_chain_lengths = self.templates[key][self.rng.choice(live)]
+            signature = template_signature(number_template, pred_chain_lengths)
+        else:
+            # Too many templates to list the live ones: dead ones are redrawn before anything is typed or filled
+            for _ in range(MAX_REDRAWS):
+                number_template, pred_chain_lengths = self.sample_template(key)
+                signature = template_signature(number_template, pred_chain_lengths)
+                if self.feasibility.is_live(signature):
+                    break
+            else:
+                return None
+
+        thing_samples = list(self.rng.choice(self.feasibility.starts(signature)[0]))
+        wh = None
+        if len(thing_samples) == 1:
+            path, end = self.type_gen.sample_chain_path(thing_samples[0], signature[0])
+            paths = [path]
+            wh = self.predicate_bank.get_wh_word(end)[0]
+        else:
+            paths = self.type_gen.sample_bidirectional_chain_path(thing_samples[0], thing_samples[1], *signature)
+        return compile_template(number_template).type(thing_samples, paths, wh), pred_chain_lengths
+
     def type_template(self, number_template: str, pred_chain_lengths: List[int]) -> (str, List[int]):
         """
         Args:
@@ -195,35 +303,29 @@ class TemplateGenerator(object):
             "What is the [literary_work->award:NOUN:A:1] of the
              [literary_work->literary_work:NOUN:A:0] of [literary_work:A] ?", [2]
         """
-        suffixes = ["A", "B"]
+        plan = compile_template(number_template)
         thing_types = ["movie", "person", "literary_work", "television_series"]
 
         paths = None
         thing_samples = None
+        wh = None
         tries = 10
 
         # This for loop ensures that a pred chain is found eventually
         for i in range(tries):
             # for each thing, sample a start domain type
-            thing_samples = random.choices(thing_types, k=len(pred_chain_lengths))
+            thing_samples = self.rng.choices(thing_types, k=len(pred_chain_lengths))
             if len(thing_samples) == 1:
-                p = list(
-                    self.type_gen.generate_unidirectional_pred_traversal(
-                        self.type_gen.G, thing_samples[0].lower(), pred_chain_lengths[0]
-                    )
+                paths_chosen = self.type_gen.sample_unidirectional_path(
+                    thing_samples[0].lower(), pred_chain_lengths[0]
                 )
-                if len(p) == 0:
+                if paths_chosen is None:
                     return None
-                paths_chosen = random.choice(p)
                 paths = [paths_chosen[0]]
-                number_template = number_template.replace("[WH]", self.predicate_bank.get_wh_word(paths_chosen[1])[0])
+                wh = self.predicate_bank.get_wh_word(paths_chosen[1])[0]
             else:
-                paths = self.type_gen.generate_bidirectional_pred_traversal(
-                    thing_samples[0].lower(),
-                    thing_samples[1].lower(),
-                    *pred_chain_lengths,
-                    self.type_gen.G,
-                    self.type_gen.Gi,
+                paths = self.type_gen.sample_bidirectional_path(
+                    thing_samples[0].lower(), thing_samples[1].lower(), *pred_chain_lengths
                 )
             if paths or i == tries - 1:
                 break
@@ -231,14 +333,7 @@ class TemplateGenerator(object):
         if paths is None:
             return None
 
-        pred_pattern = r"\[\w+-?\w+:"  # Matches [NOUN:
-        for i in range(len(thing_samples)):
-            number_template = number_template.replace(f"[THING:{suffixes[i]}]", f"[{thing_samples[i]}:{suffixes[i]}]")
-            path = paths[i]
-            for j in range(pred_chain_lengths[i]):
-                match = re.search(f"{pred_pattern}{suffixes[i]}:{j}]", number_template)
-                number_template = number_template.replace(match.group(), "[" + path[j] + ":" + match.group()[1:])
-        return number_template, pred_chain_lengths
+        return plan.type(thing_samples, paths, wh), pred_chain_lengths
 
 
 def example(data_dir: str = "data", prop_id: str = "*-props-preprocessed.json", ent_id: str = "*-5k-preprocessed.json"):
@@ -0,0 +1,211 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import random
+import hashlib
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+from nltk import grammar as nltk_grammar
+from nltk.grammar import Nonterminal, Production
+
+from mk_squit.generation.template_plan import NUMBERING_VERSION
+
+
+class TemplateGrammar(object):
+    """Read-only sequence of the base templates a CFG derives up to a given depth, without enumerating them:
+        grammar[i] == " ".join(list(nltk.parse.generate.generate(cfg, depth=depth))[i])
+
+    Derivations are counted per (symbol, depth) with dynamic programming, and template i is built by walking the
+    counts down the derivation tree (unranking), so len() and indexing cost O(depth) instead of time and memory
+    proportional to the number of templates. Templates are derivations in nltk's enumeration order, so
+    rng.choice(grammar) draws exactly what rng.choice over the enumerated list would.
+
+    With production weights, sample() draws derivations with probability proportional to the product of the weights
+    of the productions they use instead of uniformly.
+    """
+
+    def __init__(self, cfg: nltk_grammar.CFG, depth: int, weights: Dict[Production, float] = None):
+        """
+        Args:
+            cfg: nltk CFG, e.g. single_ent_template_grammar
+            depth: maximal depth of the derivation trees, as in nltk.parse.generate.generate
+            weights: weight per production for sample(), productions that are missing have weight 1
+        """
+        self.cfg = cfg
+        self.depth = depth
+        self.weights = weights
+        self._counts = dict()
+        self._sequence_counts = dict()
+        self._weighted_counts = dict()
+        self._weighted_sequence_counts = dict()
+
+    @property
+    def size(self) -> int:
+        """Number of templates, may exceed sys.maxsize (which len() cannot)."""
+        return self.count(self.cfg.start(), self.depth)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> str:
+        size = self.size
+        if i < 0:
+            i += size
+        if not 0 <= i < size:
+            raise IndexError("template index out of range")
+        tokens = []
+        self._unrank(self.cfg.start(), self.depth, i, tokens)
+        return " ".join(tokens)
+
+    def __iter__(self) -> Iterator[str]:
+        for tokens in self._enumerate(self.cfg.start(), self.depth):
+            yield " ".join(tokens)
+
+    def count(self, symbol, depth: int) -> int:
+        """Number of derivations of symbol (a Nonterminal or a terminal string) within depth."""
+        key = (symbol, depth)
+        if key not in self._counts:
+            if depth <= 0:
+                self._counts[key] = 0
+            elif not isinstance(symbol, Nonterminal):
+                self._counts[key] = 1
+            else:
+                self._counts[key] = sum(
+                    self._count_sequence(production.rhs(), depth - 1)
+                    for production in self.cfg.productions(lhs=symbol)
+                )
+        return self._counts[key]
+
+    def _count_sequence(self, symbols: Tuple, depth: int) -> int:
+        key = (symbols, depth)
+        if key not in self._sequence_counts:
+            total = 1
+            for symbol in symbols:
+                total *= self.count(symbol, depth)
+                if total == 0:
+                    break
+            self._sequence_counts[key] = total
+        return self._sequence_counts[key]
+
+    def _unrank(self, symbol, depth: int, rank: int, tokens: List[str]) -> None:
+        if not isinstance(symbol, Nonterminal):
+            tokens.append(symbol)
+            return
+        for production in self.cfg.productions(lhs=symbol):
+            count = self._count_sequence(production.rhs(), depth - 1)
+            if rank < count:
+                self._unrank_sequence(production.rhs(), depth - 1, rank, tokens)
+                return
+            rank -= count
+
+    def _unrank_sequence(self, symbols: Tuple, depth: int, rank: int, tokens: List[str]) -> None:
+        # The first symbol varies slowest, like the nested loops of nltk's generator
+        for i, symbol in enumerate(symbols):
+            symbol_rank, rank = divmod(rank, self._count_sequence(symbols[i + 1 :], depth))
+            self._unrank(symbol, depth, symbol_rank, tokens)
+
+    def _enumerate(self, symbol, depth: int) -> Iterator[List[str]]:
+        if depth <= 0:
+            return
+        if not isinstance(symbol, Nonterminal):
+            yield [symbol]
+            return
+        for production in self.cfg.productions(lhs=symbol):
+            yield from self._enumerate_sequence(production.rhs(), depth - 1)
+
+    def _enumerate_sequence(self, symbols: Tuple, depth: int) -> Iterator[List[str]]:
+        if not symbols:
+            yield []
+            return
+        if self._count_sequence(symbols, depth) == 0:
+            return
+        for head in self._enumerate(symbols[0], depth):
+            for tail in self._enumerate_sequence(symbols[1:], depth):
+                yield head + tail
+
+    def sample(self, rng: random.Random) -> str:
+        """
+        Returns:
+            a random template, uniformly over derivations (the same draw as rng.choice(self)) unless weights were given
+        """
+        if self.weights is None:
+            return self[rng.randrange(self.size)]
+        tokens = []
+        self._sample_weighted(rng, self.cfg.start(), self.depth, tokens)
+        return " ".join(tokens)
+
+    def _weighted_count(self, symbol, depth: int) -> float:
+        key = (symbol, depth)
+        if key not in self._weighted_counts:
+            if depth <= 0:
+                self._weighted_counts[key] = 0.0
+            elif not isinstance(symbol, Nonterminal):
+                self._weighted_counts[key] = 1.0
+            else:
+                self._weighted_counts[key] = sum(
+                    self.weights.get(production, 1.0) * self._weighted_sequence_count(production.rhs(), depth - 1)
+                    for production in self.cfg.productions(lhs=symbol)
+                )
+        return self._weighted_counts[key]
+
+    def _weighted_sequence_count(self, symbols: Tuple, depth: int) -> float:
+        key = (symbols, depth)
+        if key not in self._weighted_sequence_counts:
+            total = 1.0
+            for symbol in symbols:
+                total *= self._weighted_count(symbol, depth)
+            self._weighted_sequence_counts[key] = total
+        return self._weighted_sequence_counts[key]
+
+    def _sample_weighted(self, rng: random.Random, symbol, depth: int, tokens: List[str]) -> None:
+        if not isinstance(symbol, Nonterminal):
+            tokens.append(symbol)
+            return
+        productions = self.cfg.productions(lhs=symbol)
+        weights = [
+            self.weights.get(production, 1.0) * self._weighted_sequence_count(production.rhs(), depth - 1)
+            for production in productions
+        ]
+        production = rng.choices(productions, weights=weights)[0]
+        for child in production.rhs():
+            self._sample_weighted(rng, child, depth - 1, tokens)
+
+
+class NumberedTemplates(object):
+    """Read-only sequence that numbers the templates of a base sequence on access:
+        numbered[i] == number(base[i])
+
+    Only the templates that are actually drawn are numbered, up to cache_size of them are kept.
+    """
+
+    def __init__(self, base: Sequence[str], number: Callable[[str], Tuple[str, List[int]]], cache_size: int = 65536):
+        self.base = base
+        self.number = number
+        self.cache_size = cache_size
+        self._cache = dict()
+
+    @property
+    def size(self) -> int:
+        return self.base.size if isinstance(self.base, TemplateGrammar) else len(self.base)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> Tuple[str, List[int]]:
+        numbered = self._cache.get(i)
+        if numbered is None:
+            numbered = self.number(self.base[i])
+            if len(self._cache) >= self.cache_size:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[i] = numbered
+        return numbered
+
+    def __iter__(self) -> Iterator[Tuple[str, List[int]]]:
+        for template in self.base:
+            yield self.number(template)
+
+
+def template_cache_key(cfg: nltk_grammar.CFG, depth: int, template_type: str) -> str:
+    """Hash of the template type (which decides how templates are numbered), the grammar's text, the depth and
+    NUMBERING_VERSION."""
+    text = f"{template_type}\n{cfg}\ndepth={depth}\nnumbering={NUMBERING_VERSION}"
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
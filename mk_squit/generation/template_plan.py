@@ -0,0 +1,120 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+SUFFIXES = ["A", "B"]
+
+SLOT_PATTERN = re.compile(r"(\[[^\]]*\])")  # Splits on bracketed tokens, keeping them
+THING_SLOT_PATTERN = re.compile(r"\[(\w+):([AB])\]")  # Matches [person:A]
+
+# Bump whenever number_tokens (or the numbering in TemplateGenerator) changes its output, cached live templates of
+# older versions are then ignored
+NUMBERING_VERSION = 1
+
+
+class TemplatePlan(object):
+    """A numbered or typed template compiled into a token list and the indices of its slots.
+
+    "[WH] is the [NOUN:A:1] of [THING:A] 's [NOUN:A:0] ?" compiles to the tokens
+        ["", "[WH]", " is the ", "[NOUN:A:1]", " of ", "[THING:A]", " 's ", "[NOUN:A:0]", " ?"]
+    where odd indices hold the slots:
+        wh_slot: 1
+        thing_slots: {"A": (5, "THING")}
+        pred_slots: {"A": [(7, None, "NOUN"), (3, None, "NOUN")]}
+
+    Thing slots map a suffix to (token index, thing type), predicate slots map a suffix to its chain in numbered
+    order as (token index, predicate type, POS). Types are None (or "THING") until the template has been typed.
+    Filling a slot is an index assignment on a copy of the tokens followed by a single join.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.tokens = SLOT_PATTERN.split(template)
+        self.wh_slot = None
+        self.thing_slots: Dict[str, Tuple[int, str]] = {}
+        self.pred_slots: Dict[str, List[Tuple[int, Optional[str], str]]] = {}
+
+        numbered = {}
+        for i in range(1, len(self.tokens), 2):
+            fields = self.tokens[i][1:-1].split(":")
+            if fields == ["WH"]:
+                self.wh_slot = i
+            elif len(fields) == 2 and fields[1] in SUFFIXES:
+                self.thing_slots[fields[1]] = (i, fields[0])
+            elif len(fields) in [3, 4] and fields[-2] in SUFFIXES:
+                pred_type = fields[0] if len(fields) == 4 else None
+                numbered.setdefault(fields[-2], {})[int(fields[-1])] = (i, pred_type, fields[-3])
+
+        for suffix, chain in numbered.items():
+            self.pred_slots[suffix] = [chain[j] for j in range(len(chain))]
+
+    def type(self, thing_types: List[str], paths: List[List[str]], wh: Optional[str] = None) -> str:
+        """
+        Args:
+            thing_types: ["person"]
+            paths: [["person->person", "person->location"]]
+            wh: "What"
+
+        Returns:
+            the typed template
+            "What is the [person->location:NOUN:A:1] of [person:A] 's [person->person:NOUN:A:0] ?"
+        """
+        tokens = list(self.tokens)
+        if wh is not None and self.wh_slot is not None:
+            tokens[self.wh_slot] = wh
+        for suffix, thing_type, path in zip(SUFFIXES, thing_types, paths):
+            tokens[self.thing_slots[suffix][0]] = f"[{thing_type}:{suffix}]"
+            for j, (index, _, pos) in enumerate(self.pred_slots.get(suffix, [])[: len(path)]):
+                tokens[index] = f"[{path[j]}:{pos}:{suffix}:{j}]"
+        return "".join(tokens)
+
+
+def thing_types(typed_template: str) -> List[str]:
+    """
+    Args:
+        typed_template: "Is [person:A] the [movie->person:NOUN:B:0] of [movie:B] ?"
+
+    Returns:
+        the thing types of the template in suffix order, ["person", "movie"]
+
+    Unlike compile_template, this does not cache, so typed templates (which rarely repeat) do not evict plans.
+    """
+    return [thing_type for thing_type, _ in sorted(THING_SLOT_PATTERN.findall(typed_template), key=lambda m: m[1])]
+
+
+@lru_cache(maxsize=1 << 16)
+def compile_template(template: str) -> TemplatePlan:
+    """Compiles (and caches) the plan of a numbered or typed template."""
+    return TemplatePlan(template)
+
+
+def number_tokens(text_template: str, suffix: str = "A") -> Tuple[str, int]:
+    """
+    Args:
+        text_template: "[WH] is the [NOUN] of [THING] [VERB-ADP] ?"
+        suffix: "A"
+
+    Returns:
+        the numbered template and the length of its predicate chain
+        "[WH] is the [NOUN:A:0] of [THING:A] [VERB-ADP:A:1] ?", 2
+
+    See TemplateGenerator.number_single_ent for the numbering order.
+    """
+    tokens = SLOT_PATTERN.split(text_template)
+    thing_ind = tokens.index("[THING]")
+    tokens[thing_ind] = f"[THING:{suffix}]"
+
+    counter = 0
+    for i in list(range(thing_ind + 2, len(tokens), 2)) + list(range(thing_ind - 2, 0, -2)):
+        if tokens[i] == "[NOUN]":
+            tokens[i] = f"[NOUN:{suffix}:{counter}]"
+            counter += 1
+
+    verb_adp = [i for i in range(1, len(tokens), 2) if tokens[i] == "[VERB-ADP]"]
+    for i in verb_adp:
+        tokens[i] = f"[VERB-ADP:{suffix}:{counter}]"
+    if verb_adp:
+        counter += 1
+    return "".join(tokens), counter
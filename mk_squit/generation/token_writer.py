@@ -0,0 +1,193 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import re
+import json
+import struct
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from mk_squit.generation.predicate_bank import PredicateBank
+from mk_squit.generation.template_filler import SPARQL_TEMPLATES
+
+SPECIAL_TOKENS = ["<pad>", "<unk>"]
+# Tokens of TemplateFiller.construct_statement besides entities and wdt:P ids
+STATEMENT_TOKENS = ["BIND", "(", "[", "]", "as", "?end", ")", ".", "/"]
+# Sides of the rows that can be tokenized, by the value of generate_queries' tokenize argument
+TOKENIZE_SIDES = {"sparql": ["sparql"], "both": ["sparql", "english"]}
+
+ENTITY_PATTERN = re.compile(r"\[ (.*?) \]")  # Matches [ Barack Obama ]
+NPY_HEADER_SIZE = 128
+
+
+def sparql_tokens(sparql: str) -> List[str]:
+    """
+    Args:
+        sparql: "SELECT ?end WHERE { [ Barack Obama ] wdt:P26 ?end . }"
+
+    Returns:
+        the whitespace separated tokens with every entity span as a single token
+        ["SELECT", "?end", "WHERE", "{", "[", "Barack Obama", "]", "wdt:P26", "?end", ".", "}"]
+    """
+    tokens = []
+    start = 0
+    for match in ENTITY_PATTERN.finditer(sparql):
+        tokens.extend(sparql[start : match.start()].split())
+        tokens.extend(["[", match.group(1), "]"])
+        start = match.end()
+    tokens.extend(sparql[start:].split())
+    return tokens
+
+
+def english_tokens(english: str) -> List[str]:
+    """Who is Barack Obama's spouse? -> ["Who", "is", "Barack", "Obama's", "spouse?"]"""
+    return english.split()
+
+
+class Vocabulary(object):
+    """Token <-> ID mapping that assigns new tokens the next ID, so IDs never change once assigned."""
+
+    def __init__(self, tokens: Iterable[str] = ()):
+        self.tokens: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for token in [*SPECIAL_TOKENS, *tokens]:
+            self.add(token)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def add(self, token: str) -> int:
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, tokens: List[str]) -> List[int]:
+        return [self.add(token) for token in tokens]
+
+    def decode(self, ids: Iterable[int]) -> List[str]:
+        return [self.tokens[i] for i in ids]
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.tokens, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "Vocabulary":
+        with open(path, "r") as f:
+            tokens = json.load(f)
+        vocabulary = cls()
+        vocabulary.tokens = tokens
+        vocabulary.ids = {token: i for i, token in enumerate(tokens)}
+        return vocabulary
+
+
+def sparql_vocabulary(predicate_bank: PredicateBank) -> Vocabulary:
+    """Vocabulary that starts with the closed part of the SPARQL side: the query skeletons and every wdt:P id."""
+    skeleton = []
+    for template in SPARQL_TEMPLATES.values():
+        skeleton.extend(template.replace("[CLAUSES]", "").split())
+    pids = {key.split("/")[-1] for key in predicate_bank.properties.keys}
+    wdts = [f"wdt:{pid}" for pid in sorted(pids, key=lambda pid: (len(pid), pid))]
+    return Vocabulary(dict.fromkeys(skeleton + STATEMENT_TOKENS + wdts))
+
+
+def save_vocabularies(vocabularies: Dict[str, Vocabulary], sides: List[str], out_dir: str) -> None:
+    """Writes the vocabulary of every side to out_dir/<side>.vocab.json, e.g. ./out/sparql.vocab.json."""
+    for side in sides:
+        vocabularies[side].save(os.path.join(out_dir, f"{side}.vocab.json"))
+
+
+def _npy_header(dtype: np.dtype, length: int) -> bytes:
+    """A version 1.0 .npy header of a one-dimensional array, always NPY_HEADER_SIZE bytes so it can be rewritten."""
+    text = f"{{'descr': '{np.dtype(dtype).str}', 'fortran_order': False, 'shape': ({length},), }}"
+    text = text.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(text)) + text.encode("latin-1")
+
+
+class TokenArrayWriter(object):
+    """Streams token ID sequences into two .npy files that can be memory-mapped with np.load(mmap_mode="r"):
+        path.ids.npy: the int32 IDs of all sequences back to back
+        path.offsets.npy: int64, ids[offsets[i]:offsets[i + 1]] is sequence i
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.num_ids = 0
+        self.num_sequences = 0
+        self._ids = None
+        self._offsets = None
+
+    def open(self) -> None:
+        self._ids = open(self.path + ".ids.npy", "wb")
+        self._offsets = open(self.path + ".offsets.npy", "wb")
+        self._ids.write(_npy_header(np.int32, 0))
+        self._offsets.write(_npy_header(np.int64, 0))
+        self._offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+        self.num_ids = 0
+        self.num_sequences = 0
+
+    def write(self, sequences: List[List[int]]) -> None:
+        if not sequences:
+            return
+        lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+        self._ids.write(np.fromiter((i for sequence in sequences for i in sequence), dtype=np.int32).tobytes())
+        self._offsets.write((self.num_ids + np.cumsum(lengths)).tobytes())
+        self.num_ids += int(lengths.sum())
+        self.num_sequences += len(sequences)
+
+    def close(self) -> None:
+        """Writes the final lengths into the headers."""
+        files = [(self._ids, np.int32, self.num_ids), (self._offsets, np.int64, self.num_sequences + 1)]
+        for f, dtype, length in files:
+            f.seek(0)
+            f.write(_npy_header(dtype, length))
+            f.close()
+
+
+class TokenWriter(object):
+    """Writes pre-tokenized token IDs of generated rows next to the text output:
+        prefix.sparql.ids.npy, prefix.sparql.offsets.npy (and the same for english)
+
+    IDs are assigned when tokens are first seen, in the order rows are written, so they are as deterministic as the
+    rows. Vocabularies are passed in so that several outputs of one generator (train and test) share IDs, and are
+    saved once after the last output with save_vocabularies.
+    """
+
+    def __init__(self, prefix: str, vocabularies: Dict[str, Vocabulary], sides: List[str]):
+        """
+        Args:
+            prefix: path the file names start with, e.g. "./out/train_queries_v3.tsv"
+            vocabularies: {"sparql": sparql_vocabulary(bank), "english": Vocabulary()}
+            sides: ["sparql"] or ["sparql", "english"]
+        """
+        self.prefix = prefix
+        self.vocabularies = vocabularies
+        self.sides = sides
+        self.writers = {side: TokenArrayWriter(f"{prefix}.{side}") for side in sides}
+
+    def open(self) -> None:
+        for writer in self.writers.values():
+            writer.open()
+
+    def _encode(self, side: str, rows: List[Tuple]) -> List[List[int]]:
+        vocabulary = self.vocabularies[side]
+        if side == "sparql":
+            return [vocabulary.encode(sparql_tokens(row[1])) for row in rows]
+        return [vocabulary.encode(english_tokens(row[0])) for row in rows]
+
+    def write(self, rows: List[Tuple]) -> None:
+        for side, writer in self.writers.items():
+            writer.write(self._encode(side, rows))
+
+    def add(self, rows: Iterable[Tuple]) -> None:
+        """Assigns IDs to the tokens of rows without writing them, e.g. of an output whose IDs were written before."""
+        rows = list(rows)
+        for side in self.sides:
+            self._encode(side, rows)
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
@@ -1,25 +1,45 @@
 # Copyright (c) 2020 MeetKai Inc. All rights reserved.
 
 import random
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import typer
+import numpy as np
 import networkx as nx
 
 from mk_squit.generation.predicate_bank import PredicateBank
 
+# We exclude some thing types as the meeting point of the two chains of a Multi-Entity query
+MULTI_ENTITY_EXCLUDED_TYPES = [
+    "text",
+    "id",
+    "thing",
+    "image",
+    "television_series",
+    "literary_work",
+    "movie",
+    "url",
+    "rating",
+]
+
 
 class TypeGenerator(object):
     """Generate predicate chains intelligently by traversing a graph made from predicate types."""
 
-    def __init__(self, predicate_bank: PredicateBank):
+    def __init__(self, predicate_bank: PredicateBank, rng: random.Random = None):
+        """
+        Args:
+            predicate_bank: a loaded PredicateBank
+            rng: random source for sampling, defaults to the predicate bank's
+        """
         self.predicate_bank = predicate_bank
+        self.rng = rng if rng is not None else predicate_bank.rng
 
         # G and Gi are directed graphs with edges in opposite directions
         G = nx.DiGraph()
         Gi = nx.DiGraph()
 
-        for e in list(self.predicate_bank.bank.keys()):
+        for e in self.predicate_bank.predicate_types:
             ns = e.split("->")
             G.add_edge(*ns)
             G[ns[0]][ns[1]]["label"] = e
@@ -34,6 +54,355 @@ class TypeGenerator(object):
         self.G = G
         self.Gi = Gi
 
+        # Integer-indexed copy of G used for counting, sampling and enumerating traversals
+        self.nodes: List[str] = list(G.nodes)
+        self.node_index: Dict[str, int] = {node: i for i, node in enumerate(self.nodes)}
+        # Neighbors and edge labels in G's order, which fixes the order traversals are enumerated (and ranked) in
+        self.neighbors: List[List[int]] = [[self.node_index[v] for v in G.neighbors(u)] for u in self.nodes]
+        self.edge_labels: Dict[Tuple[int, int], str] = {
+            (self.node_index[u], self.node_index[v]): label for u, v, label in G.edges(data="label")
+        }
+        self.adjacency = np.zeros((len(self.nodes), len(self.nodes)), dtype=np.int64)
+        for (u, v) in self.edge_labels:
+            self.adjacency[u, v] = 1
+        self.excluded_mask = np.array([node in MULTI_ENTITY_EXCLUDED_TYPES for node in self.nodes])
+
+        # powers[k][u, v] is the number of traversals of length k from u to v
+        self._powers: List[np.ndarray] = [np.eye(len(self.nodes), dtype=np.int64)]
+        # target -> [walks of length 0, 1, ...] where walks[k][u] counts traversals of length k from u into target
+        self._walk_counts: Dict[object, List[np.ndarray]] = {}
+
+        # POS -> adjacency restricted to edges whose predicate type has labels with that POS
+        self._pos_adjacency: Dict[str, np.ndarray] = {}
+        # (POS sequence, target) -> walks, see _chain_walks
+        self._chain_walk_counts: Dict[Tuple[Tuple[str, ...], object], List[np.ndarray]] = {}
+        # (end, backward POS sequence) -> meeting nodes, see _meeting_vector
+        self._meeting_vectors: Dict[Tuple[str, Tuple[str, ...]], np.ndarray] = {}
+
+        # (start, length) -> [(edge labels, end node), ...]
+        self.path_index: Dict[Tuple[str, int], List[Tuple[Tuple[str, ...], str]]] = {}
+        # (start, end, forward length, backward length) -> (forward paths, {meeting node: backward paths})
+        self.bidirectional_index: Dict[Tuple[str, str, int, int], Tuple[list, Dict[str, list]]] = {}
+
+    def matrix_power(self, length: int) -> np.ndarray:
+        """
+        Returns:
+            A^length for the adjacency matrix A of G, entry [u, v] counts the traversals of the given length from
+            node u to node v
+
+        Counts are exact: if they could overflow int64 the powers switch to Python integers.
+        """
+        while len(self._powers) <= length:
+            previous = self._powers[-1]
+            if previous.dtype != object and previous.max() > np.iinfo(np.int64).max // max(len(self.nodes), 1) ** 2:
+                previous = previous.astype(object)
+            self._powers.append(previous @ self.adjacency)
+        return self._powers[length]
+
+    def _walks(self, target, target_vector: np.ndarray, length: int) -> List[np.ndarray]:
+        walks = self._walk_counts.get(target)
+        if walks is None or len(walks) <= length:
+            walks = [self.matrix_power(k) @ target_vector for k in range(length + 1)]
+            self._walk_counts[target] = walks
+        return walks
+
+    def count_paths(self, start: str, length: int, end: str = None) -> int:
+        """
+        Args:
+            start: "person"
+            length: 2
+            end: "country", or None to count traversals ending anywhere
+
+        Returns:
+            the number of traversals of G of the given length from start (to end)
+        """
+        if start not in self.node_index or (end is not None and end not in self.node_index):
+            return 0
+        power = self.matrix_power(length)
+        if end is None:
+            # Summed as Python integers, the row sum can overflow int64 even if every entry fits
+            return int(power[self.node_index[start]].astype(object).sum())
+        return int(power[self.node_index[start], self.node_index[end]])
+
+    def _meeting_counts(self, start: str, end: str, forward_length: int, backward_length: int) -> np.ndarray:
+        """Per meeting node, the number of (forward, backward) traversal pairs of a bidirectional traversal, as an
+        array of Python integers since the products can overflow int64."""
+        if start not in self.node_index or end not in self.node_index:
+            return np.zeros(len(self.nodes), dtype=object)
+        forward = self.matrix_power(forward_length)[self.node_index[start]].astype(object)
+        backward = self.matrix_power(backward_length)[self.node_index[end]].astype(object)
+        return np.where(self.excluded_mask, 0, forward * backward)
+
+    def count_bidirectional_paths(
+        self, start: str, end: str, forward_traversal_length: int, backward_traversal_length: int
+    ) -> int:
+        """Returns the number of bidirectional traversals that generate_bidirectional_pred_traversal enumerates."""
+        return int(self._meeting_counts(start, end, forward_traversal_length, backward_traversal_length).sum())
+
+    def _unrank(self, start: int, length: int, rank: int, walks: List[np.ndarray]) -> Tuple[Tuple[str, ...], str]:
+        """
+        Returns:
+            the rank-th traversal (in enumeration order) of the given length from start among those counted by walks
+        """
+        labels = []
+        node = start
+        for remaining in range(length - 1, -1, -1):
+            for neighbor in self.neighbors[node]:
+                count = walks[remaining][neighbor]
+                if rank < count:
+                    break
+                rank -= count
+            labels.append(self.edge_labels[(node, neighbor)])
+            node = neighbor
+        return tuple(labels), self.nodes[node]
+
+    def build_index(self, starts: List[str], max_length: int) -> None:
+        """Enumerates and stores every path of up to max_length steps from the given start nodes."""
+        for start in starts:
+            for length in range(max_length + 1):
+                self.get_paths(start, length)
+
+    def get_paths(self, start: str, length: int) -> List[Tuple[Tuple[str, ...], str]]:
+        """
+        Args:
+            start: "person"
+            length: 2
+
+        Returns:
+            every traversal of G of the given length from start and the node it ends on, in the same order as
+            generate_unidirectional_pred_traversal
+            [(('person->person', 'person->country'), 'country'), ...]
+
+        Paths are built from the (memoized) paths of the start node's neighbors, so each (node, length) is only
+        enumerated once. The number of paths grows exponentially with length, use count_paths and
+        sample_unidirectional_path unless the full listing is needed.
+        """
+        key = (start, length)
+        paths = self.path_index.get(key)
+        if paths is None:
+            if length == 0:
+                paths = [((), start)]
+            else:
+                paths = []
+                for neighbor in self.neighbors[self.node_index[start]] if start in self.node_index else []:
+                    label = self.edge_labels[(self.node_index[start], neighbor)]
+                    paths.extend(
+                        ((label,) + labels, end) for labels, end in self.get_paths(self.nodes[neighbor], length - 1)
+                    )
+            self.path_index[key] = paths
+        return paths
+
+    def get_bidirectional_paths(
+        self, start: str, end: str, forward_traversal_length: int, backward_traversal_length: int
+    ) -> Tuple[list, Dict[str, list]]:
+        """
+        Args:
+            start: 'person'
+            end: 'movie'
+            forward_traversal_length: 2
+            backward_traversal_length: 1
+
+        Returns:
+            the forward paths from start that can be joined with a backward path to end, and the backward paths
+            (traversals of G from end, in G's edge direction) grouped by the node they meet the forward path on
+
+        Forward paths are only kept if they end on a node outside MULTI_ENTITY_EXCLUDED_TYPES that some backward
+        path also reaches, so every one of them completes a bidirectional traversal.
+        """
+        key = (start, end, forward_traversal_length, backward_traversal_length)
+        join = self.bidirectional_index.get(key)
+        if join is None:
+            backward_paths = {}
+            for labels, node in self.get_paths(end, backward_traversal_length):
+                if node not in MULTI_ENTITY_EXCLUDED_TYPES:
+                    backward_paths.setdefault(node, []).append(labels)
+            forward_paths = [
+                (labels, node)
+                for labels, node in self.get_paths(start, forward_traversal_length)
+                if node in backward_paths
+            ]
+            join = (forward_paths, backward_paths)
+            self.bidirectional_index[key] = join
+        return join
+
+    def sample_unidirectional_path(self, start: str, length: int) -> Optional[Tuple[Tuple[str, ...], str]]:
+        """
+        Returns:
+            a uniformly sampled (edge labels, end node) of a traversal from start, or None if there is none
+
+        The traversal is unranked from path counts without enumerating the paths, and is the same one
+        random.choice(get_paths(start, length)) would pick from the same RNG state.
+        """
+        total = self.count_paths(start, length)
+        if total == 0:
+            return None
+        walks = self._walks(None, np.ones(len(self.nodes), dtype=np.int64), length)
+        return self._unrank(self.node_index[start], length, self.rng.randrange(total), walks)
+
+    def sample_bidirectional_path(
+        self, start: str, end: str, forward_traversal_length: int, backward_traversal_length: int
+    ) -> Optional[Tuple[Tuple[str, ...], Tuple[str, ...]]]:
+        """
+        Returns:
+            the edge labels of a forward traversal from start and of a traversal from end that meet on the same
+            node, or None if there is none
+
+        As with generate_bidirectional_pred_traversal, the forward traversal is drawn uniformly from those that can
+        be completed and the backward traversal uniformly from those that complete it. Both are unranked from
+        path counts like in sample_unidirectional_path.
+        """
+        if self.count_bidirectional_paths(start, end, forward_traversal_length, backward_traversal_length) == 0:
+            return None
+        # Forward traversals are counted into the nodes that a backward traversal from end can meet them on
+        end_index = self.node_index[end]
+        meetings = (self.matrix_power(backward_traversal_length)[end_index] > 0) & ~self.excluded_mask
+        forward_walks = self._walks(
+            (end, backward_traversal_length), meetings.astype(np.int64), forward_traversal_length
+        )
+        start_index = self.node_index[start]
+        rank = self.rng.randrange(int(forward_walks[forward_traversal_length][start_index]))
+        forward_labels, node = self._unrank(start_index, forward_traversal_length, rank, forward_walks)
+
+        node_index = self.node_index[node]
+        backward_walks = [self.matrix_power(k)[:, node_index] for k in range(backward_traversal_length + 1)]
+        rank = self.rng.randrange(int(backward_walks[backward_traversal_length][end_index]))
+        backward_labels, _ = self._unrank(end_index, backward_traversal_length, rank, backward_walks)
+        return forward_labels, backward_labels
+
+    def pos_adjacency(self, pos: str) -> np.ndarray:
+        """
+        Returns:
+            the adjacency matrix of G restricted to the edges whose predicate type has at least one label with the
+            given POS, i.e. the steps of a traversal that a [pos] slot can be filled for
+        """
+        adjacency = self._pos_adjacency.get(pos)
+        if adjacency is None:
+            adjacency = np.zeros_like(self.adjacency)
+            for (u, v), label in self.edge_labels.items():
+                if self.predicate_bank.predicate_index.get((label, pos)):
+                    adjacency[u, v] = 1
+            self._pos_adjacency[pos] = adjacency
+        return adjacency
+
+    def _chain_walks(self, pos_sequence: Tuple[str, ...], target, target_vector: np.ndarray) -> List[np.ndarray]:
+        """
+        Returns:
+            walks where walks[i][u] counts the fillable traversals that take steps i, i + 1, ... of pos_sequence from
+            node u and end on target_vector (walks[len(pos_sequence)] is target_vector itself)
+        """
+        key = (pos_sequence, target)
+        walks = self._chain_walk_counts.get(key)
+        if walks is None:
+            walks = [target_vector]
+            for pos in reversed(pos_sequence):
+                vector = walks[0]
+                if vector.dtype != object and vector.max(initial=0) > np.iinfo(np.int64).max // max(len(self.nodes), 1):
+                    vector = vector.astype(object)
+                walks.insert(0, self.pos_adjacency(pos) @ vector)
+            self._chain_walk_counts[key] = walks
+        return walks
+
+    def _unrank_chain(
+        self, start: int, pos_sequence: Tuple[str, ...], rank: int, walks: List[np.ndarray]
+    ) -> Tuple[Tuple[str, ...], str]:
+        """Like _unrank, but only over the steps pos_adjacency allows for each POS of pos_sequence."""
+        labels = []
+        node = start
+        for i, pos in enumerate(pos_sequence):
+            adjacency = self.pos_adjacency(pos)
+            for neighbor in self.neighbors[node]:
+                if not adjacency[node, neighbor]:
+                    continue
+                count = walks[i + 1][neighbor]
+                if rank < count:
+                    break
+                rank -= count
+            labels.append(self.edge_labels[(node, neighbor)])
+            node = neighbor
+        return tuple(labels), self.nodes[node]
+
+    def _meeting_vector(self, end: str, backward_pos: Tuple[str, ...]) -> np.ndarray:
+        """Per node, whether a fillable traversal with backward_pos from end reaches it and it may be met on."""
+        key = (end, backward_pos)
+        meetings = self._meeting_vectors.get(key)
+        if meetings is None:
+            end_index = self.node_index[end]
+            meetings = np.zeros(len(self.nodes), dtype=np.int64)
+            for node in range(len(self.nodes)):
+                target = np.eye(1, len(self.nodes), node, dtype=np.int64)[0]
+                walks = self._chain_walks(backward_pos, ("node", node), target)
+                meetings[node] = walks[0][end_index] > 0 and not self.excluded_mask[node]
+            self._meeting_vectors[key] = meetings
+        return meetings
+
+    def count_chain_paths(self, start: str, pos_sequence: Tuple[str, ...]) -> int:
+        """
+        Args:
+            start: "person"
+            pos_sequence: ("NOUN", "VERB-ADP"), the POS of the predicate slots of a chain in numbered order
+
+        Returns:
+            the number of traversals from start whose every step has a predicate with the POS of its slot
+        """
+        if start not in self.node_index:
+            return 0
+        walks = self._chain_walks(pos_sequence, None, np.ones(len(self.nodes), dtype=np.int64))
+        return int(walks[0][self.node_index[start]])
+
+    def count_bidirectional_chain_paths(
+        self, start: str, end: str, forward_pos: Tuple[str, ...], backward_pos: Tuple[str, ...]
+    ) -> int:
+        """Like count_bidirectional_paths, but only counts the traversals whose steps fit the slots' POS."""
+        if start not in self.node_index or end not in self.node_index:
+            return 0
+        end_index = self.node_index[end]
+        total = 0
+        for node in np.flatnonzero(self._meeting_vector(end, backward_pos)).tolist():
+            target = np.eye(1, len(self.nodes), node, dtype=np.int64)[0]
+            forward = self._chain_walks(forward_pos, ("node", node), target)[0][self.node_index[start]]
+            backward = self._chain_walks(backward_pos, ("node", node), target)[0][end_index]
+            total += int(forward) * int(backward)
+        return total
+
+    def sample_chain_path(self, start: str, pos_sequence: Tuple[str, ...]) -> Optional[Tuple[Tuple[str, ...], str]]:
+        """
+        Returns:
+            a uniformly sampled (edge labels, end node) among the traversals counted by count_chain_paths, or None if
+            there is none
+        """
+        total = self.count_chain_paths(start, pos_sequence)
+        if total == 0:
+            return None
+        walks = self._chain_walks(pos_sequence, None, np.ones(len(self.nodes), dtype=np.int64))
+        return self._unrank_chain(self.node_index[start], pos_sequence, self.rng.randrange(total), walks)
+
+    def sample_bidirectional_chain_path(
+        self, start: str, end: str, forward_pos: Tuple[str, ...], backward_pos: Tuple[str, ...]
+    ) -> Optional[Tuple[Tuple[str, ...], Tuple[str, ...]]]:
+        """
+        Returns:
+            like sample_bidirectional_path, the edge labels of a forward and a backward traversal that meet on the
+            same node, restricted to the traversals counted by count_bidirectional_chain_paths, or None if there is
+            none
+        """
+        if start not in self.node_index or end not in self.node_index:
+            return None
+        meetings = self._meeting_vector(end, backward_pos)
+        forward_walks = self._chain_walks(forward_pos, ("meet", end, backward_pos), meetings)
+        start_index = self.node_index[start]
+        total = int(forward_walks[0][start_index])
+        if total == 0:
+            return None
+        forward_labels, node = self._unrank_chain(start_index, forward_pos, self.rng.randrange(total), forward_walks)
+
+        node_index = self.node_index[node]
+        target = np.eye(1, len(self.nodes), node_index, dtype=np.int64)[0]
+        backward_walks = self._chain_walks(backward_pos, ("node", node_index), target)
+        end_index = self.node_index[end]
+        rank = self.rng.randrange(int(backward_walks[0][end_index]))
+        backward_labels, _ = self._unrank_chain(end_index, backward_pos, rank, backward_walks)
+        return forward_labels, backward_labels
+
     def generate_unidirectional_pred_traversal(
         self, graph: nx.DiGraph, node: str, steps: int, init: bool = True
     ) -> List[Tuple[List[str], str]]:
@@ -90,7 +459,7 @@ class TypeGenerator(object):
             A bidirectional traversal with the given start and end points and traversal lengths
         """
         forward_traversals = self.generate_unidirectional_pred_traversal(graph, start, forward_traversal_length)
-        random.shuffle(forward_traversals)
+        self.rng.shuffle(forward_traversals)
 
         all_paths = None
 
@@ -99,22 +468,12 @@ class TypeGenerator(object):
 
         for forward_traversal in forward_traversals:
             # We exclude some thing types for the Multi-Entity query
-            if forward_traversal[1] in [
-                "text",
-                "id",
-                "thing",
-                "image",
-                "television_series",
-                "literary_work",
-                "movie",
-                "url",
-                "rating",
-            ]:
+            if forward_traversal[1] in MULTI_ENTITY_EXCLUDED_TYPES:
                 continue
             backward_traversals = self.generate_unidirectional_pred_traversal(
                 anti_graph, forward_traversal[1], backward_traversal_length
             )
-            random.shuffle(backward_traversals)
+            self.rng.shuffle(backward_traversals)
             for backward_traversal in backward_traversals:
                 if backward_traversal[1] == end:
                     backward_traversal[0].reverse()
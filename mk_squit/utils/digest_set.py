@@ -0,0 +1,101 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import math
+import hashlib
+from array import array
+from typing import Tuple
+
+DEDUP_KEYS = ["sparql", "pair"]
+
+
+def query_digest(query: Tuple[str, str, str], key: str = "sparql") -> int:
+    """
+    Args:
+        query: (english, sparql, unique hash) as returned by TemplateFiller.fill_query
+        key: "sparql" to dedupe on the query alone (its unique hash), "pair" to dedupe on english and sparql
+
+    Returns:
+        the first 8 bytes of the SHA-1 digest of the key as an integer
+    """
+    if key == "sparql":
+        return int(query[2][:16], 16)
+    if key == "pair":
+        return int.from_bytes(hashlib.sha1(f"{query[0]}\t{query[1]}".encode("utf-8")).digest()[:8], "big")
+    raise ValueError(f"Unknown dedup key {key}, expected one of {DEDUP_KEYS}.")
+
+
+class DigestSet(object):
+    """Set of 8-byte digests stored in an open-addressing table (8 bytes per slot) that doubles when half full.
+
+    Much smaller than a Python set of hex strings. Distinct queries only collide if the first 64 bits of their SHA-1
+    digests match, which is negligible for the dataset sizes we generate.
+    """
+
+    def __init__(self, capacity: int = 1 << 20):
+        """
+        Args:
+            capacity: the expected number of digests, the table grows beyond it
+        """
+        size = 1 << max(4, math.ceil(math.log2(max(capacity, 1) * 2)))
+        # Repeating a one-slot array allocates the table without a temporary of the same size
+        self._table = array("Q", [0]) * size
+        self._mask = size - 1
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, digest: int) -> bool:
+        """Adds a digest and returns whether it was new."""
+        digest = digest or 1  # 0 marks an empty slot
+        table, mask = self._table, self._mask
+        i = digest & mask
+        while table[i]:
+            if table[i] == digest:
+                return False
+            i = (i + 1) & mask
+        table[i] = digest
+        self._len += 1
+        if self._len * 2 > len(table):
+            self._grow()
+        return True
+
+    def _grow(self) -> None:
+        old_table = self._table
+        self._table = array("Q", [0]) * (2 * len(old_table))
+        self._mask = len(self._table) - 1
+        self._len = 0
+        for digest in old_table:
+            if digest:
+                self.add(digest)
+
+
+class BloomFilter(object):
+    """Fixed-size Bloom filter over 8-byte digests.
+
+    Uses a fraction of the memory of DigestSet but with probability error_rate a new digest is reported as seen,
+    i.e. a unique query is dropped as a duplicate.
+    """
+
+    def __init__(self, capacity: int = 1 << 20, error_rate: float = 1e-4):
+        self._num_bits = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._num_hashes = max(1, round(self._num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, digest: int) -> bool:
+        """Adds a digest and returns whether it was (probably) new."""
+        # Double hashing with the two 32-bit halves of the digest
+        h1, h2 = digest >> 32, (digest & 0xFFFFFFFF) | 1
+        new = False
+        for i in range(self._num_hashes):
+            bit = (h1 + i * h2) % self._num_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self._bits[byte] & mask:
+                self._bits[byte] |= mask
+                new = True
+        self._len += new
+        return new
@@ -2,12 +2,13 @@
 
 import os
 import re
-import json
 from typing import Dict, Tuple
 
 from rapidfuzz import fuzz, process
 from glob import glob
 
+from mk_squit.generation.entity_store import load_entity_table
+
 
 def url_to_qvalue(url: str) -> str:
     """Get q value from Wikidata url.
@@ -16,23 +17,18 @@ def url_to_qvalue(url: str) -> str:
     return url.split("/")[-1]
 
 
-def load_entities(data_dir: str) -> Dict:
-    """Load entity data."""
+def load_entities(data_dir: str, use_snapshot: bool = True) -> Dict:
+    """Load entity data, from the same snapshots as the PredicateBank unless use_snapshot is False."""
     assert os.path.isdir(data_dir), f"{data_dir} is not a valid directory."
     fps = glob(os.path.join(data_dir, "*-5k-preprocessed.json"))
-    data = []
-    for fp in fps:
-        with open(fp, "r") as f:
-            file_data = json.load(f)
-            data.extend(file_data)
-    assert data, f"No data was found, please check {data_dir}."
+    tables = [load_entity_table(fp, use_snapshot=use_snapshot) for fp in fps]
+    assert any(len(table) for table in tables), f"No data was found, please check {data_dir}."
 
     # expand data
     expanded_data = dict()
-    for item in data:
-        qvalue = url_to_qvalue(item["thing"])
-        for label in item["labels"]:
-            expanded_data[label] = qvalue
+    for table in tables:
+        for label, owner in zip(table.labels, table.owners.tolist()):
+            expanded_data[label] = table.keys[owner]
 
     return expanded_data
 
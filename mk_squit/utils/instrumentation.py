@@ -0,0 +1,192 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Stages whose keys are template types, their times add up to the time spent per template type
+TEMPLATE_STAGES = ["type_template", "fill_query"]
+
+
+class _Timed(object):
+    """Replaces a method on an instance, timing every call and counting it as a failure if it returns None."""
+
+    def __init__(
+        self, instrumentation: "Instrumentation", obj, name: str, stage: str, reason: str, key_arg: Optional[int]
+    ):
+        self.instrumentation = instrumentation
+        self.obj = obj
+        self.function = getattr(type(obj), name)
+        self.stage = stage
+        self.reason = reason
+        self.key_arg = key_arg
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = self.function(self.obj, *args, **kwargs)
+        key = "all" if self.key_arg is None else str(args[self.key_arg])
+        self.instrumentation.record(
+            self.stage, key, time.perf_counter() - start, None if result is not None else self.reason
+        )
+        return result
+
+
+class Instrumentation(object):
+    """Per-stage counters of a generation run:
+        attempts, successes, cumulative seconds and failures by reason per (stage, key)
+
+    Methods are instrumented by replacing them on the instance (see instrument), so objects that are never
+    instrumented run their plain methods without any overhead. Counters of worker processes are collected with
+    take and added up with merge.
+    """
+
+    def __init__(self):
+        # (stage, key) -> [attempts, successes, seconds]
+        self.stages: Dict[Tuple[str, str], List] = {}
+        # (stage, key, reason) -> count
+        self.failures: Dict[Tuple[str, str, str], int] = {}
+
+    def instrument(self, obj, name: str, stage: str, reason: str = "none", key_arg: Optional[int] = None) -> None:
+        """
+        Args:
+            obj: object whose method to instrument, e.g. a TemplateFiller
+            name: "fill_query"
+            stage: name the calls are recorded under
+            reason: failure reason recorded when the method returns None
+            key_arg: index of the positional argument to break the stage down by, e.g. 0 for the template type
+        """
+        setattr(obj, name, _Timed(self, obj, name, stage, reason, key_arg))
+
+    @staticmethod
+    def uninstrument(obj) -> None:
+        """Restores the plain methods of an instrumented object, e.g. of a copy that gets its own instrumentation."""
+        for name, value in list(vars(obj).items()):
+            if isinstance(value, _Timed):
+                delattr(obj, name)
+
+    def record(self, stage: str, key: str, seconds: float, failure: Optional[str] = None) -> None:
+        """Records one attempt of a stage, successful unless a failure reason is given."""
+        entry = self.stages.get((stage, key))
+        if entry is None:
+            entry = self.stages[(stage, key)] = [0, 0, 0.0]
+        entry[0] += 1
+        entry[2] += seconds
+        if failure is None:
+            entry[1] += 1
+        else:
+            self.failures[(stage, key, failure)] = self.failures.get((stage, key, failure), 0) + 1
+
+    def add(self, stage: str, key: str, attempts: int, successes: int, reason: str = "none") -> None:
+        """Records a batch of untimed attempts, e.g. rows of which attempts - successes were dropped as duplicates."""
+        entry = self.stages.get((stage, key))
+        if entry is None:
+            entry = self.stages[(stage, key)] = [0, 0, 0.0]
+        entry[0] += attempts
+        entry[1] += successes
+        if attempts > successes:
+            self.failures[(stage, key, reason)] = self.failures.get((stage, key, reason), 0) + attempts - successes
+
+    def take(self) -> Dict:
+        """Returns the counters recorded so far and resets them."""
+        state = {"stages": self.stages, "failures": self.failures}
+        self.reset()
+        return state
+
+    def reset(self) -> None:
+        self.stages = {}
+        self.failures = {}
+
+    def merge(self, state: Dict) -> None:
+        """Adds counters returned by take (e.g. in a worker process)."""
+        for key, (attempts, successes, seconds) in state["stages"].items():
+            entry = self.stages.get(key)
+            if entry is None:
+                entry = self.stages[key] = [0, 0, 0.0]
+            entry[0] += attempts
+            entry[1] += successes
+            entry[2] += seconds
+        for key, count in state["failures"].items():
+            self.failures[key] = self.failures.get(key, 0) + count
+
+    def summary(self, run: Dict = None) -> Dict:
+        """
+        Args:
+            run: totals of the run, e.g. {"rows_written": 100000, "seconds": 60.0}
+
+        Returns:
+            the counters per stage and key, and rows per second per template type
+
+        Rows per second of a template type are its successful fills divided by the time spent typing and filling
+        templates of that type, summed over all worker processes.
+        """
+        stages = dict()
+        for (stage, key), (attempts, successes, seconds) in sorted(self.stages.items()):
+            stages.setdefault(stage, {})[key] = {
+                "attempts": attempts,
+                "successes": successes,
+                "seconds": seconds,
+                "failures": {
+                    reason: count for (s, k, reason), count in sorted(self.failures.items()) if (s, k) == (stage, key)
+                },
+            }
+
+        template_types = dict()
+        for key, entry in stages.get(TEMPLATE_STAGES[-1], {}).items():
+            seconds = sum(stages.get(stage, {}).get(key, {}).get("seconds", 0.0) for stage in TEMPLATE_STAGES)
+            template_types[key] = {
+                "rows": entry["successes"],
+                "seconds": seconds,
+                "rows_per_second": entry["successes"] / seconds if seconds else 0.0,
+            }
+
+        summary = {"stages": stages, "template_types": template_types}
+        if run is not None:
+            summary["run"] = run
+        return summary
+
+    def to_prometheus(self, run: Dict = None, prefix: str = "mk_squit_generation") -> str:
+        """Returns the summary in the Prometheus text exposition format, for node_exporter's textfile collector."""
+        summary = self.summary(run)
+        metrics = [
+            ("stage_attempts_total", "counter", "Calls of a pipeline stage."),
+            ("stage_successes_total", "counter", "Calls of a pipeline stage that produced a result."),
+            ("stage_seconds_total", "counter", "Time spent in a pipeline stage."),
+        ]
+        lines = []
+        for name, metric_type, help_text in metrics:
+            field = name.split("_")[1]
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for stage, keys in summary["stages"].items():
+                for key, entry in keys.items():
+                    lines.append(f'{prefix}_{name}{{stage="{stage}",key="{key}"}} {entry[field]}')
+
+        lines.append(f"# HELP {prefix}_stage_failures_total Calls of a pipeline stage that failed, by reason.")
+        lines.append(f"# TYPE {prefix}_stage_failures_total counter")
+        for stage, keys in summary["stages"].items():
+            for key, entry in keys.items():
+                for reason, count in entry["failures"].items():
+                    lines.append(
+                        f'{prefix}_stage_failures_total{{stage="{stage}",key="{key}",reason="{reason}"}} {count}'
+                    )
+
+        lines.append(f"# HELP {prefix}_rows_per_second Rows generated per second of typing and filling.")
+        lines.append(f"# TYPE {prefix}_rows_per_second gauge")
+        for key, entry in summary["template_types"].items():
+            lines.append(f'{prefix}_rows_per_second{{template_type="{key}"}} {entry["rows_per_second"]}')
+
+        for name, value in (run or {}).items():
+            lines.append(f"# TYPE {prefix}_run_{name} gauge")
+            lines.append(f"{prefix}_run_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str, run: Dict = None) -> None:
+        """Writes the summary to path + ".json" and path + ".prom", each replaced atomically."""
+        for extension, text in [
+            (".json", json.dumps(self.summary(run), indent=4)),
+            (".prom", self.to_prometheus(run)),
+        ]:
+            with open(path + extension + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(path + extension + ".tmp", path + extension)
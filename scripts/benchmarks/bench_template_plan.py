@@ -0,0 +1,190 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+"""Benchmark compiled template plans against the regex search/replace implementation they replaced."""
+import re
+import sys
+import time
+import random
+import hashlib
+from pathlib import Path
+from typing import Callable, List
+
+import typer
+
+sys.path.append(str(Path(__file__).absolute().parent.parent.parent))
+from mk_squit.generation.predicate_bank import PredicateBank
+from mk_squit.generation.template_filler import TemplateFiller
+from mk_squit.generation.template_generator import TemplateGenerator
+from mk_squit.generation.template_plan import compile_template
+from mk_squit.generation.type_generator import TypeGenerator
+
+
+def legacy_number_single_ent(text_template: str, suffix: str = "A") -> (str, List[int]):
+    """TemplateGenerator.number_single_ent before template plans."""
+    text_template = text_template.replace("[THING]", f"[THING:{suffix}]")
+    thing_ind = text_template.find(f"[THING:{suffix}]")
+    new_template = ""
+    counter = 0
+
+    for i in range(thing_ind, len(text_template)):
+        new_template += text_template[i]
+        if new_template[-5:] == "[NOUN":
+            new_template += f":{suffix}:{counter}"
+            counter += 1
+    for i in range(thing_ind - 1, -1, -1):
+        if new_template[:6] == "[NOUN]":
+            new_template = new_template[:5] + f":{suffix}:{counter}]" + new_template[6:]
+            counter += 1
+        new_template = text_template[i] + new_template
+
+    if new_template.find("[VERB-ADP]") != -1:
+        new_template = new_template.replace("[VERB-ADP]", f"[VERB-ADP:{suffix}:{counter}]")
+        counter += 1
+    return new_template, [counter]
+
+
+def legacy_type(number_template: str, thing_samples: List[str], paths: List[List[str]], wh: str) -> str:
+    """The string rewriting part of TemplateGenerator.type_template before template plans."""
+    suffixes = ["A", "B"]
+    if wh is not None:
+        number_template = number_template.replace("[WH]", wh)
+    pred_pattern = r"\[\w+-?\w+:"  # Matches [NOUN:
+    for i in range(len(thing_samples)):
+        number_template = number_template.replace(f"[THING:{suffixes[i]}]", f"[{thing_samples[i]}:{suffixes[i]}]")
+        path = paths[i]
+        for j in range(len(path)):
+            match = re.search(f"{pred_pattern}{suffixes[i]}:{j}]", number_template)
+            number_template = number_template.replace(match.group(), "[" + path[j] + ":" + match.group()[1:])
+    return number_template
+
+
+def legacy_construct_query_pair(
+    predicate_bank: PredicateBank, typed_template: str, pred_chain_lengths: List[int], sparql_template: str
+) -> (str, str, str):
+    """TemplateFiller.construct_query_pair before template plans."""
+    suffixes = ["A", "B"]
+    statements = []
+
+    thing_pattern = r"\[\w+:"  # Matches [television_series:
+    pred_pattern = r"\[\w+->\w+:\w+-?\w+:"  # Matches [person->weight:NOUN:
+
+    for i in range(len(pred_chain_lengths)):
+        thing_match = re.search(f"{thing_pattern}{suffixes[i]}]", typed_template)
+        thing = predicate_bank.get_thing(thing_match.group().split(":")[0][1:])
+        typed_template = typed_template.replace(thing_match.group(), thing)
+        statement = f"[ {thing} ]"
+
+        if pred_chain_lengths[i] == 0:
+            statement = f"BIND ( [ {thing} ] as ?end ) ."
+            statements.append(statement)
+            continue
+
+        for j in range(pred_chain_lengths[i]):
+            pred_match = re.search(f"{pred_pattern}{suffixes[i]}:{j}]", typed_template)
+            pred_info = pred_match.group().split(":")
+            pred = predicate_bank.get_predicate(pred_info[0][1:], pred_info[1])
+            if pred is None:
+                return None
+
+            prop_label, prop_wdt = pred
+            typed_template = typed_template.replace(pred_match.group(), prop_label)
+
+            if j == 0:
+                statement = statement + f" wdt:{prop_wdt}"
+            else:
+                statement = statement + f" / wdt:{prop_wdt}"
+        statement = statement + " ?end ."
+        statements.append(statement)
+
+    typed_template = typed_template.replace(" 's", "'s")
+    typed_template = typed_template.replace(" ?", "?")
+
+    query = sparql_template.replace("[CLAUSES]", " ".join(statements))
+    unique_hex_dig = hashlib.sha1(query.encode("utf-8")).hexdigest()
+    return typed_template, query, str(unique_hex_dig)
+
+
+def timed(function: Callable, repeat: int) -> (float, list):
+    start = time.perf_counter()
+    outputs = None
+    for _ in range(repeat):
+        outputs = function()
+    return (time.perf_counter() - start) / repeat, outputs
+
+
+def report(stage: str, legacy_seconds: float, plan_seconds: float, num_items: int) -> None:
+    print(
+        f"{stage:<10} legacy: {legacy_seconds / num_items * 1e6:8.2f} us/item | "
+        f"plan: {plan_seconds / num_items * 1e6:8.2f} us/item | speedup: {legacy_seconds / plan_seconds:5.2f}x"
+    )
+
+
+def main(data_dir: str = "./data", num_queries: int = 20000, repeat: int = 3, seed: int = 0):
+    """Compares numbering, typing and filling with template plans against the legacy regex implementation.
+
+    python -m scripts.benchmarks.bench_template_plan --data-dir ./data --num-queries 20000
+
+    Args:
+        data_dir: Data directory containing generation source files.
+        num_queries: Number of typed templates to type and fill.
+        repeat: Number of timed repetitions, the mean is reported.
+        seed: Seed for sampling typed templates and fills.
+    """
+    rng = random.Random(seed)
+    pb = PredicateBank(data_dir=data_dir, rng=rng)
+    gen = TemplateGenerator(type_generator=TypeGenerator(pb), predicate_bank=pb)
+    filler = TemplateFiller(pb)
+
+    # Numbering
+    base_templates = [template for key in ["single_entity", "count"] for template in gen.base_templates[key]]
+    legacy_seconds, legacy_out = timed(lambda: [legacy_number_single_ent(t) for t in base_templates], repeat)
+    plan_seconds, plan_out = timed(lambda: [gen.number_single_ent(t) for t in base_templates], repeat)
+    assert legacy_out == plan_out, "Numbered templates differ"
+    report("numbering", legacy_seconds, plan_seconds, len(base_templates))
+
+    # Typing: sample the path choices once, then time only the template rewriting
+    samples = []
+    keys = list(gen.templates.keys())
+    while len(samples) < num_queries:
+        key = keys[len(samples) % len(keys)]
+        number_template, lengths = rng.choice(gen.templates[key])
+        typed = gen.type_template(number_template, lengths)
+        if typed is None:
+            continue
+        plan = compile_template(typed[0])
+        things = [plan.thing_slots[s][1] for s in sorted(plan.thing_slots)]
+        paths = [[pred_type for _, pred_type, _ in plan.pred_slots.get(s, [])] for s in sorted(plan.thing_slots)]
+        wh = None
+        if compile_template(number_template).wh_slot is not None:
+            wh = pb.get_wh_word(paths[0][-1].split("->")[1] if paths[0] else things[0])[0]
+        samples.append((key, number_template, lengths, things, paths, wh, typed[0]))
+
+    compile_template.cache_clear()
+    legacy_seconds, legacy_out = timed(lambda: [legacy_type(s[1], s[3], s[4], s[5]) for s in samples], repeat)
+    plan_seconds, plan_out = timed(lambda: [compile_template(s[1]).type(s[3], s[4], s[5]) for s in samples], repeat)
+    assert legacy_out == plan_out == [s[6] for s in samples], "Typed templates differ"
+    report("typing", legacy_seconds, plan_seconds, len(samples))
+
+    # Filling, with identical RNG streams
+    sparql_templates = {
+        "single_entity": "SELECT ?end WHERE { [CLAUSES] }",
+        "multi_entity": "ASK { [CLAUSES] }",
+        "count": "SELECT ( COUNT ( DISTINCT ?end ) as ?endcount ) WHERE { [CLAUSES] }",
+    }
+
+    def legacy_fill():
+        rng.seed(seed)
+        return [legacy_construct_query_pair(pb, s[6], s[2], sparql_templates[s[0]]) for s in samples]
+
+    def plan_fill():
+        rng.seed(seed)
+        return [filler.fill_query(s[0], s[6], s[2]) for s in samples]
+
+    legacy_seconds, legacy_out = timed(legacy_fill, repeat)
+    plan_seconds, plan_out = timed(plan_fill, repeat)
+    assert legacy_out == plan_out, "Filled queries differ"
+    report("filling", legacy_seconds, plan_seconds, len(samples))
+
+
+if __name__ == "__main__":
+    typer.run(main)
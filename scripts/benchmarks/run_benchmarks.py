@@ -0,0 +1,370 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+"""Benchmark every stage of the pipeline on synthetic data of increasing size and compare against a baseline."""
+import os
+import sys
+import json
+import time
+import warnings
+import platform
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import typer
+
+sys.path.append(str(Path(__file__).absolute().parent.parent.parent))
+from mk_squit.generation.full_query_generator import FullQueryGenerator
+from mk_squit.generation.predicate_bank import PredicateBank
+from mk_squit.generation.template_filler import TemplateFiller
+from mk_squit.generation.template_generator import TemplateGenerator
+from mk_squit.generation.type_generator import TypeGenerator
+from mk_squit.utils.entity_resolver import EntityResolver
+from mk_squit.utils.metrics import Metrics
+from scripts.benchmarks.synthetic_data import BASE_DENSITY, generate_synthetic_data
+
+# A benchmark prepares its inputs (untimed) and returns the function to time and the number of operations per call
+Benchmark = Callable[[Dict], Tuple[Callable[[], object], int]]
+# The number of rows fill_query_batch fills from one typed template, like generate --fills-per-template
+FILLS_PER_TEMPLATE = 8
+
+
+def bench_predicate_bank_load(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Parses the props files and every entity file, without snapshots."""
+
+    def run():
+        pb = PredicateBank(data_dir=context["data_dir"], use_snapshot=False)
+        return [pb.thing_tables[domain] for domain in pb.thing_tables]
+
+    return run, 1
+
+
+def bench_predicate_bank_load_snapshot(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Maps the props and every entity table from snapshots, which the untimed first load builds."""
+
+    def run():
+        pb = PredicateBank(data_dir=context["data_dir"])
+        return [pb.thing_tables[domain] for domain in pb.thing_tables]
+
+    run()
+    return run, 1
+
+
+def bench_type_traversals(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Enumerates the traversals of length 1 to 3 from every start domain with the networkx graph."""
+    type_gen = context["type_generator"]
+    starts = type_gen.predicate_bank.type_list["start_domains"]
+
+    def run():
+        return [type_gen.generate_unidirectional_pred_traversal(type_gen.G, s, n) for s in starts for n in (1, 2, 3)]
+
+    return run, 3 * len(starts)
+
+
+def bench_type_paths(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Samples unidirectional and bidirectional traversals from the path counts."""
+    type_gen = context["type_generator"]
+    starts = type_gen.predicate_bank.type_list["start_domains"]
+    num_samples = context["num_samples"]
+
+    def run():
+        type_gen.rng.seed(0)
+        for i in range(num_samples):
+            start = starts[i % len(starts)]
+            type_gen.sample_unidirectional_path(start, 1 + i % 3)
+            type_gen.sample_bidirectional_path(start, starts[(i // len(starts)) % len(starts)], 1 + i % 2, 1)
+
+    return run, 2 * num_samples
+
+
+def bench_template_generator_init(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Builds the template sequences and the feasibility tables, without the template cache."""
+    pb = context["predicate_bank"]
+    return lambda: TemplateGenerator(type_generator=TypeGenerator(pb, rng=pb.rng), predicate_bank=pb), 1
+
+
+def bench_type_template(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Types numbered templates with independently sampled types and paths."""
+    template_gen = context["template_generator"]
+    num_samples = context["num_samples"]
+    keys = list(template_gen.templates.keys())
+    templates = [template_gen.sample_template(keys[i % len(keys)]) for i in range(num_samples)]
+
+    def run():
+        template_gen.rng.seed(0)
+        return [template_gen.type_template(*template) for template in templates]
+
+    return run, num_samples
+
+
+def bench_sample_typed_template(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Draws fillable typed templates of every type."""
+    template_gen = context["template_generator"]
+    num_samples = context["num_samples"]
+    keys = list(template_gen.templates.keys())
+
+    def run():
+        template_gen.rng.seed(0)
+        return [template_gen.sample_typed_template(keys[i % len(keys)]) for i in range(num_samples)]
+
+    return run, num_samples
+
+
+def bench_fill_query(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Fills typed templates with entities and predicate labels."""
+    filler = context["template_filler"]
+    typed_templates = context["typed_templates"]
+
+    def run():
+        filler.predicate_bank.rng.seed(0)
+        return [filler.fill_query(key, *typed) for key, typed in typed_templates]
+
+    return run, len(typed_templates)
+
+
+def bench_fill_query_batch(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Fills every typed template FILLS_PER_TEMPLATE times with one batched draw, one op per filled row."""
+    filler = context["template_filler"]
+    typed_templates = context["typed_templates"]
+
+    def run():
+        filler.predicate_bank.rng.seed(0)
+        return [filler.fill_query_batch(key, *typed, FILLS_PER_TEMPLATE) for key, typed in typed_templates]
+
+    return run, len(typed_templates) * FILLS_PER_TEMPLATE
+
+
+def bench_generate_queries(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Generates queries end-to-end into a TSV file on a single process, one op per iteration."""
+    generator = context["query_generator"]
+    num_iterations = context["num_iterations"]
+    out_file = os.path.join(context["tmp_dir"], "queries.tsv")
+
+    def run():
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        generator.generate_queries(num_iterations, out_file, seed=0, shard_size=max(1, num_iterations // 4))
+
+    return run, num_iterations
+
+
+def bench_metrics_evaluate(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Scores generated SPARQL queries against the query generated after them."""
+    queries = [query for _, query, _ in context["queries"]]
+    pairs = list(zip(queries, queries[1:] + queries[:1]))
+
+    def run():
+        # BLEU warns about every pair without 3- or 4-gram overlaps
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            return [Metrics.evaluate(prediction, truth) for prediction, truth in pairs]
+
+    return run, len(pairs)
+
+
+def bench_entity_resolver_resolve(context: Dict) -> Tuple[Callable[[], object], int]:
+    """Resolves the bracketed entities of generated SPARQL queries by fuzzy matching against every entity label."""
+    resolver = EntityResolver(context["data_dir"])
+    queries = [query for _, query, _ in context["queries"][: context["num_resolves"]]]
+    return lambda: [resolver.resolve(query) for query in queries], len(queries)
+
+
+BENCHMARKS: Dict[str, Benchmark] = {
+    "predicate_bank_load": bench_predicate_bank_load,
+    "predicate_bank_load_snapshot": bench_predicate_bank_load_snapshot,
+    "type_traversals": bench_type_traversals,
+    "type_paths": bench_type_paths,
+    "template_generator_init": bench_template_generator_init,
+    "type_template": bench_type_template,
+    "sample_typed_template": bench_sample_typed_template,
+    "fill_query": bench_fill_query,
+    "fill_query_batch": bench_fill_query_batch,
+    "generate_queries": bench_generate_queries,
+    "metrics_evaluate": bench_metrics_evaluate,
+    "entity_resolver_resolve": bench_entity_resolver_resolve,
+}
+
+
+def build_context(data_dir: str, tmp_dir: str, num_samples: int, num_iterations: int, num_resolves: int) -> Dict:
+    """Loads the pipeline once and samples the inputs that benchmarks share."""
+    query_generator = FullQueryGenerator(data_dir=data_dir)
+    template_gen = query_generator.template_generator
+    keys = list(template_gen.templates.keys())
+
+    query_generator.rng.seed(0)
+    typed_templates = []
+    while len(typed_templates) < num_samples:
+        key = keys[len(typed_templates) % len(keys)]
+        typed_templates.append((key, template_gen.sample_typed_template(key)))
+    queries = query_generator.generate_shard(0, 0, max(1, num_samples // len(keys)))
+
+    return {
+        "data_dir": data_dir,
+        "tmp_dir": tmp_dir,
+        "num_samples": num_samples,
+        "num_iterations": num_iterations,
+        "num_resolves": num_resolves,
+        "query_generator": query_generator,
+        "predicate_bank": query_generator.predicate_bank,
+        "type_generator": query_generator.type_generator,
+        "template_generator": template_gen,
+        "template_filler": TemplateFiller(query_generator.predicate_bank),
+        "typed_templates": typed_templates,
+        "queries": queries,
+    }
+
+
+def run_benchmark(benchmark: Benchmark, context: Dict, repeat: int) -> Dict:
+    """
+    Returns:
+        the best time of repeat calls, the operations per second at that time and the peak memory traced during one
+        more call (tracing slows the call down, so it is never timed)
+    """
+    function, ops = benchmark(context)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = min(times)
+    return {"ops": ops, "seconds": seconds, "ops_per_second": ops / seconds if seconds else 0.0, "peak_bytes": peak}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Args:
+        results: "results" of a run, {scale: {benchmark: {"ops_per_second": ..., "peak_bytes": ...}}}
+        baseline: "results" of the baseline run
+        tolerance: 0.2 flags throughput that dropped or peak memory that grew by more than 20%
+
+    Returns:
+        a message per regression, benchmarks missing from either run are skipped
+    """
+    regressions = []
+    for scale, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            reference = baseline.get(scale, {}).get(name)
+            if reference is None:
+                continue
+            if result["ops_per_second"] < reference["ops_per_second"] * (1 - tolerance):
+                regressions.append(
+                    f"{scale} {name}: {result['ops_per_second']:.2f} ops/s, "
+                    f"baseline {reference['ops_per_second']:.2f} ops/s"
+                )
+            if result["peak_bytes"] > reference["peak_bytes"] * (1 + tolerance):
+                regressions.append(
+                    f"{scale} {name}: peak {result['peak_bytes'] / 2 ** 20:.1f} MiB, "
+                    f"baseline {reference['peak_bytes'] / 2 ** 20:.1f} MiB"
+                )
+    return regressions
+
+
+def synthetic_data_dir(data_root: str, scale: float, density: float, seed: int) -> str:
+    """Generates the synthetic data of a scale into data_root once and reuses it while its parameters match."""
+    data_dir = os.path.join(data_root, f"{scale:g}x")
+    params = {"scale": scale, "density": density, "seed": seed}
+    params_file = os.path.join(data_dir, "synthetic.json")
+    if os.path.exists(params_file):
+        with open(params_file, "r") as f:
+            if json.load(f).get("params") == params:
+                return data_dir
+    sizes = generate_synthetic_data(data_dir, scale=scale, density=density, seed=seed)
+    with open(params_file, "w") as f:
+        json.dump({"params": params, "sizes": sizes}, f)
+    return data_dir
+
+
+def main(
+    scales: str = "1,10",
+    density: float = BASE_DENSITY,
+    data_root: str = "./bench_data",
+    benchmarks: Optional[str] = None,
+    repeat: int = 5,
+    num_samples: int = 2000,
+    num_iterations: int = 500,
+    num_resolves: int = 20,
+    seed: int = 0,
+    out_file: str = "./benchmark_results.json",
+    baseline: Optional[str] = None,
+    tolerance: float = 0.25,
+):
+    """Runs the benchmarks on synthetic data of every scale and flags regressions against a baseline, if given.
+
+    python -m scripts.benchmarks.run_benchmarks --scales 1,10,100 --out-file ./benchmark_results.json
+
+    With --baseline, exits with status 1 if any benchmark is slower, or peaks higher, than the baseline by more than
+    the tolerance. Throughput depends on the machine, so no baseline is shipped: record one on the machine you compare
+    on, e.g. from the commit you branched off, and pass it with --baseline.
+
+    Args:
+        scales: Comma separated sizes of the synthetic data relative to the shipped data directory.
+        density: Fraction of (start domain, type) pairs of the synthetic type graph that have predicates.
+        data_root: Directory the synthetic data directories are generated into (and reused from).
+        benchmarks: Comma separated names of the benchmarks to run, all by default.
+        repeat: Number of timed calls per benchmark, the best is reported.
+        num_samples: Number of samples, typed templates and fills per call of the sampling benchmarks.
+        num_iterations: Number of iterations per call of generate_queries.
+        num_resolves: Number of queries per call of EntityResolver.resolve.
+        seed: Seed of the synthetic data.
+        out_file: JSON file to write the results to.
+        baseline: JSON results of an earlier run to compare against, nothing is compared by default.
+        tolerance: Relative drop in throughput (or growth in peak memory) that counts as a regression.
+    """
+    names = list(BENCHMARKS) if benchmarks is None else benchmarks.split(",")
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {unknown}, expected {list(BENCHMARKS)}.")
+
+    results = dict()
+    for scale in [float(scale) for scale in scales.split(",")]:
+        data_dir = synthetic_data_dir(data_root, scale, density, seed)
+        label = f"{scale:g}x"
+        results[label] = dict()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            context = build_context(data_dir, tmp_dir, num_samples, num_iterations, num_resolves)
+            for name in names:
+                result = run_benchmark(BENCHMARKS[name], context, repeat)
+                results[label][name] = result
+                print(
+                    f"{label:<5} {name:<30} {result['ops_per_second']:12.2f} ops/s "
+                    f"{result['seconds'] * 1e3:10.2f} ms {result['peak_bytes'] / 2 ** 20:10.2f} MiB peak"
+                )
+
+    with open(out_file, "w") as f:
+        json.dump(
+            {
+                "params": {
+                    "density": density,
+                    "repeat": repeat,
+                    "num_samples": num_samples,
+                    "num_iterations": num_iterations,
+                    "num_resolves": num_resolves,
+                    "seed": seed,
+                },
+                "machine": {"python": platform.python_version(), "platform": platform.platform()},
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+    print(f"Saved to {out_file}")
+
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            regressions = compare(results, json.load(f)["results"], tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise typer.Exit(code=1)
+        print(f"No regressions against {baseline}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
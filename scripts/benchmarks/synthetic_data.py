@@ -0,0 +1,120 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+"""Generate synthetic predicate and entity banks in the format of the preprocessed data files."""
+import os
+import json
+import math
+import random
+from typing import Dict, List
+
+import typer
+
+START_DOMAINS = ["television_series", "person", "movie", "literary_work"]
+
+# Sizes of the shipped data/ directory
+BASE_NUM_TYPES = 27
+BASE_NUM_PROPS = 167
+BASE_NUM_ENTITIES = 4600  # per start domain
+# Fraction of (start domain, type) pairs that are predicate types in the shipped data
+BASE_DENSITY = 61 / (len(START_DOMAINS) * BASE_NUM_TYPES)
+
+PREPOSITIONS = ["in", "of", "by", "for"]
+SYLLABLES = ["ka", "lo", "mi", "ren", "sa", "tor", "vi", "zen", "an", "el", "or", "ul", "bra", "qui", "dex", "mon"]
+
+
+def _word(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+
+
+def _phrase(rng: random.Random, max_words: int, min_words: int = 1) -> str:
+    return " ".join(_word(rng) for _ in range(rng.randint(min_words, max_words)))
+
+
+def generate_synthetic_data(
+    out_dir: str, scale: float = 1.0, density: float = BASE_DENSITY, seed: int = 0
+) -> Dict[str, int]:
+    """
+    Args:
+        out_dir: directory to write the *-props-preprocessed.json, *-5k-preprocessed.json and type list files to
+        scale: size relative to the shipped data, props and entities grow linearly with scale and the number of
+            types with sqrt(scale) (the type graph is stored densely, so this keeps 100x feasible)
+        density: fraction of (start domain, type) pairs that have predicates, i.e. the density of the type graph
+        seed: seed of the generated content
+
+    Returns:
+        the number of types, predicate types, props and entities written
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    num_types = max(len(START_DOMAINS), round(BASE_NUM_TYPES * math.sqrt(scale)))
+    types = START_DOMAINS + [f"type_{i}" for i in range(num_types - len(START_DOMAINS))]
+    type_list = {
+        "start_domains": START_DOMAINS,
+        "types": {
+            t: {"WH": [rng.choice(["What", "Who", "When", "Where"])], "start_domain": t in START_DOMAINS} for t in types
+        },
+    }
+    with open(os.path.join(out_dir, "type-list-autogenerated.json"), "w") as f:
+        json.dump(type_list, f)
+
+    # Every start domain keeps at least one predicate type so that every template type stays fillable
+    predicate_types = [f"{s}->{t}" for s in START_DOMAINS for t in types if rng.random() < density]
+    for s in START_DOMAINS:
+        if not any(p.startswith(f"{s}->") for p in predicate_types):
+            predicate_types.append(f"{s}->{rng.choice(START_DOMAINS)}")
+
+    num_props = max(len(predicate_types), round(BASE_NUM_PROPS * scale))
+    props: Dict[str, List[Dict]] = {s: [] for s in START_DOMAINS}
+    for i in range(num_props):
+        predicate_type = predicate_types[i] if i < len(predicate_types) else rng.choice(predicate_types)
+        pos = {"NOUN": [_phrase(rng, 3) for _ in range(rng.randint(1, 6))]}
+        if rng.random() < 0.45:
+            pos["VERB-ADP"] = [f"{_word(rng)} {rng.choice(PREPOSITIONS)}" for _ in range(rng.randint(1, 3))]
+        props[predicate_type.split("->")[0]].append(
+            {
+                "prop": f"http://www.wikidata.org/entity/P{i + 1}",
+                "type": predicate_type,
+                "labels": [label for labels in pos.values() for label in labels],
+                "pos": pos,
+            }
+        )
+
+    num_entities = round(BASE_NUM_ENTITIES * scale)
+    for j, s in enumerate(START_DOMAINS):
+        with open(os.path.join(out_dir, f"{s}-props-preprocessed.json"), "w") as f:
+            json.dump(props[s], f)
+        entities = [
+            {
+                "thing": f"http://www.wikidata.org/entity/Q{j * num_entities + i + 1}",
+                "labels": [_phrase(rng, 3, min_words=2).title() for _ in range(rng.randint(1, 4))],
+            }
+            for i in range(num_entities)
+        ]
+        with open(os.path.join(out_dir, f"{s}-5k-preprocessed.json"), "w") as f:
+            json.dump(entities, f)
+
+    return {
+        "types": num_types,
+        "predicate_types": len(predicate_types),
+        "props": num_props,
+        "entities": num_entities * len(START_DOMAINS),
+    }
+
+
+def main(out_dir: str = "./bench_data/1x", scale: float = 1.0, density: float = BASE_DENSITY, seed: int = 0):
+    """Generate a synthetic data directory.
+
+    python scripts/benchmarks/synthetic_data.py --out-dir ./bench_data/10x --scale 10
+
+    Args:
+        out_dir: Output directory.
+        scale: Size relative to the shipped data directory.
+        density: Fraction of (start domain, type) pairs that have predicates.
+        seed: Seed of the generated content.
+    """
+    print(generate_synthetic_data(out_dir, scale=scale, density=density, seed=seed))
+
+
+if __name__ == "__main__":
+    typer.run(main)
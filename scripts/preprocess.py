@@ -5,8 +5,9 @@ import os
 import re
 import json
 import random
+import hashlib
 from glob import glob
-from typing import Dict
+from typing import Dict, Iterable, Optional
 from itertools import groupby
 
 import typer
@@ -19,6 +20,9 @@ merge_nps = nlp.create_pipe("merge_noun_chunks")
 nlp.add_pipe(merge_ents)
 nlp.add_pipe(merge_nps)
 
+# Version of the tagging rules in spacy_text and pos_pair, bump it when they change the POS tag of a label
+TAGGING_RULES_VERSION = 1
+
 
 def preprocess_things(data_dir: str = "./data", file_identifier: str = "*-5k.json"):
     """Preprocess things (essentially proper nouns) from WikiData with files named "*-5k.json":
@@ -59,36 +63,108 @@ def preprocess_things(data_dir: str = "./data", file_identifier: str = "*-5k.jso
             print(f"Saved to {out_fp}\n")
 
 
-def tag_prop(prop: Dict) -> Dict:
+def spacy_text(label: str) -> str:
+    """The text spaCy tags for a label."""
+    # deal with edge case for noun/verbs: beginning -> noun, instead of verb
+    if len(label.split(" ")) <= 1:
+        return "the " + label
+    return label
+
+
+def pos_pair(doc) -> str:
+    """Turns a tagged label into its POS (pair) tag (EX: NOUN-ADP)."""
+    # get pos tokens and process them
+    pos_tokens = [
+        token.pos_ if token.pos_ != "PROPN" else "NOUN"
+        for token in doc
+        if token.pos_ not in ["DET", "PUNCT"]
+    ]
+
+    # we only care about the first and last pos
+    if len(pos_tokens) > 2:
+        pos_tokens = [pos_tokens[0], pos_tokens[-1]]
+
+    # remove consecutive duplicates: NOUN-NOUN -> NOUN
+    pos_tokens = [group[0] for group in groupby(pos_tokens)]
+
+    # concat into str
+    return "-".join(pos_tokens)
+
+
+def pos_cache_key() -> str:
+    """Hash of the spaCy model's name and version, the pipeline and TAGGING_RULES_VERSION."""
+    text = (
+        f"model={nlp.meta['lang']}_{nlp.meta['name']}\nversion={nlp.meta['version']}\nspacy={spacy.__version__}\n"
+        f"pipeline={','.join(nlp.pipe_names)}\nrules={TAGGING_RULES_VERSION}"
+    )
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class PosTagCache(object):
+    """POS tags by label that persist across runs in cache_dir/pos-tags-<key>.json, with the key from pos_cache_key.
+    A different model, pipeline or version of the tagging rules starts a new cache file.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.key = pos_cache_key()
+        self.path = os.path.join(cache_dir, f"pos-tags-{self.key}.json")
+        self.tags: Dict[str, str] = dict()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                cache = json.load(f)
+            if cache.get("key") == self.key:
+                self.tags = cache["tags"]
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"key": self.key, "tags": self.tags}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def tag_labels(
+    labels: Iterable[str], batch_size: int = 256, n_process: int = 1, cache: Optional[PosTagCache] = None
+) -> Dict[str, str]:
+    """Tags every distinct label once, in batches of batch_size with nlp.pipe over n_process processes.
+    With a cache, only labels that are not in it are tagged and these are added to it.
+
+    Returns:
+        {"set in location": "VERB-NOUN"}
+    """
+    unique_labels = list(dict.fromkeys(labels))
+    pos_tags = dict()
+    if cache is not None:
+        pos_tags = {label: cache.tags[label] for label in unique_labels if label in cache.tags}
+        print(f"{len(pos_tags)} of {len(unique_labels)} labels found in {cache.path}")
+    missing_labels = [label for label in unique_labels if label not in pos_tags]
+    if not missing_labels:
+        return pos_tags
+
+    docs = nlp.pipe((spacy_text(label) for label in missing_labels), batch_size=batch_size, n_process=n_process)
+    for label, doc in zip(missing_labels, tqdm(docs, total=len(missing_labels))):
+        pos_tags[label] = pos_pair(doc)
+    if cache is not None:
+        cache.tags.update((label, pos_tags[label]) for label in missing_labels)
+        cache.save()
+    return pos_tags
+
+
+def tag_prop(prop: Dict, pos_tags: Optional[Dict[str, str]] = None, cache: Optional[PosTagCache] = None) -> Dict:
     """Helper function for preprocess_properties:
         - Assigns a POS (pair) tag to each property (EX: [NOUN-ADP])
         - Filters props that have ID within their labels
         - Covers edge case where a word could be a noun or a verb
+
+    Args:
+        prop: the property with its labels
+        pos_tags: POS tags by label from tag_labels, the labels of prop are tagged if not given
+        cache: PosTagCache used to tag the labels of prop if pos_tags is not given
     """
+    if pos_tags is None:
+        pos_tags = tag_labels(prop["labels"], cache=cache)
     pos_dict = dict()
     for label in prop["labels"]:
-        # deal with edge case for noun/verbs: beginning -> noun, instead of verb
-        temp_label = label
-        if len(label.split(" ")) <= 1:
-            temp_label = "the " + temp_label
-
-        # get pos tokens using spacy and process them
-        pos_tokens = [
-            token.pos_ if token.pos_ != "PROPN" else "NOUN"
-            for token in nlp(temp_label)
-            if token.pos_ not in ["DET", "PUNCT"]
-        ]
-
-        # we only care about the first and last pos
-        if len(pos_tokens) > 2:
-            pos_tokens = [pos_tokens[0], pos_tokens[-1]]
-
-        # remove consecutive duplicates: NOUN-NOUN -> NOUN
-        pos_tokens = [group[0] for group in groupby(pos_tokens)]
-
-        # concat into str
-        pos = "-".join(pos_tokens)
-
+        pos = pos_tags[label]
         if pos_dict.get(pos) is None:
             pos_dict[pos] = []
         pos_dict[pos].append(label)
@@ -96,14 +172,24 @@ def tag_prop(prop: Dict) -> Dict:
     return prop
 
 
-def preprocess_properties(data_dir: str = "./data", file_identifier: str = "*-props.json"):
+def preprocess_properties(
+    data_dir: str = "./data",
+    file_identifier: str = "*-props.json",
+    batch_size: int = 256,
+    n_process: int = 1,
+    pos_cache: bool = True,
+):
     """Preprocesses properties from WikiData with files determined by the file_identifier:
         - Adds type field (must be manually annotated afterwards)
         - Combines propLabel and propAltLabel to labels field
         - Filters out properties that are IDs
         - Tag properties with POS-tags and sort by them
+
+    The labels of all files are tagged together, see tag_labels. With pos_cache, POS tags are kept in a PosTagCache
+    in data_dir/.cache and only new labels are tagged.
     """
     fps = glob(os.path.join(data_dir, file_identifier))
+    preprocessed_files = []
     for fp in fps:
         print(f"Processing {fp}")
         prefix = os.path.basename(fp).replace("-props.json", "")
@@ -136,8 +222,15 @@ def preprocess_properties(data_dir: str = "./data", file_identifier: str = "*-pr
                         break
                 if not is_id:
                     preprocessed_data.append(prop)
+        preprocessed_files.append((fp, preprocessed_data))
+
+    print("Tagging property labels")
+    labels = [label for _, data in preprocessed_files for prop in data for label in prop["labels"]]
+    cache = PosTagCache(os.path.join(data_dir, ".cache")) if pos_cache else None
+    pos_tags = tag_labels(labels, batch_size=batch_size, n_process=n_process, cache=cache)
 
-            preprocessed_data = [tag_prop(prop) for prop in tqdm(preprocessed_data)]
+    for fp, preprocessed_data in preprocessed_files:
+        preprocessed_data = [tag_prop(prop, pos_tags) for prop in preprocessed_data]
 
         # write to file
         base_fp, ext = os.path.splitext(fp)
@@ -187,6 +280,9 @@ def main(
     ent_id: str = "*-5k.json",
     prop_id: str = "*-props.json",
     num_examples_to_generate: int = 10,
+    batch_size: int = 256,
+    n_process: int = 1,
+    pos_cache: bool = True,
 ):
     """Preprocesses entity and property data for the generation pipeline.
 
@@ -194,13 +290,17 @@ def main(
     --data-dir ./data \
     --ent-id *-5k.json \
     --prop-id *-props.json \
-    --num-examples-to-generate 10
+    --num-examples-to-generate 10 \
+    --n-process 4
 
     Args:
         data_dir: Data directory.
         ent_id: Glob identifier for entity data.
         prop_id: Glob identifier for property data.
         num_examples_to_generate: Number of examples to generate for each POS tag. If <= 0, pos-examples.txt is not generated.
+        batch_size: Number of property labels spaCy tags at a time.
+        n_process: Number of processes tagging property labels.
+        pos_cache: Reuse the POS tags of labels tagged in earlier runs, from data_dir/.cache.
 
     Outputs:
         *-5k-preprocessed.json: Preprocessed entity data.
@@ -208,7 +308,9 @@ def main(
         pos-examples.txt: Part-of-speech samples sorted by occurrences.
     """
     preprocess_things(data_dir=data_dir, file_identifier=ent_id)
-    preprocess_properties(data_dir=data_dir, file_identifier=prop_id)
+    preprocess_properties(
+        data_dir=data_dir, file_identifier=prop_id, batch_size=batch_size, n_process=n_process, pos_cache=pos_cache
+    )
     if num_examples_to_generate > 0:
         generate_pos_examples(data_dir=data_dir, num_samples=num_examples_to_generate)
 
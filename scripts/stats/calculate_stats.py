@@ -3,7 +3,7 @@
 """Calculate stats related to dataset as well as some related to the BART model."""
 import os
 import sys
-import json
+import time
 from pathlib import Path
 from glob import glob
 
@@ -11,6 +11,8 @@ import typer
 import numpy as np
 
 sys.path.append(str(Path(__file__).absolute().parent.parent.parent))
+from mk_squit.generation.entity_store import load_entity_table
+from mk_squit.generation.predicate_bank import PredicateBank
 from mk_squit.generation.template_generator import TemplateGenerator
 from mk_squit.generation.type_generator import TypeGenerator
 
@@ -22,14 +24,9 @@ def main(data_dir: str = "./data", verbose: bool = False):
         data_dir: Data directory containing generation source files.
         verbose: Print verbose.
     """
-    file_identifier = "*-props-preprocessed.json"
-    fps = glob(os.path.join(data_dir, file_identifier))
-
-    entities = []
-    for fp in fps:
-        with open(fp, "r") as f:
-            preds = json.load(f)
-            entities.extend(preds)
+    # Predicates and entities are read from the PredicateBank's snapshots instead of parsing the data files
+    pb = PredicateBank(data_dir=data_dir)
+    entities = [pred for preds in pb.bank.values() for pred in preds]
 
     # number of p-values
     predicate_bank = {}
@@ -108,36 +105,17 @@ def main(data_dir: str = "./data", verbose: bool = False):
     #######################################################################
 
     file_identifier: str = "*-5k-preprocessed.json"
-    fps = glob(os.path.join(data_dir, file_identifier))
-
-    entities = []
-    for fp in fps:
-        with open(fp, "r") as f:
-            data = json.load(f)
-            entities.extend(data)
-
-    # number of individual entities
-    entity_bank = {}
-    for ent in entities:
-        q_value = ent["thing"].split("/")[-1]
-        if q_value in entity_bank:
-            entity_bank[q_value].append(ent)
-        else:
-            entity_bank.update({q_value: [ent]})
+    tables = [load_entity_table(fp) for fp in sorted(glob(os.path.join(data_dir, file_identifier)))]
 
     # number of individual entities
-    print(f"# of q-values (entities): {len(entity_bank)}")
+    q_values = set(key for table in tables for key in table.keys)
+    print(f"# of q-values (entities): {len(q_values)}")
     if verbose:
-        print(entity_bank.keys())
+        print(q_values)
 
     # number of labels per q-value and aliases
-    label_set = set()
-    num_labels = []
-    for q_value in entity_bank.keys():
-        for ent in entity_bank[q_value]:
-            for label in ent["labels"]:
-                label_set.add(label)
-            num_labels.append(len(ent["labels"]))
+    label_set = set(label for table in tables for label in table.labels)
+    num_labels = np.concatenate([np.diff(table.offsets) for table in tables])
     print(f"# of entitiy labels: {len(label_set)}")
     if verbose:
         print(label_set)
@@ -149,47 +127,38 @@ def main(data_dir: str = "./data", verbose: bool = False):
     #######################################################################
     #######################################################################
 
-    temp_gen = TemplateGenerator()
+    type_gen = TypeGenerator(pb)
+    temp_gen = TemplateGenerator(type_generator=type_gen, predicate_bank=pb)
     # num of baseline templates
     num_baseline_templates = 0
     for template_type in temp_gen.base_templates.keys():
         num_baseline_templates += len(temp_gen.base_templates[template_type])
     print(f"# of baseline templates: {num_baseline_templates}")
 
-    # num of typed templates
-    type_gen = TypeGenerator()
+    # num of typed templates, paths are counted from the type graph without enumerating them
+    start = time.perf_counter()
     thing_types = ["movie", "person", "literary_work", "television_series"]
     total_num_paths = 0
-    total_num_possible_queries = 0
     for template_type in temp_gen.templates.keys():
         for num_template_tuple in temp_gen.templates[template_type]:
             num_template = num_template_tuple[0]
             pred_chain_lengths = num_template_tuple[1]
             if len(pred_chain_lengths) == 1:
                 for thing in thing_types:
-                    paths = list(
-                        type_gen.generate_unidirectional_pred_traversal(
-                            type_gen.G, thing.lower(), pred_chain_lengths[0]
-                        )
-                    )
-                    total_num_paths += len(paths)
+                    num_paths = type_gen.count_paths(thing.lower(), pred_chain_lengths[0])
+                    total_num_paths += num_paths
                     if verbose:
-                        print(f"Unidirectional - {thing} - {pred_chain_lengths} - paths: {len(paths)}")
+                        print(f"Unidirectional - {thing} - {pred_chain_lengths} - paths: {num_paths}")
             else:
                 for thing_1 in thing_types:
                     for thing_2 in thing_types:
-                        paths = type_gen.generate_bidirectional_pred_traversal(
-                            thing_1.lower(),
-                            thing_2.lower(),
-                            *pred_chain_lengths,
-                            type_gen.G,
-                            type_gen.Gi,
-                            debug_stats=True,
+                        num_paths = type_gen.count_bidirectional_paths(
+                            thing_1.lower(), thing_2.lower(), *pred_chain_lengths
                         )
-                        total_num_paths += len(paths)
+                        total_num_paths += num_paths
                         if verbose:
-                            print(f"Bidirectional - {thing_1} - {thing_2} - {pred_chain_lengths} - {len(paths)} paths")
-    print(f"# of typed templates: {total_num_paths}")
+                            print(f"Bidirectional - {thing_1} - {thing_2} - {pred_chain_lengths} - {num_paths} paths")
+    print(f"# of typed templates: {total_num_paths} (counted in {(time.perf_counter() - start) * 1000:.1f} ms)")
 
 
 if __name__ == "__main__":
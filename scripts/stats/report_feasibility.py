@@ -0,0 +1,45 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+"""Report dead templates and the number of fillable (template, start types, path) combinations."""
+import sys
+import json
+from pathlib import Path
+
+import typer
+
+sys.path.append(str(Path(__file__).absolute().parent.parent.parent))
+from mk_squit.generation.feasibility import FeasibilityTable
+from mk_squit.generation.predicate_bank import PredicateBank
+from mk_squit.generation.template_generator import TemplateGenerator
+from mk_squit.generation.type_generator import TypeGenerator
+
+
+def main(data_dir: str = "./data", out_file: str = None):
+    """Report template feasibility.
+
+    python scripts/stats/report_feasibility.py --data-dir ./data
+
+    Args:
+        data_dir: Data directory containing generation source files.
+        out_file: Optional path to also write the report to as JSON.
+    """
+    pb = PredicateBank(data_dir=data_dir)
+    type_gen = TypeGenerator(pb)
+    temp_gen = TemplateGenerator(type_generator=type_gen, predicate_bank=pb, prune=False)
+    report = FeasibilityTable(type_gen).report(temp_gen.templates)
+
+    for template_type, entry in report.items():
+        print(
+            f"{template_type}: {entry['templates']} templates, {len(entry['dead'])} dead, "
+            f"{entry['combinations']} fillable combinations"
+        )
+        for template in entry["dead"]:
+            print(f"\tdead: {template}")
+
+    if out_file:
+        with open(out_file, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    typer.run(main)
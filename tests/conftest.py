@@ -0,0 +1,17 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from mk_squit.generation.full_query_generator import FullQueryGenerator
+
+DATA_DIR = str(Path(__file__).absolute().parent.parent / "data")
+
+
+@pytest.fixture(scope="session")
+def query_generator() -> FullQueryGenerator:
+    """A generator on the shipped data, loaded once for all tests."""
+    return FullQueryGenerator(data_dir=DATA_DIR, instrument=False)
@@ -0,0 +1,14 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+
+def test_bloom_filter_keeps_digest_set_rows(query_generator, tmp_path):
+    """With fills_per_template, the Bloom filter must be sized for every row written, not for every iteration."""
+    counts = []
+    for bloom_filter in [False, True]:
+        out_file = str(tmp_path / f"queries_{bloom_filter}.tsv")
+        query_generator.generate_queries(
+            2000, out_file, seed=0, dedup="sparql", fills_per_template=8, bloom_filter=bloom_filter
+        )
+        with open(out_file, "r") as f:
+            counts.append(sum(1 for _ in f))
+    assert counts[0] == counts[1]
@@ -0,0 +1,27 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import random
+
+from mk_squit.utils.digest_set import BloomFilter, DigestSet
+
+
+def test_digest_set_matches_set_beyond_capacity():
+    rng = random.Random(0)
+    digests = [rng.getrandbits(64) for _ in range(5000)]
+    digests += digests[:1000] + [0, 0]
+
+    digest_set, expected = DigestSet(capacity=16), set()
+    for digest in digests:
+        assert digest_set.add(digest) == (digest not in expected)
+        expected.add(digest)
+    assert len(digest_set) == len(expected)
+
+
+def test_bloom_filter_keeps_new_digests_at_capacity():
+    rng = random.Random(0)
+    digests = [rng.getrandbits(64) for _ in range(20000)]
+
+    bloom_filter = BloomFilter(capacity=len(digests))
+    # A new digest is reported as seen with probability error_rate (1e-4)
+    assert sum(bloom_filter.add(digest) for digest in digests) >= 0.999 * len(digests)
+    assert not any(bloom_filter.add(digest) for digest in digests)
@@ -0,0 +1,45 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import hashlib
+
+import pytest
+
+from mk_squit.generation.merge_shards import ShardMerger
+from mk_squit.generation.shard_writer import load_manifest, read_shard
+
+
+def row(english: str, entity: str):
+    sparql = f"SELECT ?end WHERE {{ [ {entity} ] wdt:P26 ?end . }}"
+    return english, sparql, hashlib.sha1(sparql.encode("utf-8")).hexdigest()
+
+
+def write_tsv(path: str, rows) -> str:
+    with open(path, "w") as f:
+        f.write("english\tsparql\tunique hash\n" + "\n".join("\t".join(r) for r in rows))
+    return path
+
+
+def read_merged(prefix: str):
+    manifest = load_manifest(prefix + ".manifest.json")
+    rows = []
+    for shard in manifest["shards"]:
+        rows.extend(read_shard(os.path.join(os.path.dirname(prefix), shard["file"]), manifest["format"]))
+    return rows
+
+
+@pytest.mark.parametrize("run_rows,fan_in", [(1000, 64), (3, 2)])
+def test_merge_keeps_first_occurrence(tmp_path, run_rows, fan_in):
+    entities = [f"Entity {i}" for i in range(20)]
+    first = [row(f"first {entity}", entity) for entity in entities[:12]]
+    # Overlaps the first input, and repeats one of its own rows
+    second = [row(f"second {entity}", entity) for entity in entities[8:]] + [row("second again", entities[15])]
+    paths = [write_tsv(str(tmp_path / "a.tsv"), first), write_tsv(str(tmp_path / "b.tsv"), second)]
+
+    prefix = str(tmp_path / "merged")
+    report = ShardMerger(prefix, shard_rows=7, run_rows=run_rows, fan_in=fan_in).merge(paths)
+
+    expected = {h: (english, sparql, h) for english, sparql, h in reversed(first + second)}
+    assert read_merged(prefix) == [expected[h] for h in sorted(expected)]
+    assert report["rows"] == len(first) + len(second)
+    assert report["duplicates"] == len(first) + len(second) - len(expected)
@@ -0,0 +1,96 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import os
+import json
+
+import pytest
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(monkeypatch, generator, num_shards: int) -> None:
+    """Makes the next runs of generator raise Interrupted after writing num_shards shards."""
+    iter_shard_results = generator.iter_shard_results
+
+    def interrupted(*args, **kwargs):
+        for i, result in enumerate(iter_shard_results(*args, **kwargs)):
+            if i == num_shards:
+                raise Interrupted()
+            yield result
+
+    monkeypatch.setattr(generator, "iter_shard_results", interrupted)
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("dedup", [None, "sparql"])
+def test_resumed_tsv_matches_uninterrupted(query_generator, tmp_path, monkeypatch, dedup):
+    expected_file, out_file = str(tmp_path / "expected.tsv"), str(tmp_path / "queries.tsv")
+    kwargs = dict(shard_size=500, chunk_size=2000, dedup=dedup)
+    query_generator.generate_queries(3000, expected_file, seed=7, **kwargs)
+
+    with monkeypatch.context() as m:
+        interrupt_after(m, query_generator, 3)
+        with pytest.raises(Interrupted):
+            query_generator.generate_queries(3000, out_file, seed=7, **kwargs)
+    with open(out_file + ".checkpoint", "r") as f:
+        assert json.load(f)["state"]["next_shard"] > 0
+    query_generator.generate_queries(3000, out_file, resume=True, **kwargs)
+
+    assert read_bytes(out_file) == read_bytes(expected_file)
+    assert not os.path.exists(out_file + ".checkpoint")
+
+
+def test_resume_before_first_checkpoint_starts_over(query_generator, tmp_path, monkeypatch):
+    expected_file, out_file = str(tmp_path / "expected.tsv"), str(tmp_path / "queries.tsv")
+    query_generator.generate_queries(1000, expected_file, seed=7, shard_size=500)
+
+    with monkeypatch.context() as m:
+        interrupt_after(m, query_generator, 0)
+        with pytest.raises(Interrupted):
+            query_generator.generate_queries(1000, out_file, seed=7, shard_size=500)
+    query_generator.generate_queries(1000, out_file, seed=7, shard_size=500, resume=True)
+
+    assert read_bytes(out_file) == read_bytes(expected_file)
+
+
+@pytest.mark.parametrize("output_format", [None, "jsonl.gz"])
+def test_resume_keeps_complete_output(query_generator, tmp_path, monkeypatch, output_format):
+    out_file = str(tmp_path / ("queries.tsv" if output_format is None else "queries"))
+    query_generator.generate_queries(1000, out_file, seed=7, shard_size=500, output_format=output_format)
+    files = {path: read_bytes(str(tmp_path / path)) for path in os.listdir(tmp_path)}
+
+    # Generating anything when resuming a complete output fails
+    interrupt_after(monkeypatch, query_generator, 0)
+    query_generator.generate_queries(1000, out_file, seed=8, shard_size=500, output_format=output_format, resume=True)
+
+    assert {path: read_bytes(str(tmp_path / path)) for path in os.listdir(tmp_path)} == files
+
+
+@pytest.mark.parametrize("dedup", [None, "sparql"])
+def test_resumed_shards_match_uninterrupted(query_generator, tmp_path, monkeypatch, dedup):
+    def shards(prefix):
+        with open(prefix + ".manifest.json", "r") as f:
+            return [(shard["rows"], shard["sha1"]) for shard in json.load(f)["shards"]]
+
+    expected_prefix, prefix = str(tmp_path / "expected"), str(tmp_path / "queries")
+    # Output shards are closed in the middle of writing the rows of a generator shard
+    kwargs = dict(shard_size=500, output_format="jsonl.gz", shard_rows=2000, dedup=dedup, tokenize="sparql")
+    query_generator.generate_queries(3000, expected_prefix, seed=7, **kwargs)
+
+    with monkeypatch.context() as m:
+        interrupt_after(m, query_generator, 4)
+        with pytest.raises(Interrupted):
+            query_generator.generate_queries(3000, prefix, seed=7, **kwargs)
+    assert shards(prefix)
+    query_generator.generate_queries(3000, prefix, resume=True, **kwargs)
+
+    assert shards(prefix) == shards(expected_prefix)
+    assert all(rows == 2000 for rows, _ in shards(prefix)[:-1])
+    for suffix in [".sparql.ids.npy", ".sparql.offsets.npy"]:
+        assert read_bytes(prefix + suffix) == read_bytes(expected_prefix + suffix)
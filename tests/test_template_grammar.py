@@ -0,0 +1,32 @@
+# Copyright (c) 2020 MeetKai Inc. All rights reserved.
+
+import pytest
+from nltk.parse.generate import generate
+
+from mk_squit.generation.template_generator import DEPTHS, GRAMMARS
+from mk_squit.generation.template_grammar import TemplateGrammar
+
+CASES = [
+    (grammar_set, key, depth)
+    for grammar_set, grammars in GRAMMARS.items()
+    for key in grammars
+    for depth in range(1, DEPTHS[key] + 3)
+]
+
+
+@pytest.mark.parametrize("grammar_set,key,depth", CASES)
+def test_unranking_matches_nltk_enumeration(grammar_set, key, depth):
+    cfg = GRAMMARS[grammar_set][key]
+    expected = [" ".join(tokens) for tokens in generate(cfg, depth=depth)]
+
+    grammar = TemplateGrammar(cfg, depth)
+    assert len(grammar) == len(expected)
+    assert [grammar[i] for i in range(len(grammar))] == expected
+    assert list(grammar) == expected
+
+
+def test_negative_and_out_of_range_indices():
+    grammar = TemplateGrammar(GRAMMARS["easy"]["multi_entity"], DEPTHS["multi_entity"])
+    assert grammar[-1] == grammar[len(grammar) - 1]
+    with pytest.raises(IndexError):
+        grammar[len(grammar)]